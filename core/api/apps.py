@@ -7,6 +7,10 @@ class ApiConfig(AppConfig):
 
     def ready(self):
         import api.signals
+        from . import etags,follow_cache,response_cache
+        response_cache.check_settings()
+        etags.check_settings()
+        follow_cache.check_settings()
 
 
 
@@ -0,0 +1,83 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image,ImageOps
+from io import BytesIO
+import os
+
+
+AVATAR_SIZES = (48,96,400)
+
+# formats kept as they are; anything else (BMP, TIFF...) is re-encoded as PNG
+EXTENSIONS = {'JPEG':'jpg','PNG':'png','WEBP':'webp','GIF':'gif'}
+
+SAVE_OPTIONS = {
+    'JPEG':{'quality':85,'optimize':True,'progressive':True},
+    'PNG':{'optimize':True},
+    'WEBP':{'quality':80,'method':4},
+    'GIF':{},
+}
+
+
+def open_avatar(file):
+    img = Image.open(file)
+    source_format = img.format if img.format in EXTENSIONS else 'PNG'
+    # JPEG decodes straight to 1/2, 1/4 or 1/8 scale as long as the result stays
+    # at least as large as the biggest variant; other formats ignore the draft
+    img.draft('RGB',(max(AVATAR_SIZES),max(AVATAR_SIZES)))
+    img = ImageOps.exif_transpose(img)
+    img = img.convert('RGBA' if img.mode in ('RGBA','LA','P','PA') else 'RGB')
+    return img,source_format
+
+
+
+def square(img,size):
+    # centered square crop, never upscaled; reducing_gap shrinks with a cheap box filter first
+    width,height = img.size
+    side = min(width,height)
+    box = ((width - side) / 2,(height - side) / 2,(width + side) / 2,(height + side) / 2)
+    size = min(size,side)
+    return img.resize((size,size),Image.LANCZOS,box=box,reducing_gap=3.0)
+
+
+
+def encode(img,image_format):
+    if image_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer,format=image_format,**SAVE_OPTIONS[image_format])
+    return buffer.getvalue()
+
+
+
+def render_avatar_variants(file,name):
+    # returns {"48": {"webp": path, "jpeg": path}, ...}; the original upload is left untouched
+    img,source_format = open_avatar(file)
+    stem = os.path.splitext(os.path.basename(name))[0]
+    formats = ['WEBP'] if source_format == 'WEBP' else ['WEBP',source_format]
+    variants = {}
+    for size in sorted(AVATAR_SIZES,reverse=True):
+        resized = square(img,size)
+        variants[str(size)] = {
+            image_format.lower():default_storage.save(
+                f'avatars/{size}/{stem}.{EXTENSIONS[image_format]}',
+                ContentFile(encode(resized,image_format))
+            )
+            for image_format in formats
+        }
+    return variants
+
+
+
+def variant_names(variants):
+    return [name for formats in (variants or {}).values() for name in formats.values()]
+
+
+
+def variant_urls(variants,request=None):
+    urls = {}
+    for size,formats in (variants or {}).items():
+        urls[size] = {}
+        for image_format,name in formats.items():
+            url = default_storage.url(name)
+            urls[size][image_format] = request.build_absolute_uri(url) if request else url
+    return urls
@@ -0,0 +1,317 @@
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+from chat.conversations import create_messages
+from chat.models import ChatMessage
+from notifications.counters import reconcile_unread_counters
+from notifications.models import Notification
+from timelines.utils import rebuild_timeline
+from .counters import COUNTERS,adjust_counter,reconcile_chunk
+from .models import Comment,CommentLike,CustomUser,Follow,Post,PostLike,PostMedia,UploadSession,UserProfile
+from .uploads import upload_setting
+from PIL import Image
+from io import BytesIO
+import math
+import random
+import time
+
+# Synthetic dataset and request scenarios for the `benchmark` management command.
+# Every request goes through the Django test client with a real JWT, so the numbers
+# include authentication, routing, serialization and rendering but no network.
+
+
+def seed(users=200,posts_per_user=10,follows_per_user=20,comments_per_post=4,replies_per_comment=2,seed=0):
+    rng = random.Random(seed)
+    password = make_password('benchmark')
+    created = CustomUser.objects.bulk_create([
+        CustomUser(username=f'bench{i}',email=f'bench{i}@example.com',first_name='Bench',last_name=str(i),password=password)
+        for i in range(users)
+    ])
+    UserProfile.objects.bulk_create([UserProfile(user=user,bio=f'bio of {user.username}') for user in created])
+    user_ids = [user.id for user in created]
+
+    # random follow graph: every list mixes followed and unfollowed users
+    follows = set()
+    for follower_id in user_ids:
+        for following_id in rng.sample(user_ids,min(follows_per_user,len(user_ids) - 1)):
+            if following_id != follower_id:
+                follows.add((follower_id,following_id))
+    Follow.objects.bulk_create([Follow(follower_id=a,following_id=b) for a,b in follows],batch_size=1000)
+
+    posts = Post.objects.bulk_create([
+        Post(author_id=user_id,content=f'post {i} of {user_id}',is_public=rng.random() < 0.5)
+        for user_id in user_ids for i in range(posts_per_user)
+    ],batch_size=1000)
+    PostMedia.objects.bulk_create([
+        PostMedia(post=post,media_type='image',file=f'post_media/bench{post.id}.png') for post in posts if rng.random() < 0.3
+    ],batch_size=1000)
+    PostLike.objects.bulk_create([
+        PostLike(post=post,user_id=user_id) for post in posts for user_id in rng.sample(user_ids,min(5,len(user_ids)))
+    ],batch_size=1000,ignore_conflicts=True)
+
+    comments = Comment.objects.bulk_create([
+        Comment(post=post,author_id=rng.choice(user_ids),content='comment') for post in posts for i in range(comments_per_post)
+    ],batch_size=1000)
+    Comment.objects.bulk_create([
+        Comment(post_id=comment.post_id,parent=comment,author_id=rng.choice(user_ids),content='reply')
+        for comment in comments for i in range(replies_per_comment)
+    ],batch_size=1000)
+    CommentLike.objects.bulk_create([
+        CommentLike(comment=comment,user_id=rng.choice(user_ids)) for comment in comments
+    ],batch_size=1000,ignore_conflicts=True)
+
+    # the first user is the viewer of every scenario
+    viewer_id = user_ids[0]
+    notifications = []
+    for i in range(60):
+        actors = rng.sample(user_ids,3)
+        notifications.append(Notification(
+            user_id=actors[0],target_user_id=viewer_id,post=rng.choice(posts),verb=Notification.POST_LIKE,
+            message='benchmark notification',actor_count=rng.randint(3,50),recent_actors=actors,is_read=i % 3 == 0
+        ))
+    Notification.objects.bulk_create(notifications)
+    create_messages([
+        ChatMessage(sender_id=a,receiver_id=b,content='benchmark message',is_read=rng.random() < 0.5)
+        for partner_id in user_ids[1:11] for a,b in [(viewer_id,partner_id),(partner_id,viewer_id)] * 10
+    ])
+
+    for model in COUNTERS:
+        ids = list(model.objects.values_list('pk',flat=True))
+        for start in range(0,len(ids),1000):
+            reconcile_chunk(model,ids[start:start + 1000])
+    reconcile_unread_counters()
+    for user in created:
+        rebuild_timeline(user)
+    return CustomUser.objects.get(id=viewer_id)
+
+
+
+def percentile(values,percent):
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    rank = max(1,math.ceil(percent / 100 * len(values)))
+    return values[rank - 1]
+
+
+
+def small_png():
+    buffer = BytesIO()
+    Image.new('RGB',(64,64),'gray').save(buffer,format='PNG')
+    buffer.seek(0)
+    buffer.name = 'avatar.png'
+    return buffer
+
+
+
+class Scenario:
+    # `prepare(client, i)` runs untimed before the i-th request and may return the
+    # (path, data) to use, e.g. to undo the previous iteration of a write
+
+    def __init__(self,name,method,path,data=None,prepare=None,anonymous=False,format='json',content_type=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.prepare = prepare
+        self.anonymous = anonymous
+        self.format = format
+        self.content_type = content_type
+
+    def request(self,client,path,data):
+        kwargs = {'format':self.format} if self.content_type is None else {'content_type':self.content_type}
+        return getattr(client,self.method)(path,data,**kwargs)
+
+
+
+class Benchmark:
+
+    def __init__(self,viewer):
+        self.viewer = viewer
+        self.followed_ids = list(Follow.objects.filter(follower=viewer).values_list('following_id',flat=True))
+        self.stranger = CustomUser.objects.exclude(id__in=self.followed_ids + [viewer.id]).first()
+        self.followed = CustomUser.objects.get(id=self.followed_ids[0])
+        # visible to the viewer whatever the follow state: public posts of other users
+        self.posts = list(Post.objects.filter(is_public=True).exclude(author=viewer).order_by('id').values_list('id',flat=True)[:200])
+        self.comments = list(Comment.objects.filter(post_id__in=self.posts,parent=None).order_by('id').values_list('id','post_id')[:200])
+        self.partner_id = ChatMessage.objects.filter(receiver=viewer).values_list('sender_id',flat=True).first()
+        self.own_post = Post.objects.filter(author=viewer).order_by('id').first()
+        self.own_comment = Comment.objects.create(post_id=self.posts[0],author=viewer,content='own comment')
+        adjust_counter(Post,self.posts[0],'comments_count',1)
+        self.own_reply = Comment.objects.create(post_id=self.posts[0],author=viewer,parent=self.own_comment,content='own reply')
+        self.targets = list(CustomUser.objects.exclude(id__in=self.followed_ids + [viewer.id]).values_list('id',flat=True)[:200])
+
+    def client(self,anonymous=False):
+        # a failing route is reported with its status code instead of aborting the run
+        client = APIClient(raise_request_exception=False)
+        if not anonymous:
+            token = RefreshToken.for_user(self.viewer)
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {token.access_token}')
+            client.cookies['refresh_token'] = str(token)
+        return client
+
+    def pick(self,items,i):
+        return items[i % len(items)]
+
+    def scenarios(self):
+        viewer,followed,stranger = self.viewer,self.followed,self.stranger
+        post_data = lambda i: {'post_id':self.pick(self.posts,i)}
+        comment_data = lambda i: {'comment_id':self.pick(self.comments,i)[0]}
+        follow_data = lambda i: {'user_id':self.pick(self.targets,i)}
+        comment_id,comment_post_id = self.comments[0]
+
+        def undo(method,path,data):
+            # the inverse request, sent untimed so counters stay consistent
+            def prepare(client,i):
+                getattr(client,method)(path,data(i),format='json')
+            return prepare
+
+        def new_comment(parent=None):
+            def prepare(client,i):
+                comment = Comment.objects.create(post_id=self.posts[0],author=viewer,parent=parent,content='to delete')
+                if parent is None:
+                    adjust_counter(Post,self.posts[0],'comments_count',1)
+                    return None,{'post_id':self.posts[0],'comment_id':comment.id}
+                return None,{'post_id':self.posts[0],'parent_id':parent.id,'reply_id':comment.id}
+            return prepare
+
+        def new_post(client,i):
+            return None,{'post_id':Post.objects.create(author=viewer,content='to delete',is_public=True).id}
+
+        def new_media(client,i):
+            media = PostMedia.objects.create(post=self.own_post,media_type='image',file='post_media/benchmark.png')
+            return None,{'post_id':self.own_post.id,'media_id':media.id}
+
+        chunk = b'\0' * min(upload_setting('CHUNK_SIZE'),64 * 1024)
+
+        def new_upload(client,i):
+            session = UploadSession.objects.create(user=viewer,filename='clip.mp4',content_type='video/mp4',size=len(chunk))
+            return f'/api/uploads/{session.id}/?offset=0',chunk
+
+        def uploaded(client,i):
+            session = UploadSession.objects.create(user=viewer,filename='clip.mp4',content_type='video/mp4',size=len(chunk))
+            client.put(f'/api/uploads/{session.id}/?offset=0',chunk,content_type='application/octet-stream')
+            return f'/api/uploads/{session.id}/complete/',None
+
+        def avatar(client,i):
+            return None,{'avatar':small_png()}
+
+        return [
+            # authentication
+            Scenario('jwt create','post','/api/auth/jwt/create/',{'username':viewer.username,'password':'benchmark'},anonymous=True),
+            Scenario('jwt refresh','post','/api/auth/jwt/refresh/'),
+            Scenario('logout','post','/api/auth/jwt/logout/'),
+            # profiles
+            Scenario('profile','get','/api/get/profile/'),
+            Scenario('public profile','get',f'/api/get/public_profile/{followed.id}/'),
+            Scenario('profile update','patch','/api/update/profile/',{'bio':'benchmark bio'}),
+            Scenario('profile picture','put','/api/update/profile/pic/',prepare=avatar,format='multipart'),
+            # reads
+            Scenario('feed','get','/api/feed/'),
+            Scenario('feed anonymous','get','/api/feed/',anonymous=True),
+            Scenario('user posts followed','get',f'/api/posts/get/{followed.id}/'),
+            Scenario('user posts stranger','get',f'/api/posts/get/{stranger.id}/'),
+            Scenario('post comments','get',f'/api/posts/{comment_post_id}/comments/'),
+            Scenario('comment replies','get',f'/api/comments/{comment_id}/replies/'),
+            Scenario('followers','get',f'/api/followers/{followed.id}/'),
+            Scenario('following','get',f'/api/following/{viewer.id}/'),
+            Scenario('notifications','get',f'/api/notifications/get/{viewer.id}/'),
+            Scenario('notifications seen','get','/api/notifications/seen/'),
+            Scenario('discussions list','get','/api/discussions/list/'),
+            Scenario('discussion','get',f'/api/discussions/{self.partner_id}/'),
+            Scenario('discussion delta','get',f'/api/discussions/{self.partner_id}/?after_seq=15'),
+            Scenario('discussion seen','get',f'/api/discussions/seen/{self.partner_id}/'),
+            # likes
+            Scenario('post like','post','/api/post/like/',post_data,prepare=undo('delete','/api/post/unlike/',post_data)),
+            Scenario('post unlike','delete','/api/post/unlike/',post_data,prepare=undo('post','/api/post/like/',post_data)),
+            Scenario('comment like','post','/api/comment/like/',comment_data,prepare=undo('delete','/api/comment/unlike/',comment_data)),
+            Scenario('comment unlike','delete','/api/comment/unlike/',comment_data,prepare=undo('post','/api/comment/like/',comment_data)),
+            # follows
+            Scenario('follow','post','/api/follow/',follow_data,prepare=undo('delete','/api/unfollow/',follow_data)),
+            Scenario('unfollow','delete','/api/unfollow/',follow_data,prepare=undo('post','/api/follow/',follow_data)),
+            # comments
+            Scenario('comment create','post','/api/comments/create/',lambda i: {'post_id':self.pick(self.posts,i),'content':'benchmark comment'}),
+            Scenario('reply create','post','/api/comments/create/',lambda i: {'post_id':comment_post_id,'parent_id':comment_id,'content':'benchmark reply'}),
+            Scenario('comment update','put','/api/comments/update/',{'comment_id':self.own_comment.id,'post_id':self.posts[0],'content':'edited'}),
+            Scenario('reply update','put','/api/reply/update/',{'reply_id':self.own_reply.id,'parent_id':self.own_comment.id,'post_id':self.posts[0],'content':'edited'}),
+            Scenario('comment delete','delete','/api/comments/delete/',prepare=new_comment()),
+            Scenario('reply delete','delete','/api/reply/delete/',prepare=new_comment(self.own_comment)),
+            # posts and media
+            Scenario('post create','post','/api/posts/create/',{'content':'benchmark post','is_public':True}),
+            Scenario('post update','patch','/api/posts/update/',{'post_id':self.own_post.id,'content':'edited'}),
+            Scenario('post delete','delete','/api/posts/delete/',prepare=new_post),
+            Scenario('media delete','delete','/api/media/delete/',prepare=new_media),
+            Scenario('upload create','post','/api/uploads/',{'filename':'clip.mp4','content_type':'video/mp4','size':len(chunk)}),
+            Scenario('upload chunk','put',None,prepare=new_upload,content_type='application/octet-stream'),
+            Scenario('upload complete','post',None,prepare=uploaded),
+        ]
+
+    def run(self,scenario,iterations,warmup=0):
+        client = self.client(scenario.anonymous)
+
+        def call(i):
+            path,data = scenario.path,scenario.data(i) if callable(scenario.data) else scenario.data
+            if scenario.prepare is not None:
+                prepared = scenario.prepare(client,i)
+                if prepared is not None:
+                    path = prepared[0] or path
+                    data = prepared[1] if prepared[1] is not None else data
+            if scenario.name in ('jwt refresh','logout'):
+                # both consume the refresh cookie
+                client.cookies['refresh_token'] = str(RefreshToken.for_user(self.viewer))
+            return path,data
+
+        for i in range(warmup):
+            path,data = call(i)
+            scenario.request(client,path,data)
+
+        timings = []
+        statuses = {}
+        size = 0
+        for i in range(warmup,warmup + iterations):
+            path,data = call(i)
+            start = time.perf_counter()
+            response = scenario.request(client,path,data)
+            timings.append((time.perf_counter() - start) * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code,0) + 1
+            size = len(response.content)
+
+        # queries are counted on one extra request so that capturing them does not skew the timings
+        path,data = call(warmup + iterations)
+        with CaptureQueriesContext(connection) as queries:
+            scenario.request(client,path,data)
+
+        timings.sort()
+        return {
+            'method':scenario.method.upper(),
+            'path':path.split('?')[0],
+            'iterations':iterations,
+            'status':{str(code):count for code,count in sorted(statuses.items())},
+            'p50_ms':round(percentile(timings,50),3),
+            'p95_ms':round(percentile(timings,95),3),
+            'p99_ms':round(percentile(timings,99),3),
+            'mean_ms':round(sum(timings) / len(timings),3),
+            'queries':len(queries),
+            'bytes':size,
+        }
+
+
+
+def compare(results,baseline,threshold):
+    # rows of (endpoint, metric, before, after, change %, regressed)
+    rows = []
+    for name,current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in ('p50_ms','p95_ms','p99_ms','queries','bytes'):
+            before,after = previous.get(metric),current.get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else (0.0 if after == before else math.inf)
+            # latency is noisy and gets a tolerance, query counts must never grow
+            regressed = after > before if metric == 'queries' else (metric.endswith('_ms') and change > threshold)
+            rows.append((name,metric,before,after,change,regressed))
+    return rows
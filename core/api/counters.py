@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models import Count,F,OuterRef,Subquery,Value
+from django.db.models.functions import Coalesce
+from .loaders import grouped_counts
+from .models import Comment,CommentLike,CustomUser,Follow,Post,PostLike
+
+
+# Denormalized counters: (counter column, counted model, foreign key to the owner, extra filter)
+COUNTERS = {
+    Post:[
+        ('likes_count',PostLike,'post_id',{}),
+        ('comments_count',Comment,'post_id',{'parent__isnull':True}),
+    ],
+    Comment:[
+        ('likes_count',CommentLike,'comment_id',{}),
+    ],
+    CustomUser:[
+        ('followers_count',Follow,'following_id',{}),
+        ('following_count',Follow,'follower_id',{}),
+    ],
+}
+
+
+
+def adjust_counter(model,pk,field,delta):
+    # single UPDATE ... SET field = field + delta, safe under concurrent writers
+    model.objects.filter(pk=pk).update(**{field:F(field) + delta})
+
+
+
+def count_subquery(counted_model,key,filters,outer='pk'):
+    counted = counted_model.objects.filter(**{key:OuterRef(outer)},**filters).order_by().values(key).annotate(total=Count('pk')).values('total')
+    return Coalesce(Subquery(counted),Value(0))
+
+
+
+def reconcile_chunk(model,ids):
+    # returns the number of counter values that had drifted and were fixed
+    fixed = 0
+    stored = {row[0]:row[1:] for row in model.objects.filter(pk__in=ids).values_list('pk',*[c[0] for c in COUNTERS[model]])}
+    for index,(field,counted_model,key,filters) in enumerate(COUNTERS[model]):
+        actual = grouped_counts(counted_model.objects.filter(**filters),key,ids)
+        drifted = [pk for pk,values in stored.items() if values[index] != actual.get(pk,0)]
+        if drifted:
+            # recount inside the UPDATE itself so writes racing with the check are not lost
+            with transaction.atomic():
+                model.objects.filter(pk__in=drifted).update(**{field:count_subquery(counted_model,key,filters)})
+            fixed += len(drifted)
+    return fixed
+
+
+
+def recount(queryset,field,expression,chunk_size=1000):
+    # rewrites `field` with `expression` where the two differ, one primary key range per
+    # UPDATE; the count is taken by the UPDATE itself, so no write in between is lost
+    fixed = 0
+    last_pk = 0
+    while True:
+        ids = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk',flat=True)[:chunk_size])
+        if not ids:
+            return fixed
+        fixed += queryset.filter(pk__in=ids).exclude(**{field:expression}).update(**{field:expression})
+        last_pk = ids[-1]
@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags,quote_etag
+from rest_framework.response import Response
+from rest_framework import status
+from .response_cache import require_shared_cache,response_cache_setting,tag_versions
+import hashlib
+import json
+
+# Conditional GET on the tag versions of api.response_cache. A 200 response gets an
+# ETag hashed from its URL, viewer and tag versions, and the versions are stored under
+# that ETag; a request sending it back is answered 304 from one cache round trip when
+# none of the tags changed, before any query or serializer runs. The viewer's own
+# 'user:<id>' tag is always included: a follow bumps it, a like bumps the post.
+# ETags and versions share VERSION_ALIAS, so any process can revalidate an ETag another
+# one issued, against the versions the job worker bumps; that cache must not be per process.
+
+
+DEFAULTS = {
+    'ENABLED':True,
+    'TIMEOUT':86400,  # seconds an ETag can be revalidated without a full response
+}
+
+
+def etag_setting(name):
+    return getattr(settings,'ETAGS',{}).get(name,DEFAULTS[name])
+
+
+
+def check_settings():
+    # called from ApiConfig.ready, also when the response cache itself is disabled
+    if etag_setting('ENABLED'):
+        require_shared_cache(response_cache_setting('VERSION_ALIAS'),"RESPONSE_CACHE['VERSION_ALIAS']")
+
+
+
+def etag_key(etag):
+    return f'etag:{etag}'
+
+
+
+def request_scope(request):
+    viewer = request.user.id if request.user.is_authenticated else None
+    return f"{request.build_absolute_uri()}|{viewer}|{request.META.get('HTTP_ACCEPT','')}"
+
+
+
+def make_etag(scope,versions):
+    return hashlib.md5(f'{scope}|{json.dumps(versions,sort_keys=True)}'.encode()).hexdigest()
+
+
+
+def not_modified(request,scope):
+    cache = caches[response_cache_setting('VERSION_ALIAS')]
+    for etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH','')):
+        etag = etag.removeprefix('W/').strip('"')
+        entry = cache.get(etag_key(etag))
+        if entry is not None and entry['scope'] == scope and tag_versions(entry['versions']) == entry['versions']:
+            return etag
+    return None
+
+
+
+def conditional_response(request,tags,compute,extra_tags=None):
+    """
+    `compute()`, or a 304 when the request's If-None-Match names an ETag whose tags
+    are unchanged. `tags` and `extra_tags(data)` are those of cached_response.
+    """
+    if not etag_setting('ENABLED'):
+        return compute()
+
+    tags = set(tags)
+    if request.user.is_authenticated:
+        tags.add(f'user:{request.user.id}')
+    scope = request_scope(request)
+    etag = not_modified(request,scope)
+    if etag is not None:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        # read before computing, like cached_response
+        versions = tag_versions(tags,create=True)
+        response = compute()
+        if response.status_code != 200:
+            return response
+        if extra_tags is not None:
+            versions.update(tag_versions(set(extra_tags(response.data)) - set(versions),create=True))
+        etag = make_etag(scope,versions)
+        caches[response_cache_setting('VERSION_ALIAS')].set(etag_key(etag),{'scope':scope,'versions':versions},etag_setting('TIMEOUT'))
+    response['ETag'] = quote_etag(etag)
+    patch_vary_headers(response,('Authorization',))
+    return response
@@ -0,0 +1,139 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+from .response_cache import require_shared_cache
+import uuid
+
+# The ids a user follows, kept per process as a sorted array of 64-bit ints in a bounded
+# LRU. Each entry is tagged with a version token stored in the shared cache; following
+# or unfollowing replaces the token, so every process reloads the set on its next lookup.
+# The sets decide what followers-only posts a viewer sees, so a per-process token cache,
+# which would leave the other processes on the old set, is refused at startup.
+
+
+DEFAULTS = {
+    'CACHE_ALIAS':'shared',  # version tokens, shared between processes (Redis, Memcached)
+    'MAX_ENTRIES':10000,  # follow sets kept per process
+}
+
+
+def follow_cache_setting(name):
+    return getattr(settings,'FOLLOW_CACHE',{}).get(name,DEFAULTS[name])
+
+
+
+def check_settings():
+    # called from ApiConfig.ready
+    require_shared_cache(follow_cache_setting('CACHE_ALIAS'),"FOLLOW_CACHE['CACHE_ALIAS']")
+
+
+
+class FollowSet:
+
+    def __init__(self,ids):
+        self.ids = array('q',sorted(ids))
+
+    def __contains__(self,user_id):
+        index = bisect_left(self.ids,user_id)
+        return index < len(self.ids) and self.ids[index] == user_id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+
+EMPTY = FollowSet(())
+
+_entries = OrderedDict()
+_lock = Lock()
+
+
+def version_key(user_id):
+    return f'follow_set_version:{user_id}'
+
+
+
+def current_version(user_id):
+    cache = caches[follow_cache_setting('CACHE_ALIAS')]
+    version = cache.get(version_key(user_id))
+    if version is None:
+        # add() keeps the token of a process that got there first
+        cache.add(version_key(user_id),uuid.uuid4().hex,None)
+        version = cache.get(version_key(user_id))
+    return version
+
+
+
+def get_follow_set(user_id):
+    from .models import Follow
+    if user_id is None:
+        return EMPTY
+    version = current_version(user_id)
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is not None and entry[0] == version:
+            _entries.move_to_end(user_id)
+            return entry[1]
+
+    follow_set = FollowSet(Follow.objects.filter(follower_id=user_id).values_list('following_id',flat=True))
+    with _lock:
+        _entries[user_id] = (version,follow_set)
+        _entries.move_to_end(user_id)
+        while len(_entries) > follow_cache_setting('MAX_ENTRIES'):
+            _entries.popitem(last=False)
+    return follow_set
+
+
+
+def follow_set_for(context,user):
+    # resolved once per serializer tree (nested serializers share the root context)
+    if user is None or not user.is_authenticated:
+        return EMPTY
+    if 'follow_set' not in context:
+        context['follow_set'] = get_follow_set(user.id)
+    return context['follow_set']
+
+
+
+def is_following(user,target_id,context=None):
+    if user is None or not user.is_authenticated:
+        return False
+    follow_set = follow_set_for(context,user) if context is not None else get_follow_set(user.id)
+    return target_id in follow_set
+
+
+
+def invalidate(user_id):
+    with _lock:
+        _entries.pop(user_id,None)
+    caches[follow_cache_setting('CACHE_ALIAS')].delete(version_key(user_id))
+
+
+
+def invalidate_on_commit(user_id):
+    # dropped right away for this transaction, and again after commit so a reader that
+    # loaded the old rows in between does not keep them
+    invalidate(user_id)
+    transaction.on_commit(lambda: invalidate(user_id))
+
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+
+@receiver(setting_changed)
+def reset_follow_cache(setting,**kwargs):
+    if setting in ('FOLLOW_CACHE','CACHES'):
+        clear()
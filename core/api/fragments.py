@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.core.cache import caches
+from .models import CommentLike,PostLike
+from .follow_cache import get_follow_set
+from .response_cache import post_tags,tag_versions
+import hashlib
+
+# Rendered posts in two layers. The fragment, everything but the viewer's flags, is the
+# same for every reader and cached per post with the versions of the response-cache tags
+# it was built from (the post, its author, the commenters shown). The flags, is_liked and
+# is_following on the post and is_liked on its comments, are overlaid per request from
+# one set lookup each. Feed, user posts and notification pages share the fragments.
+
+
+DEFAULTS = {
+    'ENABLED':True,
+    'CACHE_ALIAS':'responses',
+    'TIMEOUT':3600,
+}
+
+
+def fragment_setting(name):
+    return getattr(settings,'POST_FRAGMENTS',{}).get(name,DEFAULTS[name])
+
+
+
+def fragment_key(post_id,base):
+    # file and media urls are absolute when the serializer has a request
+    return f"post_fragment:{hashlib.md5(base.encode()).hexdigest()[:12]}:{post_id}"
+
+
+
+def comment_ids(comments):
+    for comment in comments:
+        yield comment['id']
+        yield from comment_ids(comment.get('replies') or [])
+
+
+
+def overlay_comment(comment,liked_comment_ids):
+    comment = dict(comment)
+    comment['is_liked'] = comment['id'] in liked_comment_ids
+    if comment.get('replies'):
+        comment['replies'] = [overlay_comment(reply,liked_comment_ids) for reply in comment['replies']]
+    return comment
+
+
+
+def overlay(fragments,user):
+    liked_post_ids = liked_comment_ids = followed_ids = ()
+    if user is not None and user.is_authenticated and fragments:
+        liked_post_ids = set(PostLike.objects.filter(user=user,post_id__in=[fragment['id'] for fragment in fragments]).values_list('post_id',flat=True))
+        shown_comment_ids = [comment_id for fragment in fragments for comment_id in comment_ids(fragment['comments'] or [])]
+        if shown_comment_ids:
+            liked_comment_ids = set(CommentLike.objects.filter(user=user,comment_id__in=shown_comment_ids).values_list('comment_id',flat=True))
+        followed_ids = get_follow_set(user.id)
+
+    posts = []
+    for fragment in fragments:
+        post = dict(fragment)
+        author_id = post['author']['id']
+        post['is_liked'] = post['id'] in liked_post_ids
+        post['is_following'] = bool(followed_ids) and author_id != user.id and author_id in followed_ids
+        post['comments'] = [overlay_comment(comment,liked_comment_ids) for comment in post['comments'] or []]
+        posts.append(post)
+    return posts
+
+
+
+def render_posts(posts,context,render):
+    """
+    The representation of `posts` for the viewer in context['user']. `render(posts)`
+    serializes the posts whose fragment is missing or stale, without a viewer.
+    """
+    request = context.get('request')
+    base = request.build_absolute_uri('/') if request is not None else ''
+    cache = caches[fragment_setting('CACHE_ALIAS')]
+    keys = {post.id:fragment_key(post.id,base) for post in posts}
+
+    entries = cache.get_many(list(keys.values()))
+    current = tag_versions({tag for entry in entries.values() for tag in entry['versions']})
+    fragments = {}
+    for post in posts:
+        entry = entries.get(keys[post.id])
+        if entry is not None and all(current.get(tag) == version for tag,version in entry['versions'].items()):
+            fragments[post.id] = entry['data']
+
+    missing = [post for post in posts if post.id not in fragments]
+    if missing:
+        # the tags known up front are read before rendering, like cached_response does
+        versions = tag_versions({f'post:{post.id}' for post in missing} | {f'user:{post.author_id}' for post in missing},create=True)
+        rendered = {fragment['id']:(fragment,post_tags([fragment])) for fragment in render(missing)}
+        shown_tags = set().union(*[tags for fragment,tags in rendered.values()])
+        versions.update(tag_versions(shown_tags - set(versions),create=True))
+        stored = {}
+        for post_id,(fragment,tags) in rendered.items():
+            fragments[post_id] = fragment
+            stored[keys[post_id]] = {'versions':{tag:versions[tag] for tag in tags},'data':fragment}
+        cache.set_many(stored,fragment_setting('TIMEOUT'))
+
+    return overlay([fragments[post.id] for post in posts],context.get('user'))
@@ -0,0 +1,88 @@
+from django.db.models import Count,F,Window,prefetch_related_objects
+from django.db.models.functions import RowNumber
+from .models import Comment,CommentLike,CustomUser,PostLike
+from .follow_cache import get_follow_set
+
+
+# Bulk loaders: compute everything a page of posts needs up front, in a fixed number of
+# queries, so serializers read from a dict instead of querying once per row.
+
+# newest top-level comments embedded in each post of a feed page
+COMMENTS_PREVIEW_SIZE = 3
+# oldest replies embedded under each comment of a comments page
+REPLIES_PREVIEW_SIZE = 3
+
+
+def grouped_counts(queryset,key,ids):
+    if not ids:
+        return {}
+    rows = queryset.filter(**{f'{key}__in':ids}).values(key).annotate(total=Count('id')).values_list(key,'total')
+    return dict(rows)
+
+
+
+def first_per_group(queryset,group,ordering,limit):
+    # the first `limit` rows of every `group` in a single query
+    ranked = queryset.annotate(group_rank=Window(RowNumber(),partition_by=F(group),order_by=ordering))
+    return ranked.filter(group_rank__lte=limit)
+
+
+
+def load_comment_context(comments,user=None,replies_limit=None):
+    # replies_limit: None loads every reply, 0 loads none, n loads the first n per comment
+    top_level_ids = [comment.id for comment in comments if comment.parent_id is None]
+
+    replies = {}
+    if top_level_ids and replies_limit != 0:
+        reply_rows = Comment.objects.filter(parent_id__in=top_level_ids).select_related('author__userprofile')
+        if replies_limit is not None:
+            reply_rows = first_per_group(reply_rows,'parent_id',(F('created_at').asc(),F('id').asc()),replies_limit)
+        for reply in reply_rows.order_by('created_at','id'):
+            replies.setdefault(reply.parent_id,[]).append(reply)
+
+    liked_comment_ids = set()
+    if user is not None and user.is_authenticated and comments:
+        comment_ids = [comment.id for comment in comments] + [reply.id for thread in replies.values() for reply in thread]
+        liked_comment_ids = set(CommentLike.objects.filter(user=user,comment_id__in=comment_ids).values_list('comment_id',flat=True))
+
+    return {
+        'replies':replies,
+        'replies_counts':grouped_counts(Comment.objects.all(),'parent_id',top_level_ids),
+        'liked_comment_ids':liked_comment_ids,
+    }
+
+
+
+def load_post_context(posts,user=None):
+    post_ids = [post.id for post in posts]
+    prefetch_related_objects(posts,'media','author__userprofile')
+
+    comments = {post_id:[] for post_id in post_ids}
+    if post_ids:
+        previews = first_per_group(
+            Comment.objects.filter(post_id__in=post_ids,parent=None).select_related('author__userprofile'),
+            'post_id',(F('created_at').desc(),F('id').desc()),COMMENTS_PREVIEW_SIZE
+        )
+        for comment in previews.order_by('-created_at','-id'):
+            comments[comment.post_id].append(comment)
+
+    liked_post_ids = set()
+    followed_ids = set()
+    if user is not None and user.is_authenticated and post_ids:
+        liked_post_ids = set(PostLike.objects.filter(user=user,post_id__in=post_ids).values_list('post_id',flat=True))
+        followed_ids = get_follow_set(user.id)
+
+    preview_comments = [comment for post_comments in comments.values() for comment in post_comments]
+    return {
+        'comments':comments,
+        'comment_context':load_comment_context(preview_comments,user,replies_limit=0),
+        'liked_post_ids':liked_post_ids,
+        'followed_ids':followed_ids,
+    }
+
+
+
+def load_actor_cards(user_ids):
+    # {user id: {'id','username','avatar'}} for the actors shown on grouped notifications
+    users = CustomUser.objects.filter(id__in=set(user_ids)).select_related('userprofile').only('id','username','userprofile__avatar')
+    return {user.id:{'id':user.id,'username':user.username,'avatar':str(user.userprofile.avatar)} for user in users}
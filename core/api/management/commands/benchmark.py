@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand,CommandError
+from django.db import connection
+from django.test.utils import override_settings,setup_test_environment,teardown_test_environment
+from django.utils import timezone
+from api.benchmarks import Benchmark,compare,seed
+import django
+import json
+import logging
+import re
+import shutil
+import sys
+import tempfile
+
+
+class Command(BaseCommand):
+    help = 'Seed a synthetic dataset in a throwaway test database and measure latency, SQL queries and response size of every API route.'
+
+    def add_arguments(self,parser):
+        parser.add_argument('--users',type=int,default=200)
+        parser.add_argument('--posts-per-user',type=int,default=10)
+        parser.add_argument('--follows-per-user',type=int,default=20)
+        parser.add_argument('--comments-per-post',type=int,default=4)
+        parser.add_argument('--replies-per-comment',type=int,default=2)
+        parser.add_argument('--seed',type=int,default=0,help='Random seed of the dataset.')
+        parser.add_argument('--iterations',type=int,default=50,help='Timed requests per endpoint.')
+        parser.add_argument('--warmup',type=int,default=5,help='Untimed requests per endpoint before measuring.')
+        parser.add_argument('--only',help='Regular expression; only endpoints whose name matches are run.')
+        parser.add_argument('--output',help='Write the results as JSON to this file.')
+        parser.add_argument('--baseline',help='JSON file of a previous run to compare against.')
+        parser.add_argument('--threshold',type=float,default=10.0,help='Latency growth in percent reported as a regression.')
+        parser.add_argument('--fail-on-regression',action='store_true',help='Exit with status 1 when the comparison finds a regression.')
+        parser.add_argument('--keepdb',action='store_true',help='Reuse the benchmark database between runs.')
+
+    def handle(self,*args,**options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)['endpoints']
+        only = re.compile(options['only']) if options['only'] else None
+
+        # never touch the real database or media: both are replaced for the whole run
+        setup_test_environment()
+        # the untimed undo requests of write scenarios routinely answer 4xx
+        request_logger = logging.getLogger('django.request')
+        request_level = request_logger.level
+        request_logger.setLevel(logging.CRITICAL)
+        media_root = tempfile.mkdtemp(prefix='benchmark-media-')
+        # no socket is open during the run, presence is read from a local cache instead of Redis;
+        # invalidation tokens go to a directory, the benchmark is a single process
+        cache_dir = tempfile.mkdtemp(prefix='benchmark-cache-')
+        caches = dict(
+            settings.CACHES,
+            presence={'BACKEND':'django.core.cache.backends.locmem.LocMemCache','LOCATION':'presence'},
+            shared={'BACKEND':'django.core.cache.backends.filebased.FileBasedCache','LOCATION':cache_dir},
+        )
+        old_name = connection.creation.create_test_db(verbosity=0,autoclobber=True,serialize=False,keepdb=options['keepdb'])
+        try:
+            with override_settings(MEDIA_ROOT=media_root,CACHES=caches,JOBS=dict(getattr(settings,'JOBS',{}),ALWAYS_EAGER=False)):
+                results = self.run_benchmark(options,only)
+        finally:
+            connection.creation.destroy_test_db(old_name,verbosity=0,keepdb=options['keepdb'])
+            teardown_test_environment()
+            request_logger.setLevel(request_level)
+            shutil.rmtree(media_root,ignore_errors=True)
+            shutil.rmtree(cache_dir,ignore_errors=True)
+
+        report = {
+            'meta':{
+                'created_at':timezone.now().isoformat(),
+                'django':django.get_version(),
+                'python':sys.version.split()[0],
+                'database':connection.vendor,
+                'dataset':{key:options[key] for key in ('users','posts_per_user','follows_per_user','comments_per_post','replies_per_comment','seed')},
+                'iterations':options['iterations'],
+                'warmup':options['warmup'],
+            },
+            'endpoints':results,
+        }
+        if options['output']:
+            with open(options['output'],'w') as output:
+                json.dump(report,output,indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is not None:
+            rows = compare(results,baseline,options['threshold'])
+            regressions = self.print_comparison(rows)
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{regressions} regressions against {options["baseline"]}')
+
+    def run_benchmark(self,options,only):
+        self.stdout.write('Seeding dataset...')
+        viewer = seed(
+            users=options['users'],
+            posts_per_user=options['posts_per_user'],
+            follows_per_user=options['follows_per_user'],
+            comments_per_post=options['comments_per_post'],
+            replies_per_comment=options['replies_per_comment'],
+            seed=options['seed'],
+        )
+        benchmark = Benchmark(viewer)
+        results = {}
+        self.stdout.write(f"{'endpoint':<22}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'bytes':>9}  status")
+        for scenario in benchmark.scenarios():
+            if only and not only.search(scenario.name):
+                continue
+            result = benchmark.run(scenario,options['iterations'],options['warmup'])
+            results[scenario.name] = result
+            statuses = ','.join(result['status'])
+            line = f"{scenario.name:<22}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['queries']:>9}{result['bytes']:>9}  {statuses}"
+            failed = any(int(code) >= 400 for code in result['status'])
+            self.stdout.write(self.style.ERROR(line) if failed else line)
+        return results
+
+    def print_comparison(self,rows):
+        regressions = 0
+        self.stdout.write('')
+        self.stdout.write(f"{'endpoint':<22}{'metric':<9}{'baseline':>11}{'current':>11}{'change':>9}")
+        for name,metric,before,after,change,regressed in rows:
+            line = f'{name:<22}{metric:<9}{before:>11}{after:>11}{change:>8.1f}%'
+            if regressed:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(line))
+            elif change < 0:
+                self.stdout.write(self.style.SUCCESS(line))
+            else:
+                self.stdout.write(line)
+        return regressions
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from api.models import UserProfile
+from api.tasks import generate_avatar_variants
+
+
+class Command(BaseCommand):
+    help = 'Queue the avatar pipeline for profiles whose uploaded avatar has no size variants yet.'
+
+    def handle(self,*args,**options):
+        default = UserProfile._meta.get_field('avatar').default
+        profiles = UserProfile.objects.filter(avatar_variants={}).exclude(avatar=default).values_list('id','avatar')
+        queued = 0
+        for profile_id,avatar_name in profiles.iterator():
+            generate_avatar_variants.enqueue(profile_id,avatar_name)
+            queued += 1
+        self.stdout.write(self.style.SUCCESS(f'Queued {queued} avatars.'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from api.counters import COUNTERS,reconcile_chunk
+import time
+
+
+class Command(BaseCommand):
+    help = 'Recount denormalized like/comment/follow counters and fix the rows that drifted.'
+
+    def add_arguments(self,parser):
+        parser.add_argument('--chunk-size',type=int,default=1000,help='Rows checked per chunk.')
+        parser.add_argument('--pause',type=float,default=0.0,help='Seconds to sleep between chunks to leave room for live traffic.')
+
+    def handle(self,*args,**options):
+        chunk_size = options['chunk_size']
+        for model in COUNTERS:
+            checked = fixed = 0
+            last_pk = 0
+            while True:
+                # walk the primary key range; each chunk is its own short transaction
+                ids = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk',flat=True)[:chunk_size])
+                if not ids:
+                    break
+                fixed += reconcile_chunk(model,ids)
+                checked += len(ids)
+                last_pk = ids[-1]
+                if options['pause']:
+                    time.sleep(options['pause'])
+            self.stdout.write(f'{model.__name__}: checked {checked} rows, fixed {fixed} counters')
+        self.stdout.write(self.style.SUCCESS('Counters reconciled.'))
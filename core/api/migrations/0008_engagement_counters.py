@@ -0,0 +1,65 @@
+# Generated by Django 5.1.2 on 2026-10-18 18:59
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_of(model, key, **filters):
+    counted = model.objects.filter(**{key: OuterRef('pk')}, **filters).order_by().values(key).annotate(total=Count('pk')).values('total')
+    return Coalesce(Subquery(counted), Value(0))
+
+
+def backfill_counters(apps, schema_editor):
+    Post = apps.get_model('api', 'Post')
+    PostLike = apps.get_model('api', 'PostLike')
+    Comment = apps.get_model('api', 'Comment')
+    CommentLike = apps.get_model('api', 'CommentLike')
+    CustomUser = apps.get_model('api', 'CustomUser')
+    Follow = apps.get_model('api', 'Follow')
+
+    Post.objects.update(
+        likes_count=count_of(PostLike, 'post_id'),
+        comments_count=count_of(Comment, 'post_id', parent__isnull=True),
+    )
+    Comment.objects.update(likes_count=count_of(CommentLike, 'comment_id'))
+    CustomUser.objects.update(
+        followers_count=count_of(Follow, 'following_id'),
+        following_count=count_of(Follow, 'follower_id'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_alter_userprofile_avatar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='followers_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='locked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,16 +1,26 @@
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser,BaseUserManager,PermissionsMixin
-from PIL import Image
-import os
+from .avatars import variant_names
 import uuid
-from django.core.files.base import ContentFile
-from io import BytesIO
 
 
 
 
 
 
+class CounterFieldsMixin:
+    # the counter columns are only written with F() updates (api.counters); saving a loaded
+    # instance leaves them out, so it cannot undo increments made since it was read
+    counter_fields = ()
+
+    def save(self,*args,**kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name not in self.counter_fields]
+        super().save(*args,**kwargs)
+
+
+
+
 class CustomUserManager(BaseUserManager):
     def create_user(self,username,password=None,**extra_fields):
         if not username:
@@ -33,7 +43,7 @@ class CustomUserManager(BaseUserManager):
 
 
 
-class CustomUser(AbstractBaseUser,PermissionsMixin):
+class CustomUser(CounterFieldsMixin,AbstractBaseUser,PermissionsMixin):
     email = models.EmailField(unique=True,blank=False)
     username = models.CharField(max_length=35,unique=True,blank=False)
     first_name= models.CharField(max_length=35,blank=False)
@@ -41,8 +51,11 @@ class CustomUser(AbstractBaseUser,PermissionsMixin):
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
     date_joined = models.DateTimeField(auto_now_add=True)
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
     
     
+    counter_fields = ('followers_count','following_count')
     objects = CustomUserManager()
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = ['first_name','last_name','email']
@@ -57,54 +70,64 @@ class UserProfile(models.Model):
     user  = models.OneToOneField(CustomUser,on_delete=models.CASCADE)
     bio = models.TextField(blank=True)
     avatar = models.ImageField(upload_to='avatars/',default='avatars/user.jpg', blank=False,null=False)
+    # {"48": {"webp": path, "jpeg": path}, ...}, filled in by api.tasks.generate_avatar_variants
+    avatar_variants = models.JSONField(default=dict,blank=True)
 
     def __str__(self) -> str:
         return self.user.username
     
-    def save(self, *args, **kwargs):
-        if self.avatar and hasattr(self.avatar, 'file'):
-            try:
-                old_avatar = UserProfile.objects.get(pk=self.pk).avatar
-            except UserProfile.DoesNotExist:
-                old_avatar = None
-
-            # Only proceed if the avatar is new or different
-            if not old_avatar or old_avatar.name != self.avatar.name:
-                # Open the image using Pillow
-                img = Image.open(self.avatar)
-
-                # Resize the image to 400x400
-                img = img.resize((400, 400), Image.LANCZOS)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # remember the stored avatar so save() can tell a new upload without querying
+        self._saved_avatar_name = self.avatar.name
 
-                # Save the resized image to an in-memory file
-                img_io = BytesIO()
-
-                # Get the format from the original image or set a default
-                image_format = img.format if img.format else 'png'
-
-                # Save the image in the specified format
-                img.save(img_io, format=image_format)
-                img_io.seek(0)
-
-                # Generate a new image name by appending a UUID to it
-                original_image_name = self.avatar.name
-                image_name, extension = os.path.splitext(original_image_name)
-                new_image_name = f"{image_name}_{uuid.uuid4()}{extension}"
-
-                # Replace the avatar with the new image
-                self.avatar.save(new_image_name, ContentFile(img_io.read()), save=False)
+    def save(self, *args, **kwargs):
+        avatar_changed = self.avatar.name != self._saved_avatar_name
+        old_avatar_name = self._saved_avatar_name
+        stale_files = []
+
+        if avatar_changed:
+            if not self._state.adding:
+                # the variants on this instance may predate the job that generated them
+                stale_variants = UserProfile.objects.filter(pk=self.pk).values_list('avatar_variants',flat=True).first()
+                stale_files = variant_names(stale_variants)
+            if old_avatar_name and old_avatar_name != self._meta.get_field('avatar').default:
+                stale_files.append(old_avatar_name)
+            self.avatar_variants = {}
+        elif not self._state.adding and 'update_fields' not in kwargs:
+            # avatar_variants is written by the pipeline only, a stale instance must not overwrite it
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != 'avatar_variants']
 
-        # Call the parent's save method to continue saving the model instance
         super().save(*args, **kwargs)
 
+        if avatar_changed:
+            from .tasks import delete_files,generate_avatar_variants
+            # Resizing happens on the job worker, not in the request
+            generate_avatar_variants.enqueue(self.pk, self.avatar.name)
+            if stale_files:
+                delete_files.enqueue(stale_files)
+            self._saved_avatar_name = self.avatar.name
+
 
 
-class Post(models.Model):
+class Post(CounterFieldsMixin,models.Model):
     author = models.ForeignKey(CustomUser,on_delete=models.CASCADE)
     content = models.TextField(null=True,blank=True)
     is_public = models.BooleanField(default=False)
+    likes_count = models.PositiveIntegerField(default=0)
+    # top-level comments only, replies are not counted
+    comments_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    counter_fields = ('likes_count','comments_count')
+
+    class Meta:
+        indexes = [
+            # user posts page and the pulled authors of the home timeline
+            models.Index(fields=['author','-created_at','-id'],name='post_author_recent_idx'),
+            # public part of the feed; partial, as the bare boolean filter cannot seek an index on is_public
+            models.Index(fields=['-created_at','-id'],name='post_public_recent_idx',condition=models.Q(is_public=True)),
+        ]
 
 
     def __str__(self) -> str:
@@ -120,18 +143,50 @@ class PostMedia(models.Model):
         ('video','Video')
     ]
 
-    post = models.ForeignKey(Post,related_name='media',on_delete=models.CASCADE)
+    # null while a finalized chunked upload waits to be attached to a post
+    post = models.ForeignKey(Post,related_name='media',on_delete=models.CASCADE,null=True,blank=True)
     media_type = models.CharField(max_length=5,choices=MEDIA_TYPE_CHOICES)
     file = models.FileField(upload_to="post_media/")
     created_at = models.DateTimeField(auto_now_add=True)
 
 
     def __str__(self):
+        if self.post_id is None:
+            return f"Unattached {self.media_type}"
         return f"{self.media_type.capitalize()} for {self.post.author.username}'s post"
 
 
 
 
+class UploadSession(models.Model):
+    # a resumable upload: chunks are appended to a temporary file until `received` reaches `size`
+
+    OPEN = 'open'
+    COMPLETE = 'complete'
+
+    STATUS_CHOICES = [
+        (OPEN,'Open'),
+        (COMPLETE,'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True,default=uuid.uuid4,editable=False)
+    user = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10,choices=STATUS_CHOICES,default=OPEN)
+    media = models.OneToOneField(PostMedia,on_delete=models.SET_NULL,null=True,blank=True,related_name='upload')
+    # set while a chunk is being written, see api.uploads.claim_chunk
+    locked_at = models.DateTimeField(null=True,blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.filename} ({self.received}/{self.size})'
+
+
+
+
 
 class Follow(models.Model):
     following = models.ForeignKey(CustomUser,related_name='followers',on_delete=models.CASCADE)
@@ -140,6 +195,10 @@ class Follow(models.Model):
 
     class Meta:
         unique_together = ('follower', 'following')
+        indexes = [
+            models.Index(fields=['following','-created_at','-id'],name='follow_followers_recent_idx'),
+            models.Index(fields=['follower','-created_at','-id'],name='follow_following_recent_idx'),
+        ]
 
     def __str__(self):
         return f'{self.follower} follows {self.following}'
@@ -159,16 +218,26 @@ class PostLike(models.Model):
 
 
 
-class Comment(models.Model):
+class Comment(CounterFieldsMixin,models.Model):
     author = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='comments')
     post = models.ForeignKey(Post,on_delete=models.CASCADE,related_name='comments')
     content = models.TextField(blank=False,null=False)
     parent = models.ForeignKey('self',blank=True,null=True,related_name='replies', on_delete=models.CASCADE)
+    likes_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    counter_fields = ('likes_count',)
+
+    class Meta:
+        indexes = [
+            # top-level comments of a post (parent IS NULL), newest first
+            models.Index(fields=['post','parent','-created_at','-id'],name='comment_post_recent_idx'),
+            # replies of a comment, oldest first
+            models.Index(fields=['parent','created_at','id'],name='comment_replies_idx'),
+        ]
 
 
     def is_top_level(self):
-        return self.parent is None
+        return self.parent_id is None
 
 
 
@@ -1,5 +1,10 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import BasePagination,PageNumberPagination,_positive_int
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import remove_query_param,replace_query_param
+from django.db.models import Q
+from datetime import datetime
+from base64 import urlsafe_b64decode,urlsafe_b64encode
 
 
 
@@ -51,25 +56,193 @@ class UsersPagination(PageNumberPagination):
 
 
 
-class MessagesPagination(PageNumberPagination):
+class MessagesPagination(BasePagination):
+    """
+    Keyset pagination on the per-conversation sequence number of chat messages.
+    Without parameters the latest page is returned; `?before_seq=` scrolls back and
+    `?after_seq=` returns what a reconnecting client missed. Results are always oldest
+    first, and `next` continues in the direction of the request.
+    """
     page_size = 11
     page_size_query_param = 'page_size'
-    max_page_size = 11
+    max_page_size = 100
+    invalid_seq_message = 'Invalid sequence number'
+
+    def get_page_size(self,request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param],strict=True,cutoff=self.max_page_size)
+        except (KeyError,ValueError):
+            return self.page_size
+
+    def get_seq(self,request,name):
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        try:
+            return _positive_int(value)
+        except ValueError:
+            raise NotFound(self.invalid_seq_message)
+
+    def paginate_queryset(self,queryset,request,view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.after_seq = self.get_seq(request,'after_seq')
+        before_seq = self.get_seq(request,'before_seq')
+        if self.after_seq is not None:
+            items = list(queryset.filter(seq__gt=self.after_seq).order_by('seq')[:self.page_size + 1])
+        else:
+            if before_seq is not None:
+                queryset = queryset.filter(seq__lt=before_seq)
+            items = list(queryset.order_by('-seq')[:self.page_size + 1])
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        if self.after_seq is None:
+            items.reverse()
+        self.page = items
+        return items
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(),'after_seq' if self.after_seq is None else 'before_seq')
+        if self.after_seq is None:
+            return replace_query_param(url,'before_seq',self.page[0].seq)
+        return replace_query_param(url,'after_seq',self.page[-1].seq)
+
+    def get_paginated_response(self,data):
+        return Response({
+            'messages_count':self.request.messages_count,
+            'last_seq':self.request.last_seq,
+            'results':data,
+            'next':self.get_next_link(),
+        })
 
 
-    def get_paginated_response(self, data):
+
+
+def keyset_queryset(queryset,position,descending=True,field='created_at'):
+    # rows strictly after `position` in (-field,-id) order, or (field,id) when ascending
+    if not descending:
+        queryset = queryset.order_by(field,'id')
+        if position is None:
+            return queryset
+        value,pk = position
+        return queryset.filter(Q(**{f'{field}__gt':value}) | Q(**{field:value,'id__gt':pk}))
+    queryset = queryset.order_by(f'-{field}','-id')
+    if position is None:
+        return queryset
+    value,pk = position
+    return queryset.filter(Q(**{f'{field}__lt':value}) | Q(**{field:value,'id__lt':pk}))
+
+
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Cursor pagination keyed on (ordering_field, id), newest first unless `descending` is False.
+    The cursor encodes the position of the last item of the previous page, so every page
+    is a plain indexed range query: no OFFSET and no COUNT(*).
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    cursor_query_param = 'cursor'
+    ordering_field = 'created_at'
+    descending = True
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self,request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param],strict=True,cutoff=self.max_page_size)
+        except (KeyError,ValueError):
+            return self.page_size
+
+    def decode_cursor(self,request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            created_at,pk = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            created_at,pk = datetime.fromisoformat(created_at),int(pk)
+        except (TypeError,ValueError,UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        # only positions this class encoded: an aware timestamp and an id that fits a bigint
+        if created_at.tzinfo is None or not 0 <= pk < 2 ** 63:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at,pk
+
+    def encode_cursor(self,position):
+        created_at,pk = position
+        raw = f'{created_at.isoformat()}|{pk}'
+        return urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def paginate_queryset(self,queryset,request,view=None):
+        return self.paginate_with(lambda position,limit: list(keyset_queryset(queryset,position,self.descending,self.ordering_field)[:limit]),request)
+
+    def paginate_with(self,fetch,request):
+        # fetch(position,limit) must return up to `limit` items in cursor order
+        # starting strictly after `position`; one extra item tells us whether a next page exists
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+        items = list(fetch(position,self.page_size + 1))
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        self.next_position = (getattr(items[-1],self.ordering_field),items[-1].id) if self.has_next else None
+        return items
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url,self.cursor_query_param,self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self,data):
         return Response({
-            'messages_count':self.request.messages_count,
-            'results':reversed(data),
-            'count':self.page.paginator.count,
             'next':self.get_next_link(),
-            'previous':self.get_previous_link()
+            'results':data
         })
 
+    def get_paginated_response_schema(self,schema):
+        return {
+            'type':'object',
+            'required':['results'],
+            'properties':{
+                'next':{'type':'string','nullable':True,'format':'uri'},
+                'results':schema,
+            },
+        }
+
+
+
+
+class FeedPagination(KeysetCursorPagination):
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 30
+
+
+
+
+class CommentsPagination(KeysetCursorPagination):
+    page_size = 15
+    page_size_query_param = 'page_size'
+    max_page_size = 30
+
+
+
+
+class RepliesPagination(KeysetCursorPagination):
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 30
+    descending = False
+
 
 
 
-class UserDiscussionPagination(PageNumberPagination):
+class UserDiscussionPagination(KeysetCursorPagination):
     page_size = 15
     page_size_query_param = 'page_size'
-    max_page_size = 15
\ No newline at end of file
+    max_page_size = 30
+    ordering_field = 'last_message_at'
@@ -0,0 +1,196 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from rest_framework.response import Response
+from collections import Counter
+from threading import Lock
+import hashlib
+import uuid
+
+# Cached response data of the anonymous reads, which are the same for every visitor.
+# Each entry carries the version tokens of the tags it was built from: 'post:<id>' for
+# every post it shows, 'user:<id>' for every author card and profile, and one tag per
+# list ('feed', 'user_posts:<id>') for its membership. A write replaces the tokens of
+# the tags it touches, so only the entries built from them miss on their next read.
+# Tokens and entries only need get/set/get_many, which every cache backend supports, but
+# the tokens are bumped by the job worker as well as the web processes, so they have to
+# live in a cache every process reads: a per-process backend is refused at startup.
+
+
+DEFAULTS = {
+    'ENABLED':True,
+    'CACHE_ALIAS':'responses',  # response data: local memory, or a file-based cache shared by the workers of a host
+    'VERSION_ALIAS':'shared',  # tag tokens, shared between processes (Redis, Memcached)
+    'TIMEOUT':300,  # upper bound on staleness when a write bypasses the model signals
+}
+
+
+def response_cache_setting(name):
+    return getattr(settings,'RESPONSE_CACHE',{}).get(name,DEFAULTS[name])
+
+
+
+# backends whose entries only the process that wrote them can read
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def require_shared_cache(alias,setting):
+    backend = settings.CACHES.get(alias,{}).get('BACKEND')
+    if backend in PROCESS_LOCAL_BACKENDS:
+        raise ImproperlyConfigured(
+            f"{setting} is the '{alias}' cache, whose {backend.rsplit('.',1)[-1]} backend is private to each process: "
+            "invalidations from the job worker or another web process would never reach this one."
+        )
+
+
+
+def check_settings():
+    # called from ApiConfig.ready, before any process serves a request or runs a job
+    if response_cache_setting('ENABLED'):
+        require_shared_cache(response_cache_setting('VERSION_ALIAS'),"RESPONSE_CACHE['VERSION_ALIAS']")
+
+
+
+_stats = {}
+_lock = Lock()
+
+
+def count(route,outcome):
+    with _lock:
+        _stats.setdefault(route,Counter())[outcome] += 1
+
+
+
+def hit_rates():
+    with _lock:
+        return {
+            route:{'hits':stats['hit'],'misses':stats['miss'],'hit_rate':round(stats['hit'] / (stats['hit'] + stats['miss']),4)}
+            for route,stats in sorted(_stats.items())
+        }
+
+
+
+def tag_key(tag):
+    return f'response_tag:{tag}'
+
+
+
+def tag_versions(tags,create=False):
+    cache = caches[response_cache_setting('VERSION_ALIAS')]
+    versions = {}
+    found = cache.get_many([tag_key(tag) for tag in tags])
+    for tag in tags:
+        version = found.get(tag_key(tag))
+        if version is None and create:
+            version = uuid.uuid4().hex
+            cache.set(tag_key(tag),version,None)
+        versions[tag] = version
+    return versions
+
+
+
+def invalidate(*tags):
+    cache = caches[response_cache_setting('VERSION_ALIAS')]
+    cache.set_many({tag_key(tag):uuid.uuid4().hex for tag in tags},None)
+
+
+
+def invalidate_on_commit(*tags):
+    # replaced right away, and again after commit so a reader that rendered the old rows
+    # in between does not keep them
+    invalidate(*tags)
+    transaction.on_commit(lambda: invalidate(*tags))
+
+
+
+def response_key(route,request):
+    # links in paginated responses are absolute, so scheme and host are part of the key
+    url = request.build_absolute_uri()
+    return f'response:{route}:{hashlib.md5(url.encode()).hexdigest()}'
+
+
+
+def cached_response(route,request,tags,compute,extra_tags=None):
+    """
+    Response data of `compute()` for an anonymous request, from the cache when none of
+    its tags changed since it was stored. `tags` are known before computing;
+    `extra_tags(data)` returns those found in the result, such as the posts of a page.
+    """
+    if request.user.is_authenticated or not response_cache_setting('ENABLED'):
+        return compute()
+
+    cache = caches[response_cache_setting('CACHE_ALIAS')]
+    key = response_key(route,request)
+    entry = cache.get(key)
+    if entry is not None and tag_versions(entry['versions']) == entry['versions']:
+        count(route,'hit')
+        response = Response(entry['data'],status=entry['status'])
+        response['X-Cache'] = 'HIT'
+        return response
+
+    count(route,'miss')
+    # read before computing, so a write during the computation leaves a stale entry behind
+    versions = tag_versions(tags,create=True)
+    response = compute()
+    if response.status_code == 200:
+        if extra_tags is not None:
+            versions.update(tag_versions(set(extra_tags(response.data)) - set(versions),create=True))
+        cache.set(key,{'versions':versions,'data':response.data,'status':response.status_code},response_cache_setting('TIMEOUT'))
+    response['X-Cache'] = 'MISS'
+    return response
+
+
+
+def profile_tags(profile):
+    return {f"user:{profile['user']['id']}"}
+
+
+
+def comment_tags(comment):
+    tags = profile_tags(comment['author'])
+    for reply in comment.get('replies') or []:
+        tags |= comment_tags(reply)
+    return tags
+
+
+
+def post_tags(posts):
+    # every post and every user whose card appears on a page of posts
+    tags = set()
+    for post in posts:
+        tags.add(f"post:{post['id']}")
+        tags.add(f"user:{post['author']['id']}")
+        for comment in post['comments'] or []:
+            tags |= comment_tags(comment)
+    return tags
+
+
+
+def page_tags(data):
+    return post_tags(data['results'])
+
+
+
+def follower_tags(data):
+    return {f"user:{follow['follower_id']}" for follow in data['results']}
+
+
+
+def clear():
+    caches[response_cache_setting('CACHE_ALIAS')].clear()
+    with _lock:
+        _stats.clear()
+
+
+
+@receiver(setting_changed)
+def reset_response_cache(setting,**kwargs):
+    if setting in ('RESPONSE_CACHE','CACHES'):
+        with _lock:
+            _stats.clear()
@@ -1,8 +1,15 @@
 
 from rest_framework import serializers
-from .models import UserProfile,CustomUser,PostMedia,Post,PostLike,Comment,CommentLike,Follow
+from .models import UserProfile,CustomUser,PostMedia,Post,PostLike,Comment,CommentLike,Follow,UploadSession
 from notifications.models import Notification
-from chat.models import ChatMessage
+from chat.models import ChatMessage,Participant
+from chat.presence import online_many
+from django.db import models
+from .loaders import COMMENTS_PREVIEW_SIZE,load_actor_cards,load_comment_context,load_post_context
+from .avatars import variant_urls
+from .follow_cache import is_following
+from .fragments import fragment_setting,render_posts
+from .uploads import upload_setting
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -13,21 +20,35 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 
+class AvatarVariantsField(serializers.Field):
+    # {"48": {"webp": url, "jpeg": url}, ...}; empty until the avatar pipeline has run
+
+    def __init__(self,**kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self,value):
+        return variant_urls(value,self.context.get('request'))
+
+
+
+
 class UserProfileSerializer(serializers.ModelSerializer):
     followers_count = serializers.SerializerMethodField()
     following_count = serializers.SerializerMethodField()
     is_following = serializers.SerializerMethodField()
+    avatar_variants = AvatarVariantsField()
     user = UserSerializer()
     class Meta:
         model = UserProfile
-        fields = ['id','user','bio','avatar','is_following','followers_count','following_count']
+        fields = ['id','user','bio','avatar','avatar_variants','is_following','followers_count','following_count']
         read_only_fields = ['followers_count','following_count','is_following']
 
     def get_followers_count(self, obj):
-        return obj.user.followers.count()
+        return obj.user.followers_count
     
     def get_following_count(self,obj):
-        return obj.user.following.count()
+        return obj.user.following_count
 
     def update(self, instance, validated_data):
         user_data = validated_data.pop('user', None)
@@ -52,16 +73,14 @@ class UserProfileSerializer(serializers.ModelSerializer):
         return instance
 
     def get_is_following(self,obj):
-        user = self.context.get('user')
-        if user and user.is_authenticated:
-            return Follow.objects.filter(follower=user,following=obj.user).exists()
-        return False
+        return is_following(self.context.get('user'),obj.user_id,self.context)
 
 
 class AuthorProfileSrializer(serializers.ModelSerializer):
+    avatar_variants = AvatarVariantsField()
     class Meta:
         model = UserProfile
-        fields = ['bio','avatar',]
+        fields = ['bio','avatar','avatar_variants']
 
 class AuthorSerializer(serializers.ModelSerializer):
     followers_count = serializers.SerializerMethodField()
@@ -72,10 +91,10 @@ class AuthorSerializer(serializers.ModelSerializer):
         fields = ['id','username','first_name','last_name','email','userprofile','followers_count','following_count']
 
     def get_followers_count(self, obj):
-        return obj.followers.count()
+        return obj.followers_count
     
     def get_following_count(self,obj):
-        return obj.following.count()
+        return obj.following_count
 
 
 
@@ -89,11 +108,55 @@ class PostMediaSerializer(serializers.ModelSerializer):
 
 
 
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    chunk_size = serializers.SerializerMethodField()
+    media = PostMediaSerializer(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ['id','filename','content_type','size','received','chunk_size','status','media','created_at']
+        read_only_fields = ['received','status']
+
+    def get_chunk_size(self,obj):
+        return upload_setting('CHUNK_SIZE')
+
+    def validate_size(self,value):
+        if not 0 < value <= upload_setting('MAX_SIZE'):
+            raise serializers.ValidationError(f"Uploads must be between 1 and {upload_setting('MAX_SIZE')} bytes.")
+        return value
+
+    def validate_content_type(self,value):
+        if not value.startswith(('image/','video/')):
+            raise serializers.ValidationError('Only images and videos can be uploaded.')
+        return value
+
+
+
+class PostListSerializer(serializers.ListSerializer):
+
+    def to_representation(self,data):
+        posts = list(data.all() if isinstance(data,models.manager.BaseManager) else data)
+        if fragment_setting('ENABLED') and not self.context.get('fragment'):
+            return render_posts(posts,self.context,self.render_fragments)
+        # load counts, viewer flags, media and comments for the whole page at once
+        self.context['post_context'] = load_post_context(posts,self.context.get('user'))
+        return super().to_representation(posts)
+
+    def render_fragments(self,posts):
+        # rendered without a viewer, api.fragments overlays the viewer's flags
+        context = {'fragment':True}
+        if 'request' in self.context:
+            context['request'] = self.context['request']
+        return type(self.child)(posts,many=True,context=context).data
+
+
+
 class PostSerializer(serializers.ModelSerializer):
 
     author = AuthorSerializer(read_only=True)
     media = PostMediaSerializer(many=True,read_only=True)
-    likes = serializers.IntegerField(source='likes.count',read_only=True)
+    likes = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
     comments = serializers.SerializerMethodField()
     comments_count = serializers.SerializerMethodField()
@@ -102,25 +165,42 @@ class PostSerializer(serializers.ModelSerializer):
     class Meta:
         model = Post
         fields = ['id','author','content','likes','is_liked','comments','comments_count','is_following','media','is_public','created_at','updated_at']
+        list_serializer_class = PostListSerializer
+
+    def get_likes(self,obj):
+        return obj.likes_count
 
     def get_is_liked(self,obj):
         user = self.context.get('user')
         if user and user.is_authenticated:
+            post_context = self.context.get('post_context')
+            if post_context is not None:
+                return obj.id in post_context['liked_post_ids']
             return obj.likes.filter(user=user).exists()
         return False
 
     def get_comments(self,obj):
-        top_level_comments = Comment.objects.filter(post=obj,parent=None).order_by('-created_at')
+        # a short preview, the full thread is paginated by /api/posts/<id>/comments/
         user =  self.context.get('user')
-        return CommentSerializer(top_level_comments,many=True,context={'user':user}).data
+        post_context = self.context.get('post_context')
+        if post_context is not None:
+            top_level_comments = post_context['comments'].get(obj.id,[])
+            context = {'user':user,'comment_context':post_context['comment_context']}
+        else:
+            top_level_comments = Comment.objects.filter(post=obj,parent=None).select_related('author__userprofile').order_by('-created_at','-id')[:COMMENTS_PREVIEW_SIZE]
+            context = {'user':user,'replies_limit':0}
+        return CommentSerializer(top_level_comments,many=True,context=context).data
 
     def get_comments_count(self,obj):
-        return Comment.objects.filter(post=obj,parent=None).count()
+        return obj.comments_count
 
     def get_is_following(self,obj):
         user = self.context.get('user')
-        if user and user.is_authenticated and user.id != obj.author.id:
-            return Follow.objects.filter(follower=user,following=obj.author).exists()
+        if user and user.is_authenticated and user.id != obj.author_id:
+            post_context = self.context.get('post_context')
+            if post_context is not None:
+                return obj.author_id in post_context['followed_ids']
+            return is_following(user,obj.author_id,self.context)
         return False
 
 
@@ -136,31 +216,57 @@ class PostLikeSerializer(serializers.ModelSerializer):
 
 
 
+class CommentListSerializer(serializers.ListSerializer):
+
+    def to_representation(self,data):
+        # replies, reply counts and viewer likes for the whole list at once
+        comments = list(data.all() if isinstance(data,models.manager.BaseManager) else data)
+        if 'comment_context' not in self.context:
+            self.context['comment_context'] = load_comment_context(comments,self.context.get('user'),self.context.get('replies_limit'))
+        return super().to_representation(comments)
+
+
+
 class CommentSerializer(serializers.ModelSerializer):
 
     replies = serializers.SerializerMethodField()
+    replies_count = serializers.SerializerMethodField()
     author = serializers.SerializerMethodField()
-    likes = serializers.IntegerField(source='likes.count',read_only=True)
+    likes = serializers.IntegerField(source='likes_count',read_only=True)
     is_liked = serializers.SerializerMethodField()
     
 
     class Meta:
         model = Comment
-        fields = ('id','author','post','replies','parent','likes','is_liked','content','created_at')
+        fields = ('id','author','post','replies','replies_count','parent','likes','is_liked','content','created_at')
         read_only_fields = ('post','created_at')
+        list_serializer_class = CommentListSerializer
 
     def get_is_liked(self,obj):
         user = self.context.get('user')
         if user and user.is_authenticated:
+            comment_context = self.context.get('comment_context')
+            if comment_context is not None:
+                return obj.id in comment_context['liked_comment_ids']
             return obj.likes.filter(user=user).exists()
         return False
 
 
     def get_replies(self,obj):
         if obj.is_top_level():
-            return CommentSerializer(obj.replies.all(),many=True).data
+            comment_context = self.context.get('comment_context')
+            replies = comment_context['replies'].get(obj.id,[]) if comment_context is not None else obj.replies.all()
+            return CommentSerializer(replies,many=True,context=self.context).data
         return []
 
+    def get_replies_count(self,obj):
+        if not obj.is_top_level():
+            return 0
+        comment_context = self.context.get('comment_context')
+        if comment_context is not None:
+            return comment_context['replies_counts'].get(obj.id,0)
+        return obj.replies.count()
+
     def get_author(self,obj):
         return UserProfileSerializer(obj.author.userprofile).data
 
@@ -206,25 +312,22 @@ class PublicUserProfileSerializer(serializers.ModelSerializer):
     followers_count = serializers.SerializerMethodField()
     following_count = serializers.SerializerMethodField()
     is_following = serializers.SerializerMethodField()
+    avatar_variants = AvatarVariantsField()
     user = PublicUserSerializer()
     class Meta:
         model = UserProfile
-        fields = ('id','avatar','bio','user','followers_count','following_count','is_following')
+        fields = ('id','avatar','avatar_variants','bio','user','followers_count','following_count','is_following')
 
 
     def get_followers_count(self, obj):
-        return obj.user.followers.count()
+        return obj.user.followers_count
     
     def get_following_count(self,obj):
-        return obj.user.following.count()
+        return obj.user.following_count
 
 
     def get_is_following(self,obj):
-        user = self.context.get('user')
-        print(user)
-        if user and user.is_authenticated:
-            return Follow.objects.filter(follower=user,following=obj.user).exists()
-        return False
+        return is_following(self.context.get('user'),obj.user_id,self.context)
 
 
 
@@ -240,10 +343,7 @@ class FollowersSerializer(serializers.ModelSerializer):
 
     
     def get_is_following(self,obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return Follow.objects.filter(follower=request.user,following=obj.follower).exists()
-        return False
+        return is_following(self.context.get('user'),obj.follower_id,self.context)
 
 
 
@@ -259,11 +359,23 @@ class FollowingListSerializer(serializers.ModelSerializer):
         fields = ('id','username','following_id','avatar','is_following')
 
     def get_is_following(self,obj):
-        user = self.context.get('user')
-        if user and user.is_authenticated:
-            return Follow.objects.filter(follower=user,following=obj.follower).exists()
-        return False
+        return is_following(self.context.get('user'),obj.following_id,self.context)
+
+
+
+
 
+class NotificationsListSerializer(serializers.ListSerializer):
+
+    def to_representation(self,data):
+        # the posts and the recent actors of the whole page are loaded at once
+        notifications = list(data.all() if isinstance(data,models.manager.BaseManager) else data)
+        if 'post_payloads' not in self.context:
+            posts = list({notification.post_id:notification.post for notification in notifications if notification.post_id}.values())
+            self.context['post_payloads'] = {post['id']:post for post in PostSerializer(posts,many=True,context=self.context).data}
+        if 'actor_cards' not in self.context:
+            self.context['actor_cards'] = load_actor_cards([actor for notification in notifications for actor in notification.recent_actors])
+        return super().to_representation(notifications)
 
 
 
@@ -271,12 +383,28 @@ class FollowingListSerializer(serializers.ModelSerializer):
 class NotificationsSerializer(serializers.ModelSerializer):
     
     user = UserSerializer(read_only=True)
-    post = PostSerializer()
+    post = serializers.SerializerMethodField()
     avatar = serializers.CharField(source='user.userprofile.avatar')
+    actors = serializers.SerializerMethodField()
 
     class Meta:
         model = Notification
-        fields = ('id','user','avatar','post','message','is_read','timestamp')
+        fields = ('id','user','avatar','post','verb','message','actor_count','actors','is_read','timestamp')
+        list_serializer_class = NotificationsListSerializer
+
+    def get_post(self,obj):
+        if obj.post_id is None:
+            return None
+        post_payloads = self.context.get('post_payloads')
+        if post_payloads is not None and obj.post_id in post_payloads:
+            return post_payloads[obj.post_id]
+        return PostSerializer(obj.post,context=self.context).data
+
+    def get_actors(self,obj):
+        actor_cards = self.context.get('actor_cards')
+        if actor_cards is None:
+            actor_cards = load_actor_cards(obj.recent_actors)
+        return [actor_cards[actor] for actor in obj.recent_actors if actor in actor_cards]
 
 
 
@@ -291,21 +419,40 @@ class ChatMessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ChatMessage
-        fields = ('id','content','sender','is_read','created_at')
+        fields = ('id','seq','content','sender','is_read','created_at')
 
 
 
 
-class UserDiscussionSerializer(serializers.ModelSerializer):
-    avatar = serializers.CharField(source='userprofile.avatar')
-    unread_count = serializers.SerializerMethodField()
-    class Meta:
-        model = CustomUser
-        fields = ('id','username','avatar','unread_count')
+class UserDiscussionListSerializer(serializers.ListSerializer):
 
+    def to_representation(self,data):
+        # presence of the whole page comes from one cache read
+        if 'online_ids' not in self.context:
+            entries = list(data.all() if isinstance(data,models.manager.BaseManager) else data)
+            self.context['online_ids'] = online_many([entry.partner_id for entry in entries])
+            data = entries
+        return super().to_representation(data)
 
-    def get_unread_count(self,obj):
-        user = self.context.get('user')
-        if user and user.is_authenticated:
-            return ChatMessage.objects.filter(sender=obj,receiver=user,is_read=False).count()
-        return 0
\ No newline at end of file
+
+
+
+class UserDiscussionSerializer(serializers.ModelSerializer):
+    # an inbox entry, shown as the other participant of the conversation
+    id = serializers.IntegerField(source='partner_id')
+    username = serializers.CharField(source='partner.username')
+    avatar = serializers.CharField(source='partner.userprofile.avatar')
+    last_seq = serializers.IntegerField(source='conversation.last_seq')
+    last_message_id = serializers.IntegerField(source='conversation.last_message_id')
+    last_message_preview = serializers.CharField(source='conversation.last_message_preview')
+    is_online = serializers.SerializerMethodField()
+    class Meta:
+        model = Participant
+        fields = ('id','username','avatar','is_online','unread_count','last_seq','last_message_id','last_message_preview','last_message_at')
+        list_serializer_class = UserDiscussionListSerializer
+
+    def get_is_online(self,obj):
+        online_ids = self.context.get('online_ids')
+        if online_ids is None:
+            online_ids = online_many([obj.partner_id])
+        return obj.partner_id in online_ids
\ No newline at end of file
@@ -1,6 +1,9 @@
-from .models import UserProfile,CustomUser
-from django.db.models.signals import post_save
+from .models import UserProfile,CustomUser,Post,PostMedia,PostLike,Comment,CommentLike,Follow
+from django.db.models.signals import post_delete,post_save
 from django.dispatch import receiver
+from .tasks import delete_files
+from .follow_cache import invalidate_on_commit
+from . import response_cache
 
 
 @receiver(post_save,sender=CustomUser)
@@ -16,7 +19,64 @@ def save_user_profile(sender,instance, **kwargs):
 
 
 
+@receiver(post_delete,sender=PostMedia)
+def delete_post_media_file(sender,instance,**kwargs):
+    # also runs for media removed by a post delete cascade
+    if instance.file:
+        delete_files.enqueue([instance.file.name])
 
 
 
+@receiver(post_save,sender=Follow)
+@receiver(post_delete,sender=Follow)
+def invalidate_follow_set(sender,instance,**kwargs):
+    invalidate_on_commit(instance.follower_id)
 
+
+
+
+@receiver(post_save,sender=Post)
+@receiver(post_delete,sender=Post)
+def invalidate_post_responses(sender,instance,created=False,**kwargs):
+    tags = [f'post:{instance.id}',f'user_posts:{instance.author_id}']
+    # an edit may have changed the visibility, a new private post is not in the feed
+    if instance.is_public or not created:
+        tags.append('feed')
+    response_cache.invalidate_on_commit(*tags)
+
+
+
+@receiver(post_save,sender=PostMedia)
+@receiver(post_delete,sender=PostMedia)
+@receiver(post_save,sender=PostLike)
+@receiver(post_delete,sender=PostLike)
+@receiver(post_save,sender=Comment)
+@receiver(post_delete,sender=Comment)
+def invalidate_post_part_responses(sender,instance,**kwargs):
+    if instance.post_id is not None:
+        response_cache.invalidate_on_commit(f'post:{instance.post_id}')
+
+
+
+@receiver(post_save,sender=CommentLike)
+@receiver(post_delete,sender=CommentLike)
+def invalidate_comment_like_responses(sender,instance,**kwargs):
+    post_id = Comment.objects.filter(id=instance.comment_id).values_list('post_id',flat=True).first()
+    if post_id is not None:
+        response_cache.invalidate_on_commit(f'post:{post_id}')
+
+
+
+@receiver(post_save,sender=CustomUser)
+@receiver(post_save,sender=UserProfile)
+@receiver(post_delete,sender=CustomUser)
+def invalidate_user_responses(sender,instance,**kwargs):
+    response_cache.invalidate_on_commit(f'user:{instance.user_id if sender is UserProfile else instance.id}')
+
+
+
+@receiver(post_save,sender=Follow)
+@receiver(post_delete,sender=Follow)
+def invalidate_follow_responses(sender,instance,**kwargs):
+    # both follower counts are on the profile and author cards
+    response_cache.invalidate_on_commit(f'user:{instance.follower_id}',f'user:{instance.following_id}')
@@ -0,0 +1,32 @@
+from django.core.files.storage import default_storage
+from jobs.registry import task
+from .avatars import render_avatar_variants,variant_names
+from .models import UserProfile
+from . import response_cache
+
+
+@task
+def generate_avatar_variants(profile_id,avatar_name):
+    user_id = UserProfile.objects.filter(id=profile_id,avatar=avatar_name).values_list('user_id',flat=True).first()
+    if user_id is None:
+        # the avatar was replaced again before this job ran
+        return
+
+    with default_storage.open(avatar_name,'rb') as avatar_file:
+        variants = render_avatar_variants(avatar_file,avatar_name)
+
+    # Attach the variants to the profile, unless the avatar changed in the meantime
+    if not UserProfile.objects.filter(id=profile_id,avatar=avatar_name).update(avatar_variants=variants):
+        delete_files(variant_names(variants))
+    else:
+        # update() sends no signal, the cached profiles and ETags are dropped here; the
+        # tag lives in the shared VERSION_ALIAS, so the web processes see the bump
+        response_cache.invalidate(f'user:{user_id}')
+
+
+
+@task
+def delete_files(names):
+    for name in names:
+        if name and default_storage.exists(name):
+            default_storage.delete(name)
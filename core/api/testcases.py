@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase,override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from PIL import Image
+from .models import CustomUser
+from . import follow_cache
+import os
+import shutil
+import tempfile
+
+# Base class of the test suites of every app: a throwaway MEDIA_ROOT holding the
+# default avatar, presence in local memory and the shared cache in a directory instead
+# of Redis, and the user and query-count helpers. Every instance of the file-based cache
+# reads the same directory, like separate processes reading Redis.
+
+
+TEST_MEDIA_ROOT = tempfile.mkdtemp(prefix='api-tests-')
+TEST_CACHE_DIR = tempfile.mkdtemp(prefix='api-tests-cache-')
+
+TEST_CACHES = dict(
+    settings.CACHES,
+    presence={'BACKEND':'django.core.cache.backends.locmem.LocMemCache','LOCATION':'presence-tests'},
+    shared={'BACKEND':'django.core.cache.backends.filebased.FileBasedCache','LOCATION':TEST_CACHE_DIR},
+)
+
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT,CACHES=TEST_CACHES)
+class APITestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # profiles are created with the default avatar, which has to exist on disk
+        os.makedirs(os.path.join(TEST_MEDIA_ROOT,'avatars'),exist_ok=True)
+        Image.new('RGB',(8,8)).save(os.path.join(TEST_MEDIA_ROOT,'avatars','user.jpg'))
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEST_MEDIA_ROOT,ignore_errors=True)
+        shutil.rmtree(TEST_CACHE_DIR,ignore_errors=True)
+
+    def setUp(self):
+        # user ids are reused once a test rolls back, cached follow sets and tag versions
+        # must not leak between tests
+        follow_cache.clear()
+        caches['shared'].clear()
+
+    def create_user(self,username):
+        return CustomUser.objects.create_user(
+            username=username,
+            password='password',
+            email=f'{username}@example.com',
+            first_name=username,
+            last_name=username
+        )
+
+    def count_queries(self,url):
+        # every measurement starts from a cold follow-set cache
+        follow_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code,200)
+        return len(queries),response
@@ -1,3 +1,707 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.utils import timezone
+from unittest import skipUnless
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from rest_framework.test import APIClient
+from chat.models import ChatMessage
+from jobs.models import Job
+from jobs.registry import get_task
+from notifications.models import Notification
+from timelines.utils import fanout_post
+from .models import Comment,CommentLike,CustomUser,Follow,Post,PostLike,PostMedia,UploadSession
+from . import etags,follow_cache,response_cache
+from .testcases import APITestCase
+from .uploads import claim_chunk,purge_uploads,release_chunk,temp_path
+from PIL import Image
+from io import BytesIO,StringIO
+from datetime import timedelta
+from threading import Thread
+from uuid import UUID
+import os
+import re
 
 # Create your tests here.
+
+
+def in_other_thread(func,*args):
+    # cache connections are per thread: the call goes through cache instances of its own,
+    # like the job worker or another web process would
+    thread = Thread(target=func,args=args)
+    thread.start()
+    thread.join()
+
+
+
+# "SCAN api_post" reads the whole table, "SCAN api_post USING INDEX ..." walks an index in order
+FULL_SCAN = re.compile(r'^SCAN (\S+)$')
+
+
+
+class PostListQueryCountTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.viewer = self.create_user('viewer')
+        self.followed = self.create_user('followed')
+        self.stranger = self.create_user('stranger')
+        Follow.objects.create(follower=self.viewer,following=self.followed)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+
+    def create_posts(self,count):
+        for i in range(count):
+            author = self.followed if i % 2 else self.stranger
+            post = Post.objects.create(author=author,content=f'post {i}',is_public=author == self.stranger or i % 4 == 3)
+            PostMedia.objects.create(post=post,media_type='image',file='post_media/test.png')
+            PostLike.objects.create(post=post,user=self.viewer)
+            PostLike.objects.create(post=post,user=self.stranger)
+            Post.objects.filter(pk=post.pk).update(likes_count=2)
+            self.create_comment(post)
+            fanout_post(post)
+
+    def create_comment(self,post,replies=1):
+        comment = Comment.objects.create(post=post,author=self.stranger,content='comment')
+        CommentLike.objects.create(comment=comment,user=self.viewer)
+        for i in range(replies):
+            Comment.objects.create(post=post,author=self.followed,parent=comment,content=f'reply {i}')
+        return comment
+
+    def test_feed_query_count_does_not_grow_with_page_size(self):
+        self.create_posts(2)
+        small_page_queries,response = self.count_queries('/api/feed/')
+        self.assertEqual(len(response.data['results']),2)
+
+        self.create_posts(8)
+        full_page_queries,response = self.count_queries('/api/feed/')
+        self.assertEqual(len(response.data['results']),10)
+        self.assertEqual(small_page_queries,full_page_queries)
+
+        post = response.data['results'][0]
+        self.assertEqual(post['likes'],2)
+        self.assertTrue(post['is_liked'])
+        self.assertEqual(len(post['media']),1)
+
+    def test_user_posts_query_count_does_not_grow_with_page_size(self):
+        self.create_posts(4)
+        small_page_queries,response = self.count_queries(f'/api/posts/get/{self.followed.id}/')
+        self.assertEqual(len(response.data['results']),2)
+
+        self.create_posts(16)
+        full_page_queries,response = self.count_queries(f'/api/posts/get/{self.followed.id}/')
+        self.assertEqual(len(response.data['results']),10)
+        self.assertEqual(small_page_queries,full_page_queries)
+        self.assertTrue(all(post['is_following'] for post in response.data['results']))
+
+    def test_comments_query_count_does_not_grow_with_page_size(self):
+        post = Post.objects.create(author=self.stranger,content='post',is_public=True)
+        for i in range(2):
+            self.create_comment(post,replies=5)
+        small_page_queries,response = self.count_queries(f'/api/posts/{post.id}/comments/')
+        self.assertEqual(len(response.data['results']),2)
+
+        for i in range(13):
+            self.create_comment(post,replies=5)
+        full_page_queries,response = self.count_queries(f'/api/posts/{post.id}/comments/')
+        self.assertEqual(len(response.data['results']),15)
+        self.assertEqual(small_page_queries,full_page_queries)
+
+        comment = response.data['results'][0]
+        self.assertTrue(comment['is_liked'])
+        self.assertEqual(comment['replies_count'],5)
+        self.assertEqual(len(comment['replies']),3)
+
+    def test_followers_query_count_does_not_grow_with_page_size(self):
+        for i in range(2):
+            Follow.objects.create(follower=self.create_user(f'follower{i}'),following=self.stranger)
+        small_page_queries,response = self.count_queries(f'/api/followers/{self.stranger.id}/')
+        self.assertEqual(len(response.data['results']),2)
+
+        for i in range(2,10):
+            Follow.objects.create(follower=self.create_user(f'follower{i}'),following=self.stranger)
+        Follow.objects.create(follower=self.viewer,following=self.stranger)
+        full_page_queries,response = self.count_queries(f'/api/followers/{self.stranger.id}/')
+        self.assertEqual(small_page_queries,full_page_queries)
+
+        following = {row['username']:row['is_following'] for row in response.data['results']}
+        self.assertFalse(following['follower9'])
+        self.assertFalse(following['viewer'])
+        Follow.objects.create(follower=self.viewer,following=CustomUser.objects.get(username='follower9'))
+        response = self.client.get(f'/api/followers/{self.stranger.id}/')
+        self.assertTrue({row['username']:row['is_following'] for row in response.data['results']}['follower9'])
+
+
+
+
+@override_settings(CHANNEL_LAYERS={'default':{'BACKEND':'channels.layers.InMemoryChannelLayer'}})
+class CounterTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = self.create_user('author')
+        self.reader = self.create_user('reader')
+        self.post = Post.objects.create(author=self.author,content='post',is_public=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.reader)
+
+    def counts(self,model,pk,*fields):
+        return model.objects.filter(pk=pk).values_list(*fields).get()
+
+    def test_like_and_unlike(self):
+        self.assertEqual(self.client.post('/api/post/like/',{'post_id':self.post.id}).status_code,201)
+        self.assertEqual(self.client.post('/api/post/like/',{'post_id':self.post.id}).status_code,400)
+        self.assertEqual(self.counts(Post,self.post.id,'likes_count'),(1,))
+        self.client.delete('/api/post/unlike/',{'post_id':self.post.id},format='json')
+        self.client.delete('/api/post/unlike/',{'post_id':self.post.id},format='json')
+        self.assertEqual(self.counts(Post,self.post.id,'likes_count'),(0,))
+
+    def test_follow_and_unfollow(self):
+        self.assertEqual(self.client.post('/api/follow/',{'user_id':self.author.id}).status_code,201)
+        self.assertEqual(self.counts(CustomUser,self.author.id,'followers_count','following_count'),(1,0))
+        self.assertEqual(self.counts(CustomUser,self.reader.id,'followers_count','following_count'),(0,1))
+        self.client.delete('/api/unfollow/',{'user_id':self.author.id},format='json')
+        self.assertEqual(self.counts(CustomUser,self.author.id,'followers_count'),(0,))
+        self.assertEqual(self.counts(CustomUser,self.reader.id,'following_count'),(0,))
+
+    def test_comment_and_delete(self):
+        self.client.post('/api/comments/create/',{'post_id':self.post.id,'content':'comment'})
+        comment = Comment.objects.get(post=self.post)
+        # replies are not counted on the post
+        self.client.post('/api/comments/create/',{'post_id':self.post.id,'parent_id':comment.id,'content':'reply'})
+        self.assertEqual(self.counts(Post,self.post.id,'comments_count'),(1,))
+        self.client.post('/api/comment/like/',{'comment_id':comment.id})
+        self.assertEqual(self.counts(Comment,comment.id,'likes_count'),(1,))
+        self.client.delete('/api/comments/delete/',{'post_id':self.post.id,'comment_id':comment.id},format='json')
+        self.assertEqual(self.counts(Post,self.post.id,'comments_count'),(0,))
+
+    def test_save_does_not_overwrite_counters(self):
+        post = Post.objects.get(id=self.post.id)
+        author = CustomUser.objects.get(id=self.author.id)
+        self.client.post('/api/post/like/',{'post_id':self.post.id})
+        self.client.post('/api/follow/',{'user_id':self.author.id})
+        post.content = 'edited'
+        post.save()
+        author.first_name = 'edited'
+        author.save()
+        self.assertEqual(self.counts(Post,self.post.id,'content','likes_count'),('edited',1))
+        self.assertEqual(self.counts(CustomUser,self.author.id,'first_name','followers_count'),('edited',1))
+
+    def test_reconcile_counters(self):
+        PostLike.objects.create(post=self.post,user=self.reader)
+        Comment.objects.create(post=self.post,author=self.reader,content='comment')
+        Follow.objects.create(follower=self.reader,following=self.author)
+        Post.objects.filter(id=self.post.id).update(comments_count=5)
+        out = StringIO()
+        call_command('reconcile_counters',stdout=out)
+        self.assertIn('Post: checked 1 rows, fixed 2 counters',out.getvalue())
+        self.assertIn('CustomUser: checked 2 rows, fixed 2 counters',out.getvalue())
+        self.assertEqual(self.counts(Post,self.post.id,'likes_count','comments_count'),(1,1))
+        self.assertEqual(self.counts(CustomUser,self.author.id,'followers_count'),(1,))
+        self.assertEqual(self.counts(CustomUser,self.reader.id,'following_count'),(1,))
+
+
+
+
+@override_settings(UPLOADS={'CHUNK_SIZE':4,'MAX_SIZE':100,'EXPIRE_AFTER':3600,'LOCK_TIMEOUT':60})
+class UploadTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner = self.create_user('owner')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.post('/api/uploads/',{'filename':'clip.mp4','content_type':'video/mp4','size':10})
+        self.assertEqual(response.status_code,201)
+        self.url = f"/api/uploads/{response.data['id']}/"
+        self.session = UploadSession.objects.get(id=response.data['id'])
+
+    def put(self,offset,data,client=None,url=None):
+        return (client or self.client).put(f'{url or self.url}?offset={offset}',data,content_type='application/octet-stream')
+
+    def test_offsets_resume_and_finalize(self):
+        self.assertEqual(self.put(0,b'0123').data,{'received':4})
+        # a retried or out of order chunk is refused with the offset to resume from
+        for offset in (0,8):
+            response = self.put(offset,b'4567')
+            self.assertEqual(response.status_code,409)
+            self.assertEqual(response.data['received'],4)
+        self.assertEqual(self.put(4,b'45').status_code,400)
+        self.assertEqual(self.client.post(f'{self.url}complete/').status_code,400)
+
+        # an interrupted client asks where to resume
+        self.assertEqual(self.client.get(self.url).data['received'],4)
+        self.assertEqual(self.put(4,b'4567').data,{'received':8})
+        self.assertEqual(self.put(8,b'89').data,{'received':10})
+        response = self.client.post(f'{self.url}complete/')
+        self.assertEqual(response.status_code,201)
+        self.assertEqual(response.data['status'],UploadSession.COMPLETE)
+        media = PostMedia.objects.get(id=response.data['media']['id'])
+        with media.file.open('rb') as file:
+            self.assertEqual(file.read(),b'0123456789')
+        self.assertEqual(self.client.post(f'{self.url}complete/').status_code,200)
+        self.assertEqual(self.put(10,b'x').status_code,409)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/posts/create/',{'content':'post','upload_ids':[str(self.session.id)]})
+        self.assertEqual(response.status_code,201)
+        self.assertEqual(PostMedia.objects.get(id=media.id).post_id,response.data['id'])
+        # an upload is attached to one post only
+        response = self.client.post('/api/posts/create/',{'content':'again','upload_ids':[str(self.session.id)]})
+        self.assertEqual(response.status_code,400)
+
+    def test_one_writer_per_offset(self):
+        # a PUT still writing the chunk holds the session
+        claim = claim_chunk(self.session,0)
+        self.assertIsNotNone(claim)
+        self.assertIsNone(claim_chunk(self.session,0))
+        self.assertEqual(self.put(0,b'0123').status_code,409)
+
+        # until its claim times out
+        UploadSession.objects.filter(id=self.session.id).update(locked_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(self.put(0,b'0123').data,{'received':4})
+        self.assertFalse(release_chunk(self.session,claim,received=4))
+        self.assertEqual(self.client.get(self.url).data['received'],4)
+
+    def test_sessions_are_private(self):
+        other = APIClient()
+        other.force_authenticate(user=self.create_user('other'))
+        self.assertEqual(other.get(self.url).status_code,404)
+        self.assertEqual(self.put(0,b'0123',client=other).status_code,404)
+        self.assertEqual(other.post(f'{self.url}complete/').status_code,404)
+        self.assertEqual(other.delete(self.url).status_code,404)
+
+        for offset,chunk in ((0,b'0123'),(4,b'4567'),(8,b'89')):
+            self.put(offset,chunk)
+        self.client.post(f'{self.url}complete/')
+        response = other.post('/api/posts/create/',{'content':'post','upload_ids':[str(self.session.id)]})
+        self.assertEqual(response.status_code,400)
+        self.assertFalse(Post.objects.exists())
+
+    def test_purge_expired_uploads(self):
+        self.put(0,b'0123')
+        part = temp_path(self.session)
+        self.assertTrue(os.path.exists(part))
+        # finalized but never attached to a post
+        finished = self.client.post('/api/uploads/',{'filename':'a.png','content_type':'image/png','size':2}).data['id']
+        self.put(0,b'ab',url=f'/api/uploads/{finished}/')
+        media = PostMedia.objects.get(id=self.client.post(f'/api/uploads/{finished}/complete/').data['media']['id'])
+        fresh = self.client.post('/api/uploads/',{'filename':'b.png','content_type':'image/png','size':2}).data['id']
+
+        expired = timezone.now() - timedelta(seconds=3601)
+        UploadSession.objects.exclude(id=fresh).update(created_at=expired)
+        PostMedia.objects.filter(id=media.id).update(created_at=expired)
+        purge_uploads()
+        self.assertEqual(set(UploadSession.objects.values_list('id',flat=True)),{UUID(finished),UUID(fresh)})
+        self.assertFalse(os.path.exists(part))
+        self.assertFalse(PostMedia.objects.filter(id=media.id).exists())
+        # its file is deleted on the job worker
+        self.assertTrue(Job.objects.filter(name='api.tasks.delete_files',args=[[media.file.name]]).exists())
+
+
+
+
+class FeedPaginationTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        response_cache.clear()
+        self.author = self.create_user('author')
+        now = timezone.now()
+        # three posts share one timestamp and two another, only the id breaks those ties
+        offsets = [0,0,0,1,1,2,3]
+        self.posts = [Post.objects.create(author=self.author,content=f'post {i}',is_public=True) for i in range(len(offsets))]
+        for post,offset in zip(self.posts,offsets):
+            Post.objects.filter(id=post.id).update(created_at=now - timedelta(minutes=offset))
+        Post.objects.create(author=self.author,content='private',is_public=False)
+        self.client = APIClient()
+
+    def walk(self,url):
+        ids,pages = [],0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code,200)
+            ids += [post['id'] for post in response.data['results']]
+            url = response.data['next']
+            pages += 1
+            self.assertLess(pages,20)
+        return ids
+
+    def test_next_links_visit_every_post_once(self):
+        expected = list(Post.objects.filter(is_public=True).order_by('-created_at','-id').values_list('id',flat=True))
+        self.assertEqual(len(expected),7)
+        for page_size in (1,2,3,10):
+            self.assertEqual(self.walk(f'/api/feed/?page_size={page_size}'),expected)
+
+    def test_malformed_cursor_is_not_found(self):
+        cursors = [
+            'not-base64!',
+            'bm90IGEgY3Vyc29y',  # 'not a cursor'
+            'eHx5',  # 'x|y'
+            'MjAyNi0xMC0xOFQwMDowMDowMCswMDowMHwxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1',  # id past 64 bits
+            'MjAyNi0xMC0xOFQwMDowMDowMHwx',  # naive timestamp
+            '%C3%A9',
+        ]
+        for cursor in cursors:
+            self.assertEqual(self.client.get(f'/api/feed/?cursor={cursor}').status_code,404,cursor)
+
+
+
+
+class FollowCacheTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.viewer = self.create_user('viewer')
+        self.author = self.create_user('author')
+
+    def test_follow_from_another_process(self):
+        self.assertNotIn(self.author.id,follow_cache.get_follow_set(self.viewer.id))
+        # another process records the follow and replaces the shared token: this one keeps
+        # its set in memory, but drops it on the next lookup
+        Follow.objects.bulk_create([Follow(follower=self.viewer,following=self.author)])
+        self.assertNotIn(self.author.id,follow_cache.get_follow_set(self.viewer.id))
+        caches.create_connection('shared').delete(follow_cache.version_key(self.viewer.id))
+        self.assertIn(self.author.id,follow_cache.get_follow_set(self.viewer.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(follow_cache.is_following(self.viewer,self.author.id))
+
+    def test_process_local_version_cache_is_refused(self):
+        local = dict(settings.CACHES,shared={'BACKEND':'django.core.cache.backends.locmem.LocMemCache'})
+        with self.settings(CACHES=local):
+            with self.assertRaisesMessage(ImproperlyConfigured,"FOLLOW_CACHE['CACHE_ALIAS'] is the 'shared' cache"):
+                follow_cache.check_settings()
+        follow_cache.check_settings()
+
+
+
+
+class ResponseCacheTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        response_cache.clear()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.alice_post = Post.objects.create(author=self.alice,content='alice',is_public=True)
+        Post.objects.create(author=self.bob,content='bob',is_public=True)
+        self.anonymous = APIClient()
+
+    def cache_status(self,url):
+        response = self.anonymous.get(url)
+        self.assertEqual(response.status_code,200)
+        return response['X-Cache']
+
+    def test_targeted_invalidation(self):
+        feed,bob_posts,bob_profile = '/api/feed/',f'/api/posts/get/{self.bob.id}/',f'/api/get/public_profile/{self.bob.id}/'
+        for url in (feed,bob_posts,bob_profile):
+            self.assertEqual(self.cache_status(url),'MISS')
+            self.assertEqual(self.cache_status(url),'HIT')
+
+        # a like only reaches the entries showing the liked post
+        client = APIClient()
+        client.force_authenticate(user=self.alice)
+        self.assertEqual(client.post('/api/post/like/',{'post_id':self.alice_post.id}).status_code,201)
+        self.assertEqual(self.cache_status(feed),'MISS')
+        self.assertEqual(self.anonymous.get(feed).data['results'][1]['likes'],1)
+        self.assertEqual(self.cache_status(bob_posts),'HIT')
+        self.assertEqual(self.cache_status(bob_profile),'HIT')
+
+        # a follow changes the follower counts on bob's cards
+        Follow.objects.create(follower=self.alice,following=self.bob)
+        self.assertEqual(self.cache_status(bob_profile),'MISS')
+        self.assertEqual(self.cache_status(bob_posts),'MISS')
+        self.assertEqual(self.cache_status(feed),'MISS')
+
+        # readers that are signed in are never served from the cache
+        self.assertNotIn('X-Cache',client.get(feed))
+
+        self.assertEqual(client.get('/api/metrics/response_cache/').status_code,403)
+        CustomUser.objects.filter(id=self.alice.id).update(is_staff=True)
+        self.alice.is_staff = True
+        routes = client.get('/api/metrics/response_cache/').data['routes']
+        self.assertEqual(routes['feed'],{'hits':2,'misses':3,'hit_rate':0.4})
+
+    def test_invalidation_from_another_cache_instance(self):
+        url = f'/api/posts/get/{self.bob.id}/'
+        self.assertEqual(self.cache_status(url),'MISS')
+        self.assertEqual(self.cache_status(url),'HIT')
+        versions = response_cache.tag_versions([f'user:{self.bob.id}'])
+        in_other_thread(response_cache.invalidate,f'user:{self.bob.id}')
+        self.assertNotEqual(caches.create_connection('shared').get(response_cache.tag_key(f'user:{self.bob.id}')),versions[f'user:{self.bob.id}'])
+        self.assertEqual(self.cache_status(url),'MISS')
+
+    def test_process_local_version_cache_is_refused(self):
+        local = dict(settings.CACHES,shared={'BACKEND':'django.core.cache.backends.locmem.LocMemCache'})
+        with self.settings(CACHES=local):
+            with self.assertRaisesMessage(ImproperlyConfigured,"RESPONSE_CACHE['VERSION_ALIAS'] is the 'shared' cache"):
+                response_cache.check_settings()
+            with self.settings(RESPONSE_CACHE={'ENABLED':False}):
+                response_cache.check_settings()
+        response_cache.check_settings()
+
+
+
+
+class ConditionalGetTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        response_cache.clear()
+        self.viewer = self.create_user('viewer')
+        self.author = self.create_user('author')
+        self.post = Post.objects.create(author=self.author,content='post',is_public=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+
+    def revalidate(self,url,etag):
+        return self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+
+    def test_not_modified_until_a_tag_changes(self):
+        urls = ['/api/get/profile/',f'/api/get/public_profile/{self.author.id}/',f'/api/posts/get/{self.author.id}/',f'/api/followers/{self.author.id}/']
+        etags = {}
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code,200)
+            etags[url] = response['ETag']
+            # answered from the cache alone
+            with self.assertNumQueries(0):
+                response = self.revalidate(url,etags[url])
+            self.assertEqual(response.status_code,304)
+            self.assertEqual(response['ETag'],etags[url])
+
+        # the viewer's like changes is_liked and the count of that post only
+        self.client.post('/api/post/like/',{'post_id':self.post.id})
+        self.assertEqual(self.revalidate(urls[2],etags[urls[2]]).status_code,200)
+        self.assertEqual(self.revalidate(urls[1],etags[urls[1]]).status_code,304)
+
+        # following the author changes both profiles and the follower list
+        Follow.objects.create(follower=self.viewer,following=self.author)
+        for url in urls:
+            response = self.revalidate(url,etags[url])
+            self.assertEqual(response.status_code,200)
+            self.assertNotEqual(response['ETag'],etags[url])
+
+        # the ETag is per viewer
+        other = APIClient()
+        other.force_authenticate(user=self.author)
+        self.assertEqual(other.get(urls[1],HTTP_IF_NONE_MATCH=self.client.get(urls[1])['ETag']).status_code,200)
+
+    def test_etags_are_shared_between_cache_instances(self):
+        url = f'/api/get/public_profile/{self.author.id}/'
+        etag = self.client.get(url)['ETag']
+        # issued by this process, readable by any other
+        self.assertIsNotNone(caches.create_connection('shared').get(etags.etag_key(etag.strip('"'))))
+        self.assertEqual(self.revalidate(url,etag).status_code,304)
+        # a change made elsewhere, such as by the job worker, is seen on the next revalidation
+        in_other_thread(response_cache.invalidate,f'user:{self.author.id}')
+        self.assertEqual(self.revalidate(url,etag).status_code,200)
+
+    def test_process_local_etag_cache_is_refused(self):
+        local = dict(settings.CACHES,shared={'BACKEND':'django.core.cache.backends.locmem.LocMemCache'})
+        with self.settings(CACHES=local,RESPONSE_CACHE={'ENABLED':False}):
+            with self.assertRaises(ImproperlyConfigured):
+                etags.check_settings()
+            with self.settings(ETAGS={'ENABLED':False}):
+                etags.check_settings()
+
+    def test_avatar_variants_reach_the_profile(self):
+        image = BytesIO()
+        Image.new('RGB',(120,120),'red').save(image,format='JPEG')
+        avatar = SimpleUploadedFile('avatar.jpg',image.getvalue(),content_type='image/jpeg')
+        self.assertEqual(self.client.put('/api/update/profile/pic/',{'avatar':avatar},format='multipart').status_code,200)
+        response = self.client.get('/api/get/profile/')
+        self.assertEqual(response.data['avatar_variants'],{})
+
+        # the job worker bumps the user tag through cache connections of its own
+        job = Job.objects.get(name='api.tasks.generate_avatar_variants')
+        web_cache = caches['shared']
+        caches['shared'] = caches.create_connection('shared')
+        try:
+            get_task(job.name)(*job.args,**job.kwargs)
+        finally:
+            caches['shared'] = web_cache
+        response = self.revalidate('/api/get/profile/',response['ETag'])
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(sorted(response.data['avatar_variants'],key=int),['48','96','400'])
+
+
+
+
+
+class PostFragmentTests(APITestCase):
+    create_posts = PostListQueryCountTests.create_posts
+    create_comment = PostListQueryCountTests.create_comment
+
+    def setUp(self):
+        super().setUp()
+        response_cache.clear()
+        self.viewer = self.create_user('viewer')
+        self.followed = self.create_user('followed')
+        self.stranger = self.create_user('stranger')
+        Follow.objects.create(follower=self.viewer,following=self.followed)
+        self.client = APIClient()
+        self.create_posts(6)
+        for post in Post.objects.all():
+            Notification.objects.create(user=self.stranger,target_user=self.followed,post=post,verb=Notification.POST_LIKE,message='liked your post')
+
+    def render(self,url,user):
+        self.client.force_authenticate(user=user)
+        return self.count_queries(url)
+
+    def test_fragments_match_direct_rendering(self):
+        urls = ['/api/feed/',f'/api/posts/get/{self.followed.id}/',f'/api/notifications/get/{self.followed.id}/']
+        for user in (self.viewer,self.stranger,self.followed):
+            for url in urls:
+                with self.settings(POST_FRAGMENTS={'ENABLED':False}):
+                    direct_queries,direct = self.render(url,user)
+                cold_queries,cold = self.render(url,user)
+                warm_queries,warm = self.render(url,user)
+                self.assertEqual(cold.data['results'],direct.data['results'])
+                self.assertEqual(warm.data['results'],direct.data['results'])
+                self.assertLess(warm_queries,direct_queries)
+
+        # a new comment reaches the posts it was made on
+        post = Post.objects.filter(author=self.stranger).latest('id')
+        self.create_comment(post)
+        results = self.render('/api/feed/',self.viewer)[1].data['results']
+        self.assertEqual(len(next(row for row in results if row['id'] == post.id)['comments']),2)
+
+
+
+
+class DeltaResponseTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = self.create_user('author')
+        self.other = self.create_user('other')
+        self.post = Post.objects.create(author=self.author,content='post',is_public=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.author)
+
+    def test_deletes_return_a_patch(self):
+        kept = Post.objects.create(author=self.author,content='kept',is_public=True)
+        response = self.client.delete('/api/posts/delete/',{'post_id':self.post.id},format='json')
+        self.assertEqual(response.data,{'op':'delete','type':'post','id':self.post.id})
+        dropped = Post.objects.create(author=self.author,content='dropped',is_public=True)
+        response = self.client.delete('/api/posts/delete/?legacy=1',{'post_id':dropped.id},format='json')
+        self.assertEqual([post['id'] for post in response.data],[kept.id])
+
+        comment = Comment.objects.create(post=kept,author=self.other,content='comment')
+        replies = [Comment.objects.create(post=kept,author=self.author,parent=comment,content=f'reply {i}') for i in range(2)]
+        response = self.client.delete('/api/reply/delete/',{'post_id':kept.id,'parent_id':comment.id,'reply_id':replies[1].id},format='json')
+        self.assertEqual(response.data,{'op':'delete','type':'reply','id':replies[1].id,'post_id':kept.id,'parent_id':comment.id,'replies_count':1})
+        self.assertTrue(Comment.objects.filter(id=replies[0].id).exists())
+
+        self.assertEqual(self.client.post('/api/follow/',{'user_id':self.other.id}).status_code,201)
+        response = self.client.delete('/api/unfollow/',{'user_id':self.other.id},format='json')
+        self.assertEqual(response.data['followers_count'],0)
+        self.assertFalse(response.data['is_following'])
+
+    def test_updates_return_the_changed_comment(self):
+        comment = Comment.objects.create(post=self.post,author=self.author,content='comment')
+        Comment.objects.create(post=self.post,author=self.other,content='other')
+        Comment.objects.create(post=self.post,author=self.other,parent=comment,content='reply')
+        response = self.client.put('/api/comments/update/',{'comment_id':comment.id,'post_id':self.post.id,'content':'edited'},format='json')
+        self.assertEqual(response.data['id'],comment.id)
+        self.assertEqual(response.data['content'],'edited')
+        self.assertEqual(response.data['replies_count'],1)
+
+        response = self.client.put('/api/comments/update/?legacy=1',{'comment_id':comment.id,'post_id':self.post.id,'content':'again'},format='json')
+        self.assertEqual(len(response.data),2)
+
+
+
+
+@skipUnless(connection.vendor == 'sqlite','EXPLAIN QUERY PLAN output is SQLite specific')
+class QueryPlanTests(APITestCase):
+    # Every statement a hot endpoint runs is explained; a plan step that reads a whole
+    # table ("SCAN <table>" without an index) fails the test.
+
+    def setUp(self):
+        super().setUp()
+        self.viewer = self.create_user('viewer')
+        self.author = self.create_user('author')
+        Follow.objects.create(follower=self.viewer,following=self.author)
+        Follow.objects.create(follower=self.author,following=self.viewer)
+        self.post = Post.objects.create(author=self.author,content='post',is_public=False)
+        PostMedia.objects.create(post=self.post,media_type='image',file='post_media/test.png')
+        PostLike.objects.create(post=self.post,user=self.viewer)
+        self.comment = Comment.objects.create(post=self.post,author=self.viewer,content='comment')
+        Comment.objects.create(post=self.post,author=self.author,parent=self.comment,content='reply')
+        CommentLike.objects.create(comment=self.comment,user=self.author)
+        fanout_post(self.post)
+        Notification.objects.create(user=self.author,target_user=self.viewer,post=self.post,message='new post')
+        ChatMessage.objects.create(sender=self.author,receiver=self.viewer,content='hello')
+        ChatMessage.objects.create(sender=self.viewer,receiver=self.author,content='hi')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+
+    def full_scans(self,method,url):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client,method)(url)
+        self.assertLess(response.status_code,400,url)
+        scans = []
+        tables = set(connection.introspection.table_names())
+        with connection.cursor() as cursor:
+            for query in queries.captured_queries:
+                sql = query['sql']
+                if not sql.startswith(('SELECT','UPDATE','DELETE')):
+                    continue
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    match = FULL_SCAN.match(detail)
+                    # scans of subqueries and window wrappers only read rows already selected by index
+                    if match and match.group(1) in tables:
+                        scans.append(f'{detail}\n    in: {sql}')
+        return scans
+
+    def assertNoFullScans(self,url,method='get'):
+        scans = self.full_scans(method,url)
+        self.assertFalse(scans,f'{url} reads whole tables:\n' + '\n'.join(scans))
+
+    def test_feed(self):
+        self.assertNoFullScans('/api/feed/')
+
+    def test_anonymous_feed(self):
+        self.client.force_authenticate(user=None)
+        self.assertNoFullScans('/api/feed/')
+
+    def test_user_posts(self):
+        self.assertNoFullScans(f'/api/posts/get/{self.author.id}/')
+
+    def test_post_comments(self):
+        self.assertNoFullScans(f'/api/posts/{self.post.id}/comments/')
+
+    def test_comment_replies(self):
+        self.assertNoFullScans(f'/api/comments/{self.comment.id}/replies/')
+
+    def test_public_profile(self):
+        self.assertNoFullScans(f'/api/get/public_profile/{self.author.id}/')
+
+    def test_followers(self):
+        self.assertNoFullScans(f'/api/followers/{self.author.id}/')
+
+    def test_following(self):
+        self.assertNoFullScans(f'/api/following/{self.author.id}/')
+
+    def test_notifications(self):
+        self.assertNoFullScans(f'/api/notifications/get/{self.viewer.id}/')
+
+    def test_notifications_seen(self):
+        self.assertNoFullScans('/api/notifications/seen/')
+
+    def test_discussion(self):
+        self.assertNoFullScans(f'/api/discussions/{self.author.id}/')
+
+    def test_discussion_seen(self):
+        self.assertNoFullScans(f'/api/discussions/seen/{self.author.id}/')
+
+    def test_discussions_list(self):
+        self.assertNoFullScans('/api/discussions/list/')
@@ -0,0 +1,131 @@
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from datetime import timedelta
+from django.utils import timezone
+from jobs.registry import task
+from rest_framework.exceptions import ValidationError
+from .models import PostMedia,UploadSession
+import os
+import uuid
+
+
+DEFAULTS = {
+    'CHUNK_SIZE':4 * 1024 * 1024,  # every chunk but the last must be exactly this long
+    'MAX_SIZE':512 * 1024 * 1024,
+    'TEMP_DIR':None,  # defaults to MEDIA_ROOT/uploads
+    'EXPIRE_AFTER':86400,  # open sessions and unattached media are purged after this many seconds
+    'LOCK_TIMEOUT':300,  # a chunk write holding the session longer is considered abandoned
+}
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def upload_setting(name):
+    return getattr(settings,'UPLOADS',{}).get(name,DEFAULTS[name])
+
+
+
+def temp_path(session):
+    temp_dir = upload_setting('TEMP_DIR') or os.path.join(settings.MEDIA_ROOT,'uploads')
+    os.makedirs(temp_dir,exist_ok=True)
+    return os.path.join(temp_dir,f'{session.pk}.part')
+
+
+
+def expected_chunk_length(session,offset):
+    return min(upload_setting('CHUNK_SIZE'),session.size - offset)
+
+
+
+def claim_chunk(session,offset):
+    # one writer per session: the claim is a conditional UPDATE on the expected offset, so
+    # of two PUTs racing for the same offset only one gets to write the file
+    now = timezone.now()
+    stale = now - timedelta(seconds=upload_setting('LOCK_TIMEOUT'))
+    claimed = UploadSession.objects.filter(id=session.id,status=UploadSession.OPEN,received=offset).filter(
+        Q(locked_at__isnull=True) | Q(locked_at__lt=stale)
+    ).update(locked_at=now)
+    return now if claimed else None
+
+
+
+def release_chunk(session,claim,received=None):
+    # returns False when the claim timed out and was taken over by another writer
+    changes = {'locked_at':None}
+    if received is not None:
+        changes['received'] = received
+    return bool(UploadSession.objects.filter(id=session.id,locked_at=claim).update(**changes))
+
+
+
+def write_chunk(session,offset,stream,length):
+    # copies the request body to the temporary file in small buffers, never holding the whole chunk
+    path = temp_path(session)
+    written = 0
+    with open(path,'r+b' if os.path.exists(path) else 'wb') as part:
+        part.seek(offset)
+        while written < length:
+            data = stream.read(min(COPY_BUFFER_SIZE,length - written))
+            if not data:
+                break
+            part.write(data)
+            written += len(data)
+    return written
+
+
+
+class TemporaryUpload(File):
+    # FileSystemStorage moves files that expose temporary_file_path() instead of copying them
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+
+def finalize(session):
+    media_type = 'image' if session.content_type.startswith('image') else 'video'
+    with open(temp_path(session),'rb') as part:
+        with transaction.atomic():
+            media = PostMedia(media_type=media_type)
+            media.file.save(session.filename,TemporaryUpload(part,name=session.filename),save=False)
+            media.save()
+            session.status = UploadSession.COMPLETE
+            session.media = media
+            session.save(update_fields=['status','media'])
+    return media
+
+
+
+def discard(session):
+    path = temp_path(session)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+
+def attach_uploads(post,user,upload_ids):
+    # media of finalized sessions owned by `user` that no post has claimed yet
+    try:
+        upload_ids = {uuid.UUID(str(upload_id)) for upload_id in upload_ids}
+    except ValueError:
+        raise ValidationError({'upload_ids':'Invalid upload id.'})
+    media_ids = UploadSession.objects.filter(
+        id__in=upload_ids,user=user,status=UploadSession.COMPLETE,media__post__isnull=True
+    ).values_list('media_id',flat=True)
+    attached = PostMedia.objects.filter(id__in=list(media_ids),post__isnull=True).update(post=post)
+    if attached != len(upload_ids):
+        raise ValidationError({'upload_ids':'Unknown, unfinished or already used upload.'})
+
+
+
+@task
+def purge_uploads():
+    cutoff = timezone.now() - timedelta(seconds=upload_setting('EXPIRE_AFTER'))
+    for session in UploadSession.objects.filter(status=UploadSession.OPEN,created_at__lt=cutoff).iterator():
+        discard(session)
+        session.delete()
+    # the file of each deleted PostMedia goes away through api.signals
+    for media in PostMedia.objects.filter(post__isnull=True,created_at__lt=cutoff).iterator():
+        media.delete()
@@ -37,11 +37,18 @@ urlpatterns = [
     #delete media
     path('media/delete/',DeletePostMediaView.as_view() ),
 
+    #Chunked, resumable media uploads
+    path('uploads/',CreateUploadSessionView.as_view() ),
+    path('uploads/<uuid:upload_id>/',UploadSessionView.as_view() ),
+    path('uploads/<uuid:upload_id>/complete/',CompleteUploadSessionView.as_view() ),
+
     #Post like/unlike
     path('post/like/',PostLikeView.as_view()),
     path('post/unlike/',PostUnlikeView.as_view()),
 
     #Comments/Replies
+    path('posts/<int:post_id>/comments/',PostCommentsView.as_view()),
+    path('comments/<int:comment_id>/replies/',CommentRepliesView.as_view()),
     path('comments/create/',CreateCommentView.as_view()),
     path('comments/update/',UpdateCommentView.as_view()),
     path('comments/delete/',DeleteCommentView.as_view()),
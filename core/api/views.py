@@ -2,26 +2,73 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework.response import Response
 from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework.exceptions import NotFound
 from rest_framework.views import APIView
 from rest_framework import status
 from datetime import datetime
+from functools import partial
 from django.conf import settings
 from rest_framework import generics
 from rest_framework.permissions import IsAuthenticated,IsAuthenticatedOrReadOnly
-from .serializers import UserProfileSerializer,PostSerializer,PostLikeSerializer,CommentSerializer,CommentLikeSerializer,FollowSerializer,PublicUserProfileSerializer,FollowersSerializer,FollowingListSerializer,NotificationsSerializer,ChatMessageSerializer,UserDiscussionSerializer
-from .models import UserProfile,CustomUser,Follow,Post,PostMedia,PostLike,Comment,CommentLike
+from .serializers import UserProfileSerializer,PostSerializer,PostLikeSerializer,CommentSerializer,CommentLikeSerializer,FollowSerializer,PublicUserProfileSerializer,FollowersSerializer,FollowingListSerializer,NotificationsSerializer,ChatMessageSerializer,UserDiscussionSerializer,UploadSessionSerializer
+from .models import UserProfile,CustomUser,Follow,Post,PostMedia,PostLike,Comment,CommentLike,UploadSession
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
+from django.db import IntegrityError,transaction
 from notifications.utils import send_notification
+from notifications.counters import notifications_unread,reset_notifications
+from timelines.utils import publish_post,read_home_timeline
+from .counters import adjust_counter
+from .follow_cache import is_following
+from .response_cache import cached_response,follower_tags,page_tags
+from .etags import conditional_response
+from .loaders import REPLIES_PREVIEW_SIZE,load_comment_context
+from .uploads import attach_uploads,claim_chunk,discard,expected_chunk_length,finalize,release_chunk,write_chunk
 from rest_framework import serializers
-from .paginations import UserPostsPagination,UserFollowersPagination,UserFollowingPagination,UserNotificationsPagination,MessagesPagination,UserDiscussionPagination
+from .paginations import FeedPagination,CommentsPagination,RepliesPagination,UserPostsPagination,UserFollowersPagination,UserFollowingPagination,UserNotificationsPagination,MessagesPagination,UserDiscussionPagination
 from notifications.models import Notification
-from chat.models import ChatMessage
+from chat.conversations import chat_unread,find_conversation,reset_chat
+from chat.models import ChatMessage,Participant
 
 # Create your views here.
 
 
 
+def can_view_post(user,post):
+    if post.is_public or post.author_id == user.id:
+        return True
+    return is_following(user,post.author_id)
+
+
+
+def get_list(data,key):
+    # multipart bodies repeat the key, JSON bodies send a list
+    if hasattr(data,'getlist'):
+        return data.getlist(key)
+    value = data.get(key) or []
+    return value if isinstance(value,list) else [value]
+
+
+
+def wants_legacy(request):
+    # old clients get the whole collection back from write endpoints with ?legacy=1
+    return request.query_params.get('legacy') in ('1','true')
+
+
+
+def render_comment(comment,user):
+    # one comment in the shape of a comments page, with its first replies
+    context = {'user':user,'comment_context':load_comment_context([comment],user,REPLIES_PREVIEW_SIZE)}
+    return CommentSerializer(comment,context=context).data
+
+
+
+def patch(op,kind,object_id,**changes):
+    # what a write endpoint changed, for the client to apply to the lists it holds
+    return {'op':op,'type':kind,'id':object_id,**changes}
+
+
+
 #Login view
 class CustomTokenObtainPairView(TokenObtainPairView):
     
@@ -129,6 +176,9 @@ class GetUserProfileView(generics.ListAPIView):
     serializer_class = UserProfileSerializer
 
     def get(self,request,*args,**kwargs):
+        return conditional_response(request,[f'user:{request.user.id}'],partial(self.get_profile,request))
+
+    def get_profile(self,request):
         user = request.user
 
         try:
@@ -196,10 +246,14 @@ class FollowUserView(APIView):
         except CustomUser.DoesNotExist:
             return Response("User does not exist!",status=status.HTTP_400_BAD_REQUEST)
 
-        follow_instance,created = Follow.objects.get_or_create(
-            follower=request.user,
-            following = user_to_follow
-        )
+        with transaction.atomic():
+            follow_instance,created = Follow.objects.get_or_create(
+                follower=request.user,
+                following = user_to_follow
+            )
+            if created:
+                adjust_counter(CustomUser,request.user.id,'following_count',1)
+                adjust_counter(CustomUser,user_to_follow.id,'followers_count',1)
         if not created:
             return Response({'Error':'You are already following this user!'},status=status.HTTP_400_BAD_REQUEST)
         
@@ -225,7 +279,10 @@ class UnfollowUserView(APIView):
         follow_instance = Follow.objects.filter(follower=request.user, following=user_to_unfollow).first()
 
         if follow_instance:
-            follow_instance.delete()
+            with transaction.atomic():
+                follow_instance.delete()
+                adjust_counter(CustomUser,request.user.id,'following_count',-1)
+                adjust_counter(CustomUser,user_to_unfollow.id,'followers_count',-1)
             return Response({'success':f'you have unfollowed {user_to_unfollow.username}'})
 
         return Response({'error':'You are not following this user!'},status=status.HTTP_400_BAD_REQUEST)
@@ -239,6 +296,7 @@ class CreatePostView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = PostSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
         post = serializer.save(author = self.request.user)
         media_files = self.request.FILES.getlist('media')
@@ -246,7 +304,12 @@ class CreatePostView(generics.CreateAPIView):
         for media_file in media_files:
             media_type = 'image' if media_file.content_type.startswith('image') else 'video'
             PostMedia.objects.create(post=post,media_type=media_type,file=media_file)
-        send_notification(action_user=self.request.user,request=self.request,post=post,message=f"{self.request.user.username} created a new post!")
+        # media sent beforehand through /api/uploads/
+        upload_ids = get_list(self.request.data,'upload_ids')
+        if upload_ids:
+            attach_uploads(post,self.request.user,upload_ids)
+        publish_post(post)
+        send_notification(action_user=self.request.user,request=self.request,post=post,verb=Notification.POST)
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -268,6 +331,7 @@ class UpdatePostView(generics.UpdateAPIView):
     def patch(self, request, *args, **kwargs):
         return self.partial_update(request, *args, **kwargs)
 
+    @transaction.atomic
     def perform_update(self, serializer):
         post = serializer.save()
 
@@ -277,6 +341,9 @@ class UpdatePostView(generics.UpdateAPIView):
             for media_file in media_files:
                 media_type = 'image' if media_file.content_type.startswith('image') else 'video'
                 PostMedia.objects.create(post=post, media_type=media_type, file=media_file)
+        upload_ids = get_list(self.request.data,'upload_ids')
+        if upload_ids:
+            attach_uploads(post,self.request.user,upload_ids)
     
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -286,6 +353,85 @@ class UpdatePostView(generics.UpdateAPIView):
 
 
 
+class CreateUploadSessionView(generics.CreateAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+
+    def perform_create(self,serializer):
+        serializer.save(user=self.request.user)
+
+
+
+
+
+class UploadSessionView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_session(self):
+        return get_object_or_404(UploadSession,id=self.kwargs.get('upload_id'),user=self.request.user)
+
+    def get(self,request,*args,**kwargs):
+        # clients resume an interrupted upload from `received`
+        return Response(UploadSessionSerializer(self.get_session()).data)
+
+    def put(self,request,*args,**kwargs):
+        session = self.get_session()
+        if session.status != UploadSession.OPEN:
+            return Response({'detail':'Upload already completed.'},status=status.HTTP_409_CONFLICT)
+        try:
+            offset = int(request.query_params.get('offset'))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (TypeError,ValueError):
+            return Response({'detail':'An integer offset and a Content-Length are required.'},status=status.HTTP_400_BAD_REQUEST)
+        if offset != session.received:
+            return Response({'detail':'Unexpected offset.','received':session.received},status=status.HTTP_409_CONFLICT)
+        if length != expected_chunk_length(session,offset):
+            return Response({'detail':f'Chunk must be {expected_chunk_length(session,offset)} bytes long.'},status=status.HTTP_400_BAD_REQUEST)
+
+        claim = claim_chunk(session,offset)
+        if claim is None:
+            session.refresh_from_db(fields=['received'])
+            return Response({'detail':'Chunk is being written or was already received.','received':session.received},status=status.HTTP_409_CONFLICT)
+        # the body goes straight from the socket to the temporary file
+        try:
+            written = write_chunk(session,offset,request.stream,length)
+        except Exception:
+            release_chunk(session,claim)
+            raise
+        if written != length:
+            release_chunk(session,claim)
+            return Response({'detail':'Incomplete chunk.','received':offset},status=status.HTTP_400_BAD_REQUEST)
+        if not release_chunk(session,claim,received=offset + length):
+            return Response({'detail':'Chunk write timed out.'},status=status.HTTP_409_CONFLICT)
+        return Response({'received':offset + length})
+
+    def delete(self,request,*args,**kwargs):
+        session = self.get_session()
+        discard(session)
+        if session.media_id and session.media.post_id is None:
+            session.media.delete()
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+
+
+
+class CompleteUploadSessionView(UploadSessionView):
+
+    def post(self,request,*args,**kwargs):
+        session = self.get_session()
+        if session.status == UploadSession.COMPLETE:
+            return Response(UploadSessionSerializer(session).data)
+        if session.received != session.size:
+            return Response({'detail':'Upload is incomplete.','received':session.received},status=status.HTTP_400_BAD_REQUEST)
+        finalize(session)
+        return Response(UploadSessionSerializer(session).data,status=status.HTTP_201_CREATED)
+
+
+
+
+
 class DeletePostView(generics.DestroyAPIView):
     serializer_class = PostSerializer
     permission_classes = [IsAuthenticated]
@@ -300,7 +446,11 @@ class DeletePostView(generics.DestroyAPIView):
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
+        post_id = instance.id
         self.perform_destroy(instance)
+        if not wants_legacy(request):
+            return Response(patch('delete','post',post_id),status=status.HTTP_200_OK)
+
         user = self.request.user
         followed_users = user.following.values_list('following',flat=True)
         posts = Post.objects.filter(Q(author__in=followed_users) | Q(author=user) | Q(is_public=True)).order_by('-created_at')
@@ -320,15 +470,22 @@ class DeletePostView(generics.DestroyAPIView):
 
 class FeedView(generics.ListAPIView):
     serializer_class = PostSerializer
+    pagination_class = FeedPagination
 
     def get_queryset(self):
-        if self.request.user.is_authenticated:
-            user = self.request.user
+        return Post.objects.filter(is_public=True).order_by('-created_at','-id')
 
-            followed_users = user.following.values_list('following', flat=True)
-            return Post.objects.filter(Q(author__in=followed_users) | Q(author=user) | Q(is_public=True)).order_by('-created_at')
-        else:
-            return Post.objects.filter(is_public=True).order_by('-created_at')
+    def list(self,request,*args,**kwargs):
+        if not request.user.is_authenticated:
+            return cached_response('feed',request,['feed'],partial(super().list,request,*args,**kwargs),page_tags)
+
+        # home timeline: fanned-out posts merged with public and high-follower posts
+        page = self.paginator.paginate_with(
+            lambda position,limit: read_home_timeline(request.user,position,limit),
+            request
+        )
+        serializer = self.get_serializer(page,many=True)
+        return self.get_paginated_response(serializer.data)
     
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -352,11 +509,11 @@ class DeletePostMediaView(generics.DestroyAPIView):
 
 
     def perform_destroy(self, instance):
-        instance.file.delete()
+        # the file itself is removed by a background job (see api.signals)
         instance.delete()
 
 
-    def delete(self,instance,request,*args,**kwargs):
+    def delete(self,request,*args,**kwargs):
         response = super().delete(request, *args, **kwargs)
 
         post_id = request.data.get('post_id')
@@ -385,13 +542,16 @@ class PostLikeView(generics.CreateAPIView):
         post = get_object_or_404(Post,id=post_id)
         user = request.user
 
-        if PostLike.objects.filter(user=user,post=post).exists():
+        try:
+            with transaction.atomic():
+                like = PostLike.objects.create(post=post,user=user)
+                adjust_counter(Post,post.id,'likes_count',1)
+        except IntegrityError:
             return Response({'error':'You have already liked this post'},status=status.HTTP_400_BAD_REQUEST)
 
-        like = PostLike.objects.create(post=post,user=user)
         serializer = PostLikeSerializer(like)
         if user != post.author:
-            send_notification(action_user=request.user,request=request,target_user=post.author,post=post,message=f"{request.user.username} liked your post")
+            send_notification(action_user=request.user,request=request,target_user=post.author,post=post,verb=Notification.POST_LIKE)
         return Response(serializer.data,status=status.HTTP_201_CREATED)
 
 
@@ -408,11 +568,13 @@ class PostUnlikeView(generics.DestroyAPIView):
 
         post = get_object_or_404(Post,id=post_id)
         user = request.user
-        like = PostLike.objects.filter(post=post,user=user).first()
-        if not like:
+        with transaction.atomic():
+            deleted,_ = PostLike.objects.filter(post=post,user=user).delete()
+            if deleted:
+                adjust_counter(Post,post.id,'likes_count',-deleted)
+        if not deleted:
             return Response({'error':'Like does not exist on this post!'},status=status.HTTP_400_BAD_REQUEST)
         
-        like.delete()
         return Response('Post unliked successfully!',status=status.HTTP_200_OK)
 
 
@@ -435,9 +597,12 @@ class CreateCommentView(generics.CreateAPIView):
             except Comment.DoesNotExist:
                 return Response({'error':'Comment does not exist!'},status=status.HTTP_400_BAD_REQUEST)
 
-        serializer.save(author=self.request.user,post=post,parent=parent_comment)
+        with transaction.atomic():
+            serializer.save(author=self.request.user,post=post,parent=parent_comment)
+            if parent_comment is None:
+                adjust_counter(Post,post.id,'comments_count',1)
         if self.request.user != post.author:
-            send_notification(action_user=self.request.user,request=self.request,target_user=post.author,post=post,message=f"{self.request.user.username} commented on your post")
+            send_notification(action_user=self.request.user,request=self.request,target_user=post.author,post=post,verb=Notification.COMMENT)
     
     
     def get_serializer_context(self):
@@ -447,6 +612,45 @@ class CreateCommentView(generics.CreateAPIView):
         return context
 
 
+class PostCommentsView(generics.ListAPIView):
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    serializer_class = CommentSerializer
+    pagination_class = CommentsPagination
+
+    def get_queryset(self):
+        post = get_object_or_404(Post,id=self.kwargs.get('post_id'))
+        if not can_view_post(self.request.user,post):
+            raise NotFound('Post does not exist!')
+        return Comment.objects.filter(post=post,parent=None).select_related('author__userprofile')
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['request'] = self.request
+        context['user'] = self.request.user
+        context['replies_limit'] = REPLIES_PREVIEW_SIZE
+        return context
+
+
+
+class CommentRepliesView(generics.ListAPIView):
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    serializer_class = CommentSerializer
+    pagination_class = RepliesPagination
+
+    def get_queryset(self):
+        comment = get_object_or_404(Comment.objects.select_related('post'),id=self.kwargs.get('comment_id'),parent=None)
+        if not can_view_post(self.request.user,comment.post):
+            raise NotFound('Comment does not exist!')
+        return Comment.objects.filter(parent=comment).select_related('author__userprofile')
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['request'] = self.request
+        context['user'] = self.request.user
+        return context
+
+
+
 class DeleteCommentView(generics.DestroyAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = CommentSerializer
@@ -455,12 +659,19 @@ class DeleteCommentView(generics.DestroyAPIView):
         comment_id = self.request.data.get('comment_id')
         post_id = self.request.data.get('post_id')
         post = get_object_or_404(Post,id=post_id)
-        comment = Comment.objects.get(id=comment_id,author=self.request.user,post=post).first()
+        comment = get_object_or_404(Comment,id=comment_id,author=self.request.user,post=post)
         return comment
     def destroy(self,request,*args,**kwargs):
         comment = self.get_object()
+        comment_id = comment.id
         post = comment.post
-        comment.delete()
+        with transaction.atomic():
+            comment.delete()
+            if comment.parent_id is None:
+                adjust_counter(Post,post.id,'comments_count',-1)
+        if not wants_legacy(request):
+            comments_count = Post.objects.filter(id=post.id).values_list('comments_count',flat=True).first()
+            return Response(patch('delete','comment',comment_id,post_id=post.id,parent_id=comment.parent_id,comments_count=comments_count),status=status.HTTP_200_OK)
         remaining_comments = Comment.objects.filter(post=post,parent__isnull=True)
         serializer = CommentSerializer(remaining_comments,many=True)
         return Response(serializer.data,status=status.HTTP_200_OK)
@@ -481,17 +692,20 @@ class DeleteCommentReplyView(generics.DestroyAPIView):
     def get_object(self):
         post_id = self.request.data.get('post_id')
         reply_id = self.request.data.get('reply_id')
-        parent_id =self.request.data.get('parent_id',None)
-        if parent_id:
-            post = get_object_or_404(Post,id=post_id)
-            reply = Comment.objects.filter(author=self.request.user,post=post,parent=parent_id).first()
-            return reply
+        parent_id = self.request.data.get('parent_id')
+        if not (post_id and reply_id and parent_id):
+            raise serializers.ValidationError('post_id, parent_id and reply_id are required')
+        return get_object_or_404(Comment,id=reply_id,author=self.request.user,post_id=post_id,parent_id=parent_id)
 
     def destroy(self, request, *args, **kwargs):
         reply = self.get_object()
+        reply_id = reply.id
         post = reply.post
-        parent_id = request.data.get('parent_id')
+        parent_id = reply.parent_id
         reply.delete()
+        if not wants_legacy(request):
+            replies_count = Comment.objects.filter(parent_id=parent_id).count()
+            return Response(patch('delete','reply',reply_id,post_id=post.id,parent_id=parent_id,replies_count=replies_count),status=status.HTTP_200_OK)
         remaining_replies = Comment.objects.filter(post=post,parent=parent_id)
         serializer = CommentSerializer(remaining_replies,many=True)
         return Response(serializer.data,status=status.HTTP_200_OK)
@@ -517,13 +731,16 @@ class CommentLikeView(generics.CreateAPIView):
         comment = get_object_or_404(Comment,id=comment_id)
         user = request.user
 
-        if CommentLike.objects.filter(user=user,comment=comment).exists():
+        try:
+            with transaction.atomic():
+                like = CommentLike.objects.create(comment=comment,user=user)
+                adjust_counter(Comment,comment.id,'likes_count',1)
+        except IntegrityError:
             return Response({'error':'You have already liked this comment'},status=status.HTTP_400_BAD_REQUEST)
 
-        like = CommentLike.objects.create(comment=comment,user=user)
         serializer = CommentLikeSerializer(like)
         if user != comment.author:
-            send_notification(action_user=user,request=request,target_user=comment.author,post=comment.post,message=f"{request.user.username} liked your comment!")
+            send_notification(action_user=user,request=request,target_user=comment.author,post=comment.post,verb=Notification.COMMENT_LIKE)
         return Response(serializer.data,status.HTTP_201_CREATED)
 
 
@@ -542,11 +759,13 @@ class CommentUnlikeView(generics.DestroyAPIView):
 
         comment = get_object_or_404(Comment,id=comment_id)
         user = request.user
-        like = CommentLike.objects.filter(comment=comment,user=user).first()
-        if not like:
+        with transaction.atomic():
+            deleted,_ = CommentLike.objects.filter(comment=comment,user=user).delete()
+            if deleted:
+                adjust_counter(Comment,comment.id,'likes_count',-deleted)
+        if not deleted:
             return Response({'error':'You did not like this comment!'},status=status.HTTP_400_BAD_REQUEST)
         
-        like.delete()
         return Response('Comment unliked successfully!',status=status.HTTP_200_OK)
 
 
@@ -571,6 +790,8 @@ class UpdateCommentView(generics.UpdateAPIView):
         comment_serializer = self.get_serializer(comment,data=request.data)
         if comment_serializer.is_valid(raise_exception=True):
             self.perform_update(comment_serializer)
+        if not wants_legacy(request):
+            return Response(render_comment(comment,request.user),status=status.HTTP_200_OK)
         post_id = request.data.get('post_id')
         post = get_object_or_404(Post,id=post_id)
         comments = Comment.objects.filter(post=post,parent__isnull=True)
@@ -605,6 +826,8 @@ class UpdateCommentReplyView(generics.UpdateAPIView):
         comment_serializer = self.get_serializer(comment,data=request.data)
         if comment_serializer.is_valid(raise_exception=True):
             self.perform_update(comment_serializer)
+        if not wants_legacy(request):
+            return Response(render_comment(comment,request.user),status=status.HTTP_200_OK)
         post_id = request.data.get('post_id')
         post = get_object_or_404(Post,id=post_id)
         parent_id = request.data.get('parent_id')
@@ -634,7 +857,10 @@ class CreateFollowView(generics.CreateAPIView):
         except CustomUser.DoesNotExist:
             raise serializers.ValidationError('User Does not exist!')
         
-        serializer.save(follower=self.request.user,following=target_user)
+        with transaction.atomic():
+            serializer.save(follower=self.request.user,following=target_user)
+            adjust_counter(CustomUser,self.request.user.id,'following_count',1)
+            adjust_counter(CustomUser,target_user.id,'followers_count',1)
 
     def create(self,request,*args,**kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -647,7 +873,7 @@ class CreateFollowView(generics.CreateAPIView):
         target_user_profile = get_object_or_404(UserProfile,user=target_user)
         profile_serializer = PublicUserProfileSerializer(target_user_profile)
         if request.user != target_user:
-            send_notification(action_user=request.user,request=request,target_user=target_user,message=f"{request.user.username} is following you")
+            send_notification(action_user=request.user,request=request,target_user=target_user,verb=Notification.FOLLOW)
         return Response(profile_serializer.data,status=status.HTTP_201_CREATED)
 
 
@@ -667,7 +893,14 @@ class DeleteFollowView(generics.DestroyAPIView):
 
     def delete(self, request, *args, **kwargs):
         follow = self.get_object()
-        follow.delete()
+        follow_id = follow.id
+        with transaction.atomic():
+            follow.delete()
+            adjust_counter(CustomUser,follow.follower_id,'following_count',-1)
+            adjust_counter(CustomUser,follow.following_id,'followers_count',-1)
+        if not wants_legacy(request):
+            followers_count = CustomUser.objects.filter(id=follow.following_id).values_list('followers_count',flat=True).first()
+            return Response(patch('delete','follow',follow_id,user_id=follow.following_id,followers_count=followers_count,is_following=False),status=status.HTTP_200_OK)
         target_user = get_object_or_404(CustomUser,id=request.data.get('user_id'))
         target_user_profile = UserProfile.objects.get(user=target_user)
         serializer = PublicUserProfileSerializer(target_user_profile)
@@ -681,6 +914,10 @@ class GetPublicUserProfile(generics.ListAPIView):
 
     def get(self,request,*args,**kwargs):
         user_id = self.kwargs.get('user_id')
+        tags = [f'user:{user_id}']
+        return conditional_response(request,tags,partial(cached_response,'public_profile',request,tags,partial(self.get_profile,request,user_id)))
+
+    def get_profile(self,request,user_id):
         if user_id:
             try:
                 user_profile = UserProfile.objects.get(user__id=user_id)
@@ -707,29 +944,23 @@ class UserPostsView(generics.ListAPIView):
     pagination_class = UserPostsPagination
 
     def get(self,request,*args,**kwargs):
+        # anonymous visitors all see the public posts
         user_id = self.kwargs.get('user_id')
+        tags = [f'user_posts:{user_id}',f'user:{user_id}']
+        return conditional_response(request,tags,partial(cached_response,'user_posts',request,tags,partial(self.get_posts,request,user_id),page_tags),page_tags)
+
+    def get_posts(self,request,user_id):
         user = get_object_or_404(CustomUser,id=user_id)
         paginator = self.pagination_class()
 
-        if request.user.is_authenticated:
-            relationship = Follow.objects.get(following=user,follower=request.user)
-            print('rel: ',relationship)
-            if relationship:
-                user_posts = Post.objects.filter(author=user).order_by('-created_at')
-                paginated_queryset = paginator.paginate_queryset(user_posts,request)
-                serializer = PostSerializer(paginated_queryset,many=True,context={'user':request.user})
-                return paginator.get_paginated_response(serializer.data)
-            else:
-                print('rel else: ')
-                user_posts = Post.objects.filter(author=user,is_public=True).order_by('-created_at')
-                paginated_queryset = paginator.paginate_queryset(user_posts,request)
-                serializer = PostSerializer(paginated_queryset,many=True,context={'user':request.user})
-                return paginator.get_paginated_response(serializer.data)
-        else:
-            user_posts = Post.objects.filter(author=user,is_public=True).order_by('-created_at')
-            paginated_queryset = paginator.paginate_queryset(user_posts,request)
-            serializer = PostSerializer(paginated_queryset,many=True,context={'user':request.user})
-            return paginator.get_paginated_response(serializer.data)
+        user_posts = Post.objects.filter(author=user)
+        context = {'user':request.user}
+        if not (is_following(request.user,user.id,context) or request.user == user):
+            user_posts = user_posts.filter(is_public=True)
+
+        paginated_queryset = paginator.paginate_queryset(user_posts.select_related('author__userprofile').order_by('-created_at','-id'),request)
+        serializer = PostSerializer(paginated_queryset,many=True,context=context)
+        return paginator.get_paginated_response(serializer.data)
 
 
     def get_serializer_context(self):
@@ -748,12 +979,16 @@ class UserFollowersView(generics.ListAPIView):
     pagination_class = UserFollowersPagination
 
     def get(self,request,*args,**kwargs):
+        # a follow or unfollow bumps the followed user's tag
         user_id = self.kwargs.get('user_id')
+        return conditional_response(request,[f'user:{user_id}'],partial(self.get_followers,request,user_id),follower_tags)
+
+    def get_followers(self,request,user_id):
         user = get_object_or_404(CustomUser,id=user_id)
         paginator = self.pagination_class()
-        followers = Follow.objects.filter(following=user)
+        followers = Follow.objects.filter(following=user).select_related('follower__userprofile').order_by('-created_at','-id')
         paginated_queryset = paginator.paginate_queryset(followers,request)
-        serializer = FollowersSerializer(paginated_queryset,many=True)
+        serializer = FollowersSerializer(paginated_queryset,many=True,context=self.get_serializer_context())
         return paginator.get_paginated_response(serializer.data)
 
     def get_serializer_context(self):
@@ -773,9 +1008,9 @@ class UserFollowingView(generics.ListAPIView):
         user_id = self.kwargs.get('user_id')
         user = get_object_or_404(CustomUser,id=user_id)
         paginator = self.pagination_class()
-        following_list = Follow.objects.filter(follower=user)
+        following_list = Follow.objects.filter(follower=user).select_related('following__userprofile').order_by('-created_at','-id')
         paginated_queryset = paginator.paginate_queryset(following_list,request)
-        serializer = FollowingListSerializer(paginated_queryset,many=True)
+        serializer = FollowingListSerializer(paginated_queryset,many=True,context=self.get_serializer_context())
         return paginator.get_paginated_response(serializer.data)
 
 
@@ -798,9 +1033,8 @@ class GetUserNotificationsView(generics.ListAPIView):
             return Response('You must provide a user id!',status=status.HTTP_400_BAD_REQUEST)
         user = get_object_or_404(CustomUser,id=user_id)
         paginator = self.pagination_class()
-        notifications = Notification.objects.filter(target_user=user).order_by('-timestamp')
-        notifications_count = notifications.filter(is_read=False).count()
-        request.notifications_count = notifications_count
+        notifications = Notification.objects.filter(target_user=user).select_related('user__userprofile','post').order_by('-timestamp','-id')
+        request.notifications_count = notifications_unread(user.id)
         paginated_queryset = paginator.paginate_queryset(notifications,request)
         context = self.get_serializer_context()
         serializer = NotificationsSerializer(paginated_queryset,many=True,context=context)
@@ -821,7 +1055,9 @@ class GetUserNotificationsView(generics.ListAPIView):
 class NotificationsReadView(APIView):
     permission_classes = [IsAuthenticated]
     def get(self,request,*args,**kwargs):
-        Notification.objects.filter(target_user=request.user,is_read=False).update(is_read=True)
+        with transaction.atomic():
+            Notification.objects.filter(target_user=request.user,is_read=False).update(is_read=True)
+            reset_notifications(request.user.id)
         return Response(status=status.HTTP_200_OK)
 
 
@@ -837,13 +1073,15 @@ class RetrieveDiscussionView(generics.ListAPIView):
         recipient_id = self.kwargs.get('user_id')
         user = request.user
         paginator = self.pagination_class()
-        discussion = ChatMessage.objects.filter(
-            ( Q(sender=user) & Q(receiver__id=recipient_id) ) | ( Q(sender__id=recipient_id) & Q(receiver=user) )
-        )
-        messages_count = discussion.filter(sender__id=recipient_id,is_read=False).count()
-        request.messages_count = messages_count
-        paginated_queryset = paginator.paginate_queryset(discussion.order_by('-created_at'),request)
-        serializer = ChatMessageSerializer(paginated_queryset,many=True)
+        conversation = find_conversation(user.id,recipient_id)
+        if conversation is None:
+            discussion = ChatMessage.objects.none()
+        else:
+            discussion = conversation.messages.select_related('sender__userprofile')
+        request.messages_count = chat_unread(user.id,recipient_id)
+        request.last_seq = conversation.last_seq if conversation else 0
+        paginated_queryset = paginator.paginate_queryset(discussion,request)
+        serializer = ChatMessageSerializer(paginated_queryset,many=True,context=self.get_serializer_context())
         return paginator.get_paginated_response(serializer.data)
 
     
@@ -867,11 +1105,8 @@ class RetrieveDiscussionUsers(generics.ListAPIView):
 
 
     def get_queryset(self):
-        user = self.request.user
-        return CustomUser.objects.filter(
-            Q(received_messages__sender=user) | 
-            Q(sent_messages__receiver=user)
-            ).exclude(id=user.id).distinct()
+        # ordered by the pagination on the (user, -last_message_at, -id) index
+        return Participant.objects.filter(user=self.request.user).select_related('partner__userprofile','conversation')
 
 
     def get_serializer_context(self):
@@ -892,6 +1127,8 @@ class UserDiscussionSeenView(APIView):
         if not user_id:
             return Response('You must provide a user id !',status=status.HTTP_400_BAD_REQUEST)
         target_user = get_object_or_404(CustomUser,id=user_id)
-        messages = ChatMessage.objects.filter(sender=target_user,receiver=request.user,is_read=False).update(is_read=True)
+        with transaction.atomic():
+            ChatMessage.objects.filter(sender=target_user,receiver=request.user,is_read=False).update(is_read=True)
+            reset_chat(request.user.id,target_user.id)
         return Response(status=status.HTTP_200_OK)
 
@@ -0,0 +1,135 @@
+from django.db import transaction
+from django.db.models import F,OuterRef,Sum
+from api.counters import count_subquery,recount
+from collections import Counter
+from .models import ChatMessage,Conversation,Participant
+
+# Conversations and inboxes. Every message takes the next value of its conversation's
+# last_seq, bumped by UPDATE for a whole batch of messages; the rows stay locked until
+# the transaction commits, so concurrent writers never hand out the same number. After
+# the insert, record_messages moves the conversation to the top of both inboxes and
+# bumps the receiver's unread badge, with a constant number of queries per batch.
+
+
+PREVIEW_LENGTH = 100
+
+
+def conversation_key(user_id,other_id):
+    return (user_id,other_id) if user_id <= other_id else (other_id,user_id)
+
+
+
+def find_conversation(user_id,other_id):
+    low,high = conversation_key(user_id,other_id)
+    return Conversation.objects.filter(user_low_id=low,user_high_id=high).first()
+
+
+
+def get_conversations(keys):
+    # {(low,high): Conversation}, creating the missing ones
+    keys = set(keys)
+    if not keys:
+        return {}
+
+    def fetch():
+        # two IN lists instead of one OR branch per pair, the extra pairs are dropped here
+        candidates = Conversation.objects.filter(user_low_id__in={low for low,high in keys},user_high_id__in={high for low,high in keys})
+        return {(conversation.user_low_id,conversation.user_high_id):conversation for conversation in candidates if (conversation.user_low_id,conversation.user_high_id) in keys}
+
+    conversations = fetch()
+    missing = keys - set(conversations)
+    if missing:
+        Conversation.objects.bulk_create([Conversation(user_low_id=low,user_high_id=high) for low,high in missing],ignore_conflicts=True)
+        conversations = fetch()
+        # notes to self have no inbox entry
+        Participant.objects.bulk_create([
+            Participant(conversation=conversations[low,high],user_id=user_id,partner_id=partner_id)
+            for low,high in missing if low != high
+            for user_id,partner_id in ((low,high),(high,low))
+        ],ignore_conflicts=True)
+    return conversations
+
+
+
+def allocate(counts):
+    # {conversation id: count} -> {conversation id: first of `count` consecutive numbers},
+    # one UPDATE per distinct count and one SELECT for the whole batch
+    by_count = {}
+    for conversation_id,count in counts.items():
+        by_count.setdefault(count,[]).append(conversation_id)
+    for count,conversation_ids in by_count.items():
+        Conversation.objects.filter(id__in=conversation_ids).update(last_seq=F('last_seq') + count)
+    last_seqs = Conversation.objects.filter(id__in=list(counts)).values_list('id','last_seq')
+    return {conversation_id:last_seq - counts[conversation_id] + 1 for conversation_id,last_seq in last_seqs}
+
+
+
+def assign_sequence(messages):
+    # numbers follow the order of `messages`; must run inside the transaction that inserts them
+    by_key = {}
+    for message in messages:
+        by_key.setdefault(conversation_key(message.sender_id,message.receiver_id),[]).append(message)
+    conversations = get_conversations(by_key)
+    first_seqs = allocate({conversations[key].id:len(group) for key,group in by_key.items()})
+    for key,group in by_key.items():
+        conversation = conversations[key]
+        for offset,message in enumerate(group):
+            message.conversation = conversation
+            message.seq = first_seqs[conversation.id] + offset
+
+
+
+def record_messages(messages):
+    # must run inside the transaction that inserted `messages`
+    last = {}
+    unread = Counter()
+    for message in messages:
+        last[message.conversation_id] = message
+        unread[message.receiver_id,message.sender_id] += 1
+
+    conversations = []
+    for message in last.values():
+        conversation = message.conversation
+        conversation.last_message = message
+        conversation.last_message_preview = message.content[:PREVIEW_LENGTH]
+        conversation.last_message_at = message.created_at
+        conversations.append(conversation)
+    Conversation.objects.bulk_update(conversations,['last_message','last_message_preview','last_message_at'])
+
+    participants = list(Participant.objects.filter(conversation_id__in=list(last)))
+    for participant in participants:
+        participant.last_message_at = last[participant.conversation_id].created_at
+        # an expression for every row: a plain value would overwrite a concurrent reset
+        participant.unread_count = F('unread_count') + unread[participant.user_id,participant.partner_id]
+    Participant.objects.bulk_update(participants,['last_message_at','unread_count'])
+
+
+
+def create_messages(messages,batch_size=None):
+    with transaction.atomic():
+        assign_sequence(messages)
+        messages = ChatMessage.objects.bulk_create(messages,batch_size=batch_size)
+        record_messages(messages)
+    return messages
+
+
+
+def reset_chat(user_id,partner_id):
+    Participant.objects.filter(user_id=user_id,partner_id=partner_id).update(unread_count=0)
+
+
+
+def chat_unread(user_id,partner_id):
+    return Participant.objects.filter(user_id=user_id,partner_id=partner_id).values_list('unread_count',flat=True).first() or 0
+
+
+
+def chat_unread_total(user_id):
+    return Participant.objects.filter(user_id=user_id).aggregate(total=Sum('unread_count'))['total'] or 0
+
+
+
+def reconcile_unread():
+    # recount the unread messages of every participant, returns the number of fixed rows
+    unread = count_subquery(ChatMessage,'receiver_id',{'sender_id':OuterRef('partner_id'),'is_read':False},outer='user_id')
+    return recount(Participant.objects.all(),'unread_count',unread)
@@ -0,0 +1,242 @@
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError,IntegrityError
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from rest_framework import serializers
+from collections import OrderedDict,namedtuple
+from threading import Lock
+from api.models import CustomUser
+from api.serializers import UserProfileSerializer
+from metrics.layers import timed_group_send
+from .conversations import create_messages
+from .models import ChatMessage
+import asyncio
+import logging
+import time
+import weakref
+
+# Message path of ChatConsumer. Recipients are checked against a per-process set of
+# known user ids, the sender card is rendered once per connection, and messages go
+# through a write-behind buffer: one flusher task per event loop inserts them in
+# batches and only then delivers them, in the order they were received. A batch the
+# database refuses goes back to the head of the buffer and is tried again; once its
+# attempts run out its senders are told, nothing is dropped silently.
+
+
+DEFAULTS = {
+    'FLUSH_INTERVAL':0.005,  # seconds a message may wait for others to join its batch
+    'MAX_BATCH':500,  # messages inserted by one query
+    'MAX_PENDING':5000,  # receivers wait for a flush once this many messages are buffered
+    'FLUSH_ATTEMPTS':5,  # inserts tried for a message before its sender is told it was lost
+    'RETRY_DELAY':0.1,  # seconds before a failed insert is tried again, doubled every time
+    'KNOWN_USERS':100000,  # recipient ids remembered per process
+}
+
+
+def chat_setting(name):
+    return getattr(settings,'CHAT',{}).get(name,DEFAULTS[name])
+
+
+logger = logging.getLogger(__name__)
+
+_known_users = OrderedDict()
+_lock = Lock()
+
+
+def remember_user(user_id):
+    with _lock:
+        _known_users[user_id] = True
+        _known_users.move_to_end(user_id)
+        while len(_known_users) > chat_setting('KNOWN_USERS'):
+            _known_users.popitem(last=False)
+
+
+
+def forget_user(user_id):
+    with _lock:
+        _known_users.pop(user_id,None)
+
+
+
+@receiver(post_delete,sender=CustomUser)
+def forget_deleted_user(sender,instance,**kwargs):
+    forget_user(instance.id)
+
+
+
+async def is_known_user(user_id):
+    with _lock:
+        if user_id in _known_users:
+            _known_users.move_to_end(user_id)
+            return True
+    exists = await database_sync_to_async(CustomUser.objects.filter(id=user_id).exists)()
+    if exists:
+        remember_user(user_id)
+    return exists
+
+
+
+def sender_card(user):
+    profile = user.userprofile
+    return UserProfileSerializer(profile,context={'user':user}).data
+
+
+
+def render_message(message,card):
+    # the fields of ChatMessageSerializer, without touching the database again
+    return {
+        'id':message.id,
+        'seq':message.seq,
+        'content':message.content,
+        'sender':card,
+        'is_read':message.is_read,
+        'created_at':serializers.DateTimeField().to_representation(message.created_at),
+    }
+
+
+
+Entry = namedtuple('Entry',['sender','recipient_id','content','card'])
+
+
+def write_messages(entries):
+    """
+    The stored message of every entry, in order, or None for one whose recipient is gone.
+    A shorter list means the database failed on the next entry: it and those after it
+    were not stored. A failed batch insert stores nothing and raises.
+    """
+    messages = [ChatMessage(sender_id=entry.sender.id,receiver_id=entry.recipient_id,content=entry.content) for entry in entries]
+    try:
+        return create_messages(messages)
+    except IntegrityError:
+        # a recipient deleted by another process fails the whole batch: isolate it
+        logger.exception('Batch insert of %s chat messages failed, retrying one by one',len(messages))
+
+    written = []
+    for message in messages:
+        message.pk = message.seq = message.conversation = None
+        message._state.adding = True
+        try:
+            message.save()
+            written.append(message)
+        except IntegrityError:
+            logger.exception('Dropped chat message from %s to %s',message.sender_id,message.receiver_id)
+            forget_user(message.receiver_id)
+            written.append(None)
+        except DatabaseError:
+            logger.exception('Insert of chat message from %s to %s failed',message.sender_id,message.receiver_id)
+            break
+    return written
+
+
+
+class MessageBuffer:
+
+    def __init__(self):
+        self.pending = []
+        self.flusher = None
+        self.room = asyncio.Event()
+        self.room.set()
+        # entries ever added, and entries stored or given up on: always a prefix of those added
+        self.added = 0
+        self.done = 0
+        self.drains = []
+
+    async def add(self,sender,recipient_id,content,card):
+        while len(self.pending) >= chat_setting('MAX_PENDING'):
+            self.room.clear()
+            await self.room.wait()
+        self.pending.append(Entry(sender,recipient_id,content,card))
+        self.added += 1
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.run())
+
+    async def drain(self):
+        # returns once every entry added so far is stored or reported lost
+        if self.done >= self.added:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.drains.append((self.added,future))
+        await future
+
+    async def run(self):
+        failures = 0
+        while self.pending:
+            if len(self.pending) < chat_setting('MAX_BATCH') and not failures:
+                await asyncio.sleep(chat_setting('FLUSH_INTERVAL'))
+            batch = self.pending[:chat_setting('MAX_BATCH')]
+            del self.pending[:len(batch)]
+            try:
+                messages = await self.write(batch)
+            except Exception:
+                logger.exception('Flushing %s chat messages failed',len(batch))
+                messages = []
+
+            unwritten = batch[len(messages):]
+            failures = failures + 1 if unwritten else 0
+            if unwritten and failures < chat_setting('FLUSH_ATTEMPTS'):
+                # nothing of them was stored, they are tried again first, in order
+                self.pending[:0] = unwritten
+            elif unwritten:
+                logger.error('Gave up on %s chat messages after %s failed flushes',len(unwritten),failures)
+                failures = 0
+            self.room.set()
+
+            try:
+                await self.deliver(batch[:len(messages)],messages)
+                if unwritten and not failures:
+                    await self.report_lost(unwritten)
+            except Exception:
+                logger.exception('Delivering %s chat messages failed',len(batch))
+            self.done += len(messages) if failures else len(batch)
+            self.release_drains()
+            if failures:
+                await asyncio.sleep(chat_setting('RETRY_DELAY') * 2 ** (failures - 1))
+
+    def release_drains(self):
+        waiting = []
+        for added,future in self.drains:
+            if added <= self.done:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                waiting.append((added,future))
+        self.drains = waiting
+
+    async def write(self,batch):
+        return await database_sync_to_async(write_messages)(batch)
+
+    async def deliver(self,batch,messages):
+        stored_at = time.time()
+        channel_layer = get_channel_layer()
+        for entry,message in zip(batch,messages):
+            if message is None:
+                continue
+            await timed_group_send(channel_layer,f'chat_user_{entry.recipient_id}',{
+                'type':'chat_message',
+                'alert':f'{entry.sender.username} sent you a message!',
+                'message':render_message(message,entry.card),
+                'stored_at':stored_at,
+            })
+
+    async def report_lost(self,entries):
+        channel_layer = get_channel_layer()
+        for entry in entries:
+            await timed_group_send(channel_layer,f'chat_user_{entry.sender.id}',{
+                'type':'chat_failed',
+                'recipient_id':entry.recipient_id,
+                'content':entry.content,
+            })
+
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_buffer():
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        buffer = _buffers[loop] = MessageBuffer()
+    return buffer
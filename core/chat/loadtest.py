@@ -0,0 +1,203 @@
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.hashers import make_password
+from rest_framework_simplejwt.tokens import AccessToken
+from api.benchmarks import percentile
+from api.models import CustomUser,Follow,UserProfile
+from jobs.worker import claim_jobs,run_job
+from notifications.utils import fan_out
+import asyncio
+import os
+import random
+import time
+import tracemalloc
+
+# WebSocket load harness for core.consumers, driven by the `ws_loadtest` command.
+# Every socket goes through the real ASGI stack (JWT middleware, URL router,
+# consumer) with WebsocketCommunicator, against an in-memory channel layer.
+
+
+def seed_users(count):
+    password = make_password(None)
+    users = CustomUser.objects.bulk_create([
+        CustomUser(username=f'ws{i}',email=f'ws{i}@example.com',first_name='Load',last_name=str(i),password=password)
+        for i in range(count + 1)
+    ])
+    UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+    # the extra user is the one whose notifications fan out to every connected user
+    broadcaster,users = users[0],users[1:]
+    Follow.objects.bulk_create([Follow(follower=user,following=broadcaster) for user in users],batch_size=1000)
+    CustomUser.objects.filter(id=broadcaster.id).update(followers_count=len(users))
+    return broadcaster,users
+
+
+
+def run_fan_out(broadcaster_id,message):
+    # fan_out only queues one job per chunk of followers, which are run right away
+    fan_out(broadcaster_id,message)
+    while job_ids := claim_jobs(100):
+        for job_id in job_ids:
+            run_job(job_id)
+
+
+
+def rss_bytes():
+    # resident set size on Linux, None elsewhere
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError):
+        return None
+
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'p50_ms':None,'p95_ms':None,'p99_ms':None,'max_ms':None}
+    return {
+        'p50_ms':round(percentile(latencies,50),3),
+        'p95_ms':round(percentile(latencies,95),3),
+        'p99_ms':round(percentile(latencies,99),3),
+        'max_ms':round(latencies[-1],3),
+    }
+
+
+
+class LoadTest:
+
+    def __init__(self,application,users,broadcaster,seed=0,connect_batch=100,trace_memory=False):
+        self.application = application
+        self.users = users
+        self.broadcaster = broadcaster
+        self.rng = random.Random(seed)
+        self.connect_batch = connect_batch
+        self.trace_memory = trace_memory
+        self.chat_sockets = {}
+        self.notification_sockets = {}
+        self.readers = []
+        self.sent_at = {}
+        self.chat_latencies = []
+        self.notification_latencies = []
+        self.notifications_received = 0
+
+    async def open(self,path,user):
+        token = AccessToken.for_user(user)
+        communicator = WebsocketCommunicator(self.application,f'{path}?token={token}')
+        connected,code = await communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f'{path} refused user {user.id} with code {code}')
+        return communicator
+
+    async def connect_all(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        rss_before = rss_bytes()
+        traced_before = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        started = time.perf_counter()
+
+        for start in range(0,len(self.users),self.connect_batch):
+            batch = self.users[start:start + self.connect_batch]
+            chat = await asyncio.gather(*[self.open('/ws/chat/',user) for user in batch])
+            notifications = await asyncio.gather(*[self.open('/ws/notifications/',user) for user in batch])
+            for user,chat_socket,notification_socket in zip(batch,chat,notifications):
+                self.chat_sockets[user.id] = chat_socket
+                self.notification_sockets[user.id] = notification_socket
+
+        elapsed = time.perf_counter() - started
+        sockets = len(self.chat_sockets) + len(self.notification_sockets)
+        rss_after = rss_bytes()
+        result = {
+            'sockets':sockets,
+            'connect_seconds':round(elapsed,3),
+            'connects_per_second':round(sockets / elapsed,1) if elapsed else None,
+            'rss_bytes_per_socket':round((rss_after - rss_before) / sockets) if rss_before is not None else None,
+        }
+        if self.trace_memory:
+            result['traced_bytes_per_socket'] = round((tracemalloc.get_traced_memory()[0] - traced_before) / sockets)
+            tracemalloc.stop()
+        return result
+
+    async def read_chat(self,communicator):
+        while True:
+            event = await communicator.receive_json_from(timeout=3600)
+            if 'message' not in event:
+                # presence and typing events
+                continue
+            sent_at = self.sent_at.pop(event['message']['content'],None)
+            if sent_at is not None:
+                self.chat_latencies.append((time.perf_counter() - sent_at) * 1000)
+
+    async def read_notifications(self,communicator):
+        while True:
+            event = await communicator.receive_json_from(timeout=3600)
+            sent_at = self.sent_at.get(event['payload']['results']['message'])
+            if sent_at is not None:
+                self.notifications_received += 1
+                self.notification_latencies.append((time.perf_counter() - sent_at) * 1000)
+
+    def start_readers(self):
+        self.readers = [asyncio.ensure_future(self.read_chat(socket)) for socket in self.chat_sockets.values()]
+        self.readers += [asyncio.ensure_future(self.read_notifications(socket)) for socket in self.notification_sockets.values()]
+
+    async def drain(self,done,timeout):
+        deadline = time.perf_counter() + timeout
+        while not done() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def run_chat(self,messages,rate,drain_timeout):
+        # messages are paced on an absolute schedule so a slow send does not lower the rate
+        user_ids = list(self.chat_sockets)
+        interval = 1 / rate if rate else 0
+        started = time.perf_counter()
+        for i in range(messages):
+            if interval:
+                delay = started + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sender_id,recipient_id = self.rng.sample(user_ids,2)
+            content = f'load:{i}'
+            self.sent_at[content] = time.perf_counter()
+            await self.chat_sockets[sender_id].send_json_to({'recipient_id':recipient_id,'content':content})
+        send_seconds = time.perf_counter() - started
+
+        await self.drain(lambda: not self.sent_at,drain_timeout)
+        elapsed = time.perf_counter() - started
+        delivered = len(self.chat_latencies)
+        self.sent_at.clear()
+        return dict({
+            'sent':messages,
+            'delivered':delivered,
+            'lost':messages - delivered,
+            'target_rate':rate,
+            'send_rate':round(messages / send_seconds,1) if send_seconds else None,
+            'throughput_per_second':round(delivered / elapsed,1) if elapsed else None,
+        },**latency_summary(self.chat_latencies))
+
+    async def run_notifications(self,count,drain_timeout):
+        expected = count * len(self.notification_sockets)
+        started = time.perf_counter()
+        for i in range(count):
+            message = f'load notification {i}'
+            self.sent_at[message] = time.perf_counter()
+            # the fan-out job and its chunk jobs, run the way the job worker would run them
+            await sync_to_async(run_fan_out)(self.broadcaster.id,message)
+        await self.drain(lambda: self.notifications_received >= expected,drain_timeout)
+        elapsed = time.perf_counter() - started
+        self.sent_at.clear()
+        return dict({
+            'fan_outs':count,
+            'recipients':len(self.notification_sockets),
+            'expected':expected,
+            'delivered':self.notifications_received,
+            'lost':expected - self.notifications_received,
+            'throughput_per_second':round(self.notifications_received / elapsed,1) if elapsed else None,
+        },**latency_summary(self.notification_latencies))
+
+    async def close(self):
+        for reader in self.readers:
+            reader.cancel()
+        await asyncio.gather(*self.readers,return_exceptions=True)
+        sockets = list(self.chat_sockets.values()) + list(self.notification_sockets.values())
+        for start in range(0,len(sockets),self.connect_batch):
+            await asyncio.gather(*[socket.disconnect() for socket in sockets[start:start + self.connect_batch]],return_exceptions=True)
@@ -0,0 +1,94 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings,setup_test_environment,teardown_test_environment
+from django.utils import timezone
+from chat.loadtest import LoadTest,seed_users
+import asyncio
+import django
+import json
+import shutil
+import sys
+import tempfile
+
+
+class Command(BaseCommand):
+    help = 'Open authenticated chat and notification sockets against a throwaway test database and an in-memory channel layer, then measure delivery latency, throughput and memory per socket.'
+
+    def add_arguments(self,parser):
+        parser.add_argument('--connections',type=int,default=1000,help='Users connected, each with one chat and one notification socket.')
+        parser.add_argument('--messages',type=int,default=2000,help='Chat messages sent between random connected users.')
+        parser.add_argument('--rate',type=float,default=200.0,help='Chat messages per second; 0 sends as fast as possible.')
+        parser.add_argument('--notifications',type=int,default=3,help='Notification fan-outs to every connected user.')
+        parser.add_argument('--drain-timeout',type=float,default=60.0,help='Seconds to wait for outstanding deliveries.')
+        parser.add_argument('--connect-batch',type=int,default=100,help='Sockets opened concurrently.')
+        parser.add_argument('--capacity',type=int,default=10000,help='Per-channel capacity of the in-memory channel layer.')
+        parser.add_argument('--trace-memory',action='store_true',help='Also measure Python allocations per socket with tracemalloc (slow).')
+        parser.add_argument('--seed',type=int,default=0)
+        parser.add_argument('--output',help='Write the results as JSON to this file.')
+
+    def handle(self,*args,**options):
+        channel_layers = {'default':{
+            'BACKEND':'channels.layers.InMemoryChannelLayer',
+            'CONFIG':{'capacity':options['capacity']},
+        }}
+        # one process, presence and invalidation tokens do not need the Redis caches either
+        cache_dir = tempfile.mkdtemp(prefix='ws-loadtest-cache-')
+        caches = dict(
+            settings.CACHES,
+            presence={'BACKEND':'django.core.cache.backends.locmem.LocMemCache','LOCATION':'presence'},
+            shared={'BACKEND':'django.core.cache.backends.filebased.FileBasedCache','LOCATION':cache_dir},
+        )
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0,autoclobber=True,serialize=False)
+        try:
+            with override_settings(CHANNEL_LAYERS=channel_layers,CACHES=caches,JOBS={'ALWAYS_EAGER':False}):
+                results = self.run_loadtest(options)
+        finally:
+            connection.creation.destroy_test_db(old_name,verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(cache_dir,ignore_errors=True)
+
+        report = {
+            'meta':{
+                'created_at':timezone.now().isoformat(),
+                'django':django.get_version(),
+                'python':sys.version.split()[0],
+                'database':connection.vendor,
+                'options':{key:options[key] for key in ('connections','messages','rate','notifications','capacity','seed')},
+            },
+            **results,
+        }
+        if options['output']:
+            with open(options['output'],'w') as output:
+                json.dump(report,output,indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def run_loadtest(self,options):
+        # imported here so the routing is built once the in-memory layer is configured
+        from core.asgi import application
+
+        self.stdout.write(f"Seeding {options['connections']} users...")
+        broadcaster,users = seed_users(options['connections'])
+        loadtest = LoadTest(application,users,broadcaster,seed=options['seed'],connect_batch=options['connect_batch'],trace_memory=options['trace_memory'])
+        return asyncio.run(self.scenario(loadtest,options))
+
+    async def scenario(self,loadtest,options):
+        try:
+            connect = await loadtest.connect_all()
+            rss = connect['rss_bytes_per_socket']
+            self.stdout.write(f"connect        {connect['sockets']} sockets in {connect['connect_seconds']}s, {connect['connects_per_second']}/s, {rss if rss is not None else '?'} bytes RSS per socket")
+            if 'traced_bytes_per_socket' in connect:
+                self.stdout.write(f"               {connect['traced_bytes_per_socket']} bytes allocated per socket")
+            loadtest.start_readers()
+            chat = await loadtest.run_chat(options['messages'],options['rate'],options['drain_timeout'])
+            self.print_result('chat',chat)
+            notifications = await loadtest.run_notifications(options['notifications'],options['drain_timeout'])
+            self.print_result('notifications',notifications)
+        finally:
+            await loadtest.close()
+        return {'connect':connect,'chat':chat,'notifications':notifications}
+
+    def print_result(self,name,result):
+        line = f"{name:<15}{result['delivered']}/{result['delivered'] + result['lost']} delivered, {result['throughput_per_second']}/s, p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms"
+        self.stdout.write(self.style.ERROR(line) if result['lost'] else line)
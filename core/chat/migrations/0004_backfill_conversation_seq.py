@@ -0,0 +1,38 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:30
+
+from django.db import migrations
+
+
+def backfill_conversation_seq(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+    conversations = {}
+    last_seq = {}
+    pending = []
+    # numbered in the order the messages were sent
+    for message in ChatMessage.objects.order_by('created_at', 'id').only('id', 'sender_id', 'receiver_id').iterator(chunk_size=2000):
+        key = tuple(sorted((message.sender_id, message.receiver_id)))
+        if key not in conversations:
+            conversations[key] = Conversation.objects.create(user_low_id=key[0], user_high_id=key[1])
+            last_seq[key] = 0
+        last_seq[key] += 1
+        message.conversation = conversations[key]
+        message.seq = last_seq[key]
+        pending.append(message)
+        if len(pending) >= 2000:
+            ChatMessage.objects.bulk_update(pending, ['conversation', 'seq'])
+            pending = []
+    ChatMessage.objects.bulk_update(pending, ['conversation', 'seq'])
+    for key, conversation in conversations.items():
+        Conversation.objects.filter(id=conversation.id).update(last_seq=last_seq[key])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversation_seq, migrations.RunPython.noop),
+    ]
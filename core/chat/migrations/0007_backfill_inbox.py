@@ -0,0 +1,47 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:35
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_inbox(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+    Participant = apps.get_model('chat', 'Participant')
+    unread = {
+        (row['receiver_id'], row['sender_id']): row['total']
+        for row in ChatMessage.objects.filter(is_read=False).values('receiver_id', 'sender_id').annotate(total=Count('id'))
+    }
+    conversations = []
+    participants = []
+    for conversation in Conversation.objects.filter(last_seq__gt=0).iterator(chunk_size=2000):
+        message = ChatMessage.objects.filter(conversation=conversation).order_by('-seq').first()
+        if message is None:
+            continue
+        conversation.last_message = message
+        conversation.last_message_preview = message.content[:100]
+        conversation.last_message_at = message.created_at
+        conversations.append(conversation)
+        if conversation.user_low_id == conversation.user_high_id:
+            continue
+        for user_id, partner_id in ((conversation.user_low_id, conversation.user_high_id), (conversation.user_high_id, conversation.user_low_id)):
+            participants.append(Participant(
+                conversation=conversation,
+                user_id=user_id,
+                partner_id=partner_id,
+                unread_count=unread.get((user_id, partner_id), 0),
+                last_message_at=message.created_at,
+            ))
+    Conversation.objects.bulk_update(conversations, ['last_message', 'last_message_preview', 'last_message_at'], batch_size=500)
+    Participant.objects.bulk_create(participants, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_inbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_inbox, migrations.RunPython.noop),
+    ]
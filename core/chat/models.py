@@ -1,14 +1,81 @@
-from django.db import models
+from django.db import models,transaction
 from api.models import CustomUser
 
 # Create your models here.
 
+class Conversation(models.Model):
+    # one row per pair of users, the lower id first
+    user_low = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='+')
+    user_high = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='+')
+    last_seq = models.PositiveBigIntegerField(default=0)
+    last_message = models.ForeignKey('ChatMessage',on_delete=models.SET_NULL,null=True,blank=True,related_name='+')
+    last_message_preview = models.CharField(max_length=100,blank=True)
+    last_message_at = models.DateTimeField(null=True,blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low','user_high'],name='unique_conversation_pair'),
+        ]
+
+    def __str__(self):
+        return f"Conversation between {self.user_low_id} and {self.user_high_id}"
+
+
+
+
+class Participant(models.Model):
+    # one inbox entry per user and conversation, kept up to date by chat.conversations.record_messages
+    conversation = models.ForeignKey(Conversation,on_delete=models.CASCADE,related_name='participants')
+    user = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='conversations')
+    partner = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='+')
+    unread_count = models.PositiveIntegerField(default=0)
+    # copy of Conversation.last_message_at, so the inbox is one index range
+    last_message_at = models.DateTimeField(null=True,blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user','partner'],name='unique_participant'),
+        ]
+        indexes = [
+            models.Index(fields=['user','-last_message_at','-id'],name='participant_inbox_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} in conversation with {self.partner_id}"
+
+
+
+
 class ChatMessage(models.Model):
     sender = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='sent_messages')
     receiver = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='received_messages')
+    conversation = models.ForeignKey(Conversation,on_delete=models.CASCADE,related_name='messages')
+    # position in the conversation, allocated from Conversation.last_seq: increasing, not necessarily gapless
+    seq = models.PositiveBigIntegerField()
     content = models.TextField()
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # serves both directions of the ?after_seq= / ?before_seq= range reads
+            models.UniqueConstraint(fields=['conversation','seq'],name='unique_conversation_seq'),
+        ]
+        indexes = [
+            # both directions of a discussion, and the unread messages of one direction
+            models.Index(fields=['sender','receiver','-created_at'],name='chat_pair_recent_idx'),
+            models.Index(fields=['receiver','is_read'],name='chat_receiver_unread_idx'),
+        ]
+
+    def save(self,*args,**kwargs):
+        if not (self._state.adding and self.seq is None):
+            return super().save(*args,**kwargs)
+        # a single new message takes the same path as a batch from chat.delivery
+        from .conversations import assign_sequence,record_messages
+        with transaction.atomic():
+            assign_sequence([self])
+            super().save(*args,**kwargs)
+            record_messages([self])
+
     def __str__(self):
-        return f"Message from {self.sender.username} to {self.receiver.username}"
\ No newline at end of file
+        return f"Message from {self.sender.username} to {self.receiver.username}"
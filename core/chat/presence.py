@@ -0,0 +1,146 @@
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from collections import Counter
+from metrics.layers import timed_group_send
+from .conversations import conversation_key
+from .models import Participant
+import asyncio
+import time
+
+# Presence and typing indicators of ChatConsumer. A user is online while the shared
+# cache holds a positive count of their chat sockets; every process refreshes the
+# entries of its own sockets, so the sockets of a crashed process expire on their own.
+# Typing events are throttled per conversation and typist, across processes.
+
+
+DEFAULTS = {
+    'CACHE_ALIAS':'presence',  # must be shared between processes (Redis, Memcached), and not culled with other entries
+    'TIMEOUT':60,  # seconds a presence entry lives without being refreshed
+    'TYPING_INTERVAL':2.0,  # at most one typing broadcast per conversation and typist in this many seconds
+    'NOTIFY_PARTNERS':50,  # most recent inbox entries told when a user comes online or goes offline
+}
+
+
+def presence_setting(name):
+    return getattr(settings,'PRESENCE',{}).get(name,DEFAULTS[name])
+
+
+
+def presence_cache():
+    return caches[presence_setting('CACHE_ALIAS')]
+
+
+
+def presence_key(user_id):
+    return f'presence:{user_id}'
+
+
+
+# chat sockets per user in this process
+_local = Counter()
+_refresher = None
+
+
+def connect(user_id):
+    # True when this is the user's first socket anywhere
+    _local[user_id] += 1
+    cache = presence_cache()
+    key = presence_key(user_id)
+    cache.add(key,0,presence_setting('TIMEOUT'))
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # expired between add and incr
+        cache.set(key,1,presence_setting('TIMEOUT'))
+        count = 1
+    cache.touch(key,presence_setting('TIMEOUT'))
+    return count == 1
+
+
+
+def disconnect(user_id):
+    # True when the user has no socket left
+    _local[user_id] -= 1
+    if _local[user_id] <= 0:
+        del _local[user_id]
+    cache = presence_cache()
+    key = presence_key(user_id)
+    try:
+        count = cache.decr(key)
+    except ValueError:
+        return True
+    if count <= 0:
+        cache.delete(key)
+        return True
+    return False
+
+
+
+def refresh():
+    cache = presence_cache()
+    for user_id,count in list(_local.items()):
+        if not cache.touch(presence_key(user_id),presence_setting('TIMEOUT')):
+            cache.add(presence_key(user_id),count,presence_setting('TIMEOUT'))
+
+
+
+async def refresh_while_connected():
+    while _local:
+        await asyncio.sleep(presence_setting('TIMEOUT') / 3)
+        await sync_to_async(refresh)()
+
+
+
+def start_refresher():
+    global _refresher
+    if _refresher is None or _refresher.done():
+        _refresher = asyncio.ensure_future(refresh_while_connected())
+
+
+
+def online_many(user_ids):
+    # one cache round trip for a whole page of users
+    user_ids = list(user_ids)
+    counts = presence_cache().get_many([presence_key(user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if (counts.get(presence_key(user_id)) or 0) > 0}
+
+
+
+def recent_partner_ids(user_id):
+    return list(
+        Participant.objects.filter(user_id=user_id).order_by('-last_message_at','-id')
+        .values_list('partner_id',flat=True)[:presence_setting('NOTIFY_PARTNERS')]
+    )
+
+
+
+async def announce(channel_layer,user_id,online):
+    for partner_id in await database_sync_to_async(recent_partner_ids)(user_id):
+        await timed_group_send(channel_layer,f'chat_user_{partner_id}',{
+            'type':'chat_presence',
+            # the Redis channel layer packs events with msgpack, which only accepts string keys back
+            'online':{str(user_id):online},
+        })
+
+
+
+_typing = {}
+
+
+def allow_typing(sender_id,recipient_id):
+    # the local check absorbs bursts from one socket, the cache entry those from other processes
+    interval = presence_setting('TYPING_INTERVAL')
+    now = time.monotonic()
+    if now - _typing.get((sender_id,recipient_id),-interval) < interval:
+        return False
+    if len(_typing) > 10000:
+        for key in [key for key,sent_at in _typing.items() if now - sent_at >= interval]:
+            del _typing[key]
+    _typing[sender_id,recipient_id] = now
+    # only partners of an existing conversation see each other typing
+    if not Participant.objects.filter(user_id=sender_id,partner_id=recipient_id).exists():
+        return False
+    low,high = conversation_key(sender_id,recipient_id)
+    return presence_cache().add(f'typing:{low}:{high}:{sender_id}',1,interval)
@@ -1,3 +1,310 @@
-from django.test import TestCase
+from django.db import OperationalError,connection
+from django.test import override_settings
+from rest_framework.test import APIClient
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer,get_channel_layer
+from channels.testing import WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from api.testcases import APITestCase
+from core.consumers import ChatConsumer
+from .conversations import chat_unread,reconcile_unread
+from .delivery import MessageBuffer
+from .models import ChatMessage,Participant
+import asyncio
 
 # Create your tests here.
+
+
+class MsgpackChannelLayer(InMemoryChannelLayer):
+    # in-memory delivery, with every event packed and unpacked like RedisChannelLayer does
+
+    def __init__(self,**kwargs):
+        super().__init__(**kwargs)
+        self.redis_layer = RedisChannelLayer()
+
+    async def send(self,channel,message):
+        await super().send(channel,self.redis_layer.deserialize(self.redis_layer.serialize(message)))
+
+
+
+
+class RecordingBuffer(MessageBuffer):
+    # the size of every batch written
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    async def write(self,batch):
+        self.batches.append(len(batch))
+        return await super().write(batch)
+
+
+
+
+class FailingInserts:
+    # execute wrapper failing the next `count` inserts of chat messages, like a database that went away
+
+    def __init__(self,count):
+        self.count = count
+
+    def __call__(self,execute,sql,params,many,context):
+        if self.count and sql.startswith('INSERT INTO "chat_chatmessage"'):
+            self.count -= 1
+            raise OperationalError('database is locked')
+        return execute(sql,params,many,context)
+
+
+
+
+class ChatHistoryTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.viewer = self.create_user('viewer')
+        self.partner = self.create_user('partner')
+        for i in range(25):
+            sender,receiver = (self.viewer,self.partner) if i % 2 else (self.partner,self.viewer)
+            ChatMessage.objects.create(sender=sender,receiver=receiver,content=f'message {i}')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+
+    def seqs(self,response):
+        return [message['seq'] for message in response.data['results']]
+
+    def test_latest_page_and_scroll_back(self):
+        response = self.client.get(f'/api/discussions/{self.partner.id}/')
+        self.assertEqual(response.data['last_seq'],25)
+        self.assertEqual(self.seqs(response),list(range(15,26)))
+        self.assertEqual(response.data['results'][-1]['content'],'message 24')
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.seqs(response),list(range(4,15)))
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.seqs(response),[1,2,3])
+        self.assertIsNone(response.data['next'])
+
+    def test_after_seq_returns_only_missed_messages(self):
+        response = self.client.get(f'/api/discussions/{self.partner.id}/?after_seq=20')
+        self.assertEqual(self.seqs(response),[21,22,23,24,25])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(f'/api/discussions/{self.partner.id}/?after_seq=0&page_size=10')
+        self.assertEqual(self.seqs(response),list(range(1,11)))
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.seqs(response),list(range(11,21)))
+
+        # the other side of the conversation shares the numbering
+        ChatMessage.objects.create(sender=self.viewer,receiver=self.partner,content='late')
+        self.client.force_authenticate(user=self.partner)
+        response = self.client.get(f'/api/discussions/{self.viewer.id}/?after_seq=25')
+        self.assertEqual(self.seqs(response),[26])
+
+    def test_inbox_lists_conversations_by_recent_activity(self):
+        other = self.create_user('other')
+        ChatMessage.objects.create(sender=other,receiver=self.viewer,content='x' * 300)
+        queries,response = self.count_queries('/api/discussions/list/')
+        self.assertEqual([row['username'] for row in response.data['results']],['other','partner'])
+        self.assertEqual(response.data['results'][0]['last_message_preview'],'x' * 100)
+        self.assertEqual(response.data['results'][0]['unread_count'],1)
+        self.assertEqual(response.data['results'][1]['unread_count'],13)
+        self.assertEqual(response.data['results'][1]['last_seq'],25)
+
+        self.client.get(f'/api/discussions/seen/{self.partner.id}/')
+        ChatMessage.objects.create(sender=self.viewer,receiver=self.partner,content='back')
+        self.assertEqual(queries,self.count_queries('/api/discussions/list/')[0])
+        response = self.client.get('/api/discussions/list/?page_size=1')
+        self.assertEqual(response.data['results'][0]['username'],'partner')
+        self.assertEqual(response.data['results'][0]['unread_count'],0)
+        self.assertEqual(response.data['results'][0]['last_message_preview'],'back')
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['username'],'other')
+
+    def test_reconcile_unread(self):
+        Participant.objects.update(unread_count=20)
+        ChatMessage.objects.filter(receiver=self.partner,seq__lte=10).update(is_read=True)
+        self.assertEqual(reconcile_unread(),2)
+        self.assertEqual(chat_unread(self.viewer.id,self.partner.id),13)
+        self.assertEqual(chat_unread(self.partner.id,self.viewer.id),7)
+        self.assertEqual(reconcile_unread(),0)
+
+    def test_invalid_seq(self):
+        response = self.client.get(f'/api/discussions/{self.partner.id}/?after_seq=-1')
+        self.assertEqual(response.status_code,404)
+
+
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default':{'BACKEND':'chat.tests.MsgpackChannelLayer'}},
+    PRESENCE={'TYPING_INTERVAL':0},
+)
+class PresenceTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.viewer = self.create_user('viewer')
+        self.partner = self.create_user('partner')
+        self.stranger = self.create_user('stranger')
+        ChatMessage.objects.create(sender=self.viewer,receiver=self.partner,content='hello')
+
+    async def open(self,user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(),'/ws/chat/')
+        communicator.scope['user'] = user
+        connected,code = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_presence_and_typing_events(self):
+        async def scenario():
+            partner = await self.open(self.partner)
+            viewer = await self.open(self.viewer)
+            # events cross the channel layer as msgpack, whose maps only come back with string keys
+            self.assertEqual(await partner.receive_json_from(),{'event':'presence','online':{str(self.viewer.id):True}})
+
+            await viewer.send_json_to({'type':'typing','recipient_id':self.partner.id})
+            self.assertEqual(await partner.receive_json_from(),{'event':'typing','user_id':self.viewer.id})
+            # no conversation, no typing indicator
+            stranger = await self.open(self.stranger)
+            await stranger.send_json_to({'type':'typing','recipient_id':self.partner.id})
+            self.assertTrue(await partner.receive_nothing())
+
+            await viewer.disconnect()
+            self.assertEqual(await partner.receive_json_from(),{'event':'presence','online':{str(self.viewer.id):False}})
+            await stranger.disconnect()
+            await partner.disconnect()
+        async_to_sync(scenario)()
+
+
+
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default':{'BACKEND':'chat.tests.MsgpackChannelLayer'}},
+    CHAT={'FLUSH_INTERVAL':0.01,'MAX_BATCH':3,'MAX_PENDING':100,'FLUSH_ATTEMPTS':3,'RETRY_DELAY':0.001},
+)
+class MessageBufferTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.cards = {self.alice.id:{'username':'alice'},self.bob.id:{'username':'bob'}}
+
+    async def listen(self,user):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(f'chat_user_{user.id}',channel)
+        return channel
+
+    async def received(self,channel,count):
+        layer = get_channel_layer()
+        return [await asyncio.wait_for(layer.receive(channel),1) for i in range(count)]
+
+    async def send(self,buffer,sender,recipient,content):
+        await buffer.add(sender,recipient.id,content,self.cards[sender.id])
+
+    def stored(self):
+        return list(ChatMessage.objects.order_by('conversation','seq').values_list('sender__username','content','seq'))
+
+    def test_batches_by_size_and_interval(self):
+        async def scenario():
+            bob = await self.listen(self.bob)
+            buffer = RecordingBuffer()
+            for i in range(7):
+                await self.send(buffer,self.alice,self.bob,f'message {i}')
+            # nothing is written before the flusher runs
+            self.assertEqual(buffer.batches,[])
+            await buffer.drain()
+            # full batches go at once, the remainder after FLUSH_INTERVAL
+            self.assertEqual(buffer.batches,[3,3,1])
+            events = await self.received(bob,7)
+            self.assertEqual([event['message']['content'] for event in events],[f'message {i}' for i in range(7)])
+            self.assertEqual(events[0]['message']['sender'],{'username':'alice'})
+        async_to_sync(scenario)()
+        self.assertEqual([content for sender,content,seq in self.stored()],[f'message {i}' for i in range(7)])
+
+    def test_order_and_sequence_across_interleaved_flushes(self):
+        async def scenario():
+            alice,bob = await self.listen(self.alice),await self.listen(self.bob)
+            buffer = RecordingBuffer()
+            for i in range(10):
+                sender,recipient = (self.alice,self.bob) if i % 3 else (self.bob,self.alice)
+                await self.send(buffer,sender,recipient,f'message {i}')
+                if i % 4 == 3:
+                    # let a flush start while more messages come in
+                    await asyncio.sleep(0.015)
+            await buffer.drain()
+            self.assertGreater(len(buffer.batches),3)
+            to_bob = [event['message'] for event in await self.received(bob,6)]
+            to_alice = [event['message'] for event in await self.received(alice,4)]
+            self.assertEqual([message['content'] for message in to_bob],[f'message {i}' for i in range(10) if i % 3])
+            self.assertEqual([message['content'] for message in to_alice],[f'message {i}' for i in range(10) if not i % 3])
+            return to_bob + to_alice
+        delivered = async_to_sync(scenario)()
+
+        # one conversation, numbered in the order the messages were received
+        stored = self.stored()
+        self.assertEqual([content for sender,content,seq in stored],[f'message {i}' for i in range(10)])
+        self.assertEqual([seq for sender,content,seq in stored],sorted({seq for sender,content,seq in stored}))
+        self.assertEqual(sorted(message['seq'] for message in delivered),[seq for sender,content,seq in stored])
+
+    @override_settings(CHAT={'FLUSH_INTERVAL':0.05,'MAX_BATCH':500,'MAX_PENDING':3})
+    def test_receivers_wait_while_the_buffer_is_full(self):
+        async def scenario():
+            buffer = MessageBuffer()
+            for i in range(3):
+                await self.send(buffer,self.alice,self.bob,f'message {i}')
+            blocked = asyncio.ensure_future(self.send(buffer,self.alice,self.bob,'message 3'))
+            await asyncio.sleep(0.01)
+            self.assertFalse(blocked.done())
+            self.assertEqual(len(buffer.pending),3)
+            # room is made as soon as the flusher takes the batch
+            await asyncio.wait_for(blocked,1)
+            await buffer.drain()
+        async_to_sync(scenario)()
+        self.assertEqual([content for sender,content,seq in self.stored()],[f'message {i}' for i in range(4)])
+
+    @override_settings(CHAT={'FLUSH_INTERVAL':0.2})
+    def test_disconnect_flushes_the_buffer(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(),'/ws/chat/')
+            communicator.scope['user'] = self.alice
+            connected,code = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'recipient_id':self.bob.id,'content':'goodbye'})
+            await communicator.disconnect()
+        async_to_sync(scenario)()
+        # stored by the time the socket is gone, not FLUSH_INTERVAL later
+        self.assertEqual([content for sender,content,seq in self.stored()],['goodbye'])
+
+    def test_failed_insert_is_retried_in_order(self):
+        async def scenario():
+            bob = await self.listen(self.bob)
+            buffer = RecordingBuffer()
+            for i in range(4):
+                await self.send(buffer,self.alice,self.bob,f'message {i}')
+            await buffer.drain()
+            self.assertEqual(buffer.batches,[3,3,3,1])
+            events = await self.received(bob,4)
+            self.assertEqual([event['message']['content'] for event in events],[f'message {i}' for i in range(4)])
+        with self.assertLogs('chat.delivery','ERROR'),connection.execute_wrapper(FailingInserts(2)):
+            async_to_sync(scenario)()
+        self.assertEqual([content for sender,content,seq in self.stored()],[f'message {i}' for i in range(4)])
+
+    def test_sender_is_told_when_attempts_run_out(self):
+        async def scenario():
+            alice,bob = await self.listen(self.alice),await self.listen(self.bob)
+            buffer = RecordingBuffer()
+            await self.send(buffer,self.alice,self.bob,'lost')
+            await buffer.drain()
+            self.assertEqual(buffer.batches,[1,1,1])
+            self.assertEqual(await self.received(alice,1),[{'type':'chat_failed','recipient_id':self.bob.id,'content':'lost'}])
+            # the buffer keeps working once the database is back
+            await self.send(buffer,self.alice,self.bob,'kept')
+            await buffer.drain()
+            self.assertEqual([event['message']['content'] for event in await self.received(bob,1)],['kept'])
+        with self.assertLogs('chat.delivery','ERROR') as logs,connection.execute_wrapper(FailingInserts(3)):
+            async_to_sync(scenario)()
+        self.assertIn('Gave up on 1 chat messages after 3 failed flushes',logs.output[-1])
+        self.assertEqual([content for sender,content,seq in self.stored()],['kept'])
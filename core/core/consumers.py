@@ -1,23 +1,20 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 import json
 from channels.exceptions import DenyConnection
-from chat.models import ChatMessage
-from api.models import CustomUser
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async
-from api.serializers import ChatMessageSerializer
+from asgiref.sync import sync_to_async
+from chat import presence
+from chat.delivery import get_buffer,is_known_user,sender_card
+from metrics import sockets
+from metrics.consumers import MeteredConsumerMixin
+from metrics.layers import timed_group_send
 
 
 
 
 
-def serialize_message(message,user):
-    serializer = ChatMessageSerializer(message,context={'user':user})
-    return serializer.data
-
-
-
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(MeteredConsumerMixin,AsyncWebsocketConsumer):
     async def connect(self):
         if self.scope["user"].is_authenticated:
             self.room_group_name = f'notifications_user_{self.scope["user"].id}'
@@ -37,7 +34,6 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.room_group_name,
                 self.channel_name
             )
-            print('disconnected with code: ',code)
     
     async def receive(self, text_data):
         data = json.loads(text_data)
@@ -50,35 +46,74 @@ class NotificationConsumer(AsyncWebsocketConsumer):
 
 
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+class ChatConsumer(MeteredConsumerMixin,AsyncJsonWebsocketConsumer):
     async def connect(self):
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
         self.room_name = f"chat_user_{self.scope['user'].id}"
+        # rendered once, every message of this connection reuses it
+        self.sender_card = await database_sync_to_async(sender_card)(self.scope['user'])
         await self.channel_layer.group_add(self.room_name,self.channel_name)
         await self.accept()
+        if await sync_to_async(presence.connect)(self.scope['user'].id):
+            await presence.announce(self.channel_layer,self.scope['user'].id,True)
+        presence.start_refresher()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_name,self.channel_name)
+        if hasattr(self,'room_name'):
+            # what this socket sent is stored before it goes, also when the server shuts down
+            await get_buffer().drain()
+            await self.channel_layer.group_discard(self.room_name,self.channel_name)
+            if await sync_to_async(presence.disconnect)(self.scope['user'].id):
+                await presence.announce(self.channel_layer,self.scope['user'].id,False)
 
 
 
     async def receive(self,text_data):
         data = json.loads(text_data)
-        recipient_id = data['recipient_id']
-        message_content = data['content']
-
-        recipient = await database_sync_to_async(CustomUser.objects.get)(id=recipient_id)
-        message = await database_sync_to_async( ChatMessage.objects.create)(sender=self.scope['user'],
-        receiver=recipient,content=message_content)
-        serializer = await database_sync_to_async(serialize_message)(message=message,user=self.scope['user'])
-
-        await self.channel_layer.group_send(
-            f"chat_user_{recipient_id}",
-            {
-                'type':'chat_message',
-                'alert':f"{self.scope['user'].username} sent you a message!",
-                'message':serializer
-            },
-        )
+        kind = data.get('type','message')
+        if kind == 'typing':
+            await self.handle_typing(data)
+            return
+        if kind == 'presence':
+            await self.handle_presence(data)
+            return
+
+        try:
+            recipient_id = int(data['recipient_id'])
+            message_content = str(data['content'])
+        except (KeyError,TypeError,ValueError):
+            await self.send_json({'error':'recipient_id and content are required.'})
+            return
+
+        if not await is_known_user(recipient_id):
+            await self.send_json({'error':'Recipient not found.'})
+            return
+        # stored and delivered by the write-behind buffer a few milliseconds later
+        await get_buffer().add(self.scope['user'],recipient_id,message_content,self.sender_card)
+
+    async def handle_typing(self,data):
+        try:
+            recipient_id = int(data['recipient_id'])
+        except (KeyError,TypeError,ValueError):
+            await self.send_json({'error':'recipient_id is required.'})
+            return
+        # bursts of keystrokes become at most one broadcast per TYPING_INTERVAL
+        if await database_sync_to_async(presence.allow_typing)(self.scope['user'].id,recipient_id):
+            await timed_group_send(self.channel_layer,f'chat_user_{recipient_id}',{
+                'type':'chat_typing',
+                'user_id':self.scope['user'].id,
+            })
+
+    async def handle_presence(self,data):
+        try:
+            user_ids = [int(user_id) for user_id in data['user_ids']][:100]
+        except (KeyError,TypeError,ValueError):
+            await self.send_json({'error':'user_ids is required.'})
+            return
+        online = await sync_to_async(presence.online_many)(user_ids)
+        await self.send_json({'event':'presence','online':{user_id:user_id in online for user_id in user_ids}})
 
     
 
@@ -91,6 +126,14 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             'alert':alert,
             'message':message,
         }))
+        if 'stored_at' in event:
+            sockets.observe_delivery(event['stored_at'])
 
+    async def chat_failed(self,event):
+        await self.send_json({'error':'Message could not be sent.','recipient_id':event['recipient_id'],'content':event['content']})
 
+    async def chat_typing(self,event):
+        await self.send_json({'event':'typing','user_id':event['user_id']})
 
+    async def chat_presence(self,event):
+        await self.send_json({'event':'presence','online':event['online']})
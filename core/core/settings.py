@@ -47,10 +47,14 @@ INSTALLED_APPS = [
     'corsheaders',
     'notifications',
     'chat',
+    'timelines',
+    'jobs',
+    'metrics',
 
 ]
 
 MIDDLEWARE = [
+    'metrics.middleware.RequestMetricsMiddleware',  # a no-op unless REQUEST_METRICS['ENABLED']
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -87,10 +91,132 @@ CHANNEL_LAYERS = {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG":{
             "hosts":[("127.0.0.1",6379)],
+            #messages a channel holds before ChannelFull; exported with the socket metrics
+            "capacity":100,
         },
     }
 }
 
+#Home timelines (fan-out on write)
+TIMELINES = {
+    'BACKEND': 'timelines.backends.DatabaseTimelineBackend',  # or MemoryTimelineBackend / RedisTimelineBackend
+    'OPTIONS': {},  # e.g. {'url': 'redis://127.0.0.1:6379/1'} for the redis backend
+    'MAX_LENGTH': 500,  # entries kept per user
+    'FANOUT_FOLLOWER_THRESHOLD': 5000,  # authors with more followers are merged in at read time
+    'FANOUT_CHUNK_SIZE': 1000,
+}
+
+#Notification fan-out (runs on the job worker)
+NOTIFICATIONS = {
+    'CHUNK_SIZE': 500,  # recipients inserted and pushed per job
+}
+
+#Background jobs: run the worker with `python manage.py run_jobs`
+JOBS = {
+    'ALWAYS_EAGER': False,  # True runs jobs in-process after commit (no worker needed)
+    'CONCURRENCY': 4,
+    'EXECUTOR': 'thread',  # or 'process'
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 10,
+    'PERIODIC': {
+        'notifications.counters.reconcile_unread_counters': 3600,
+        'api.uploads.purge_uploads': 3600,
+        'timelines.utils.trim_timelines': 3600,
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    #anonymous response data (see api.response_cache); for one copy per host instead of per
+    #worker: 'django.core.cache.backends.filebased.FileBasedCache' with LOCATION a directory
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    #online users and typing throttles (see chat.presence), shared by every ASGI process
+    'presence': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/2',
+    },
+    #invalidation tokens (see api.response_cache, api.follow_cache), bumped by web and job
+    #processes alike and read by all of them; a per-process backend is refused at startup
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/3',
+    },
+}
+
+#Anonymous feed, profile and user posts responses, invalidated per post, user and list
+RESPONSE_CACHE = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'responses',
+    'VERSION_ALIAS': 'shared',
+    'TIMEOUT': 300,
+}
+
+#Viewer-independent post fragments shared by feed, user posts and notifications (see
+#api.fragments); the viewer's flags are overlaid per request
+POST_FRAGMENTS = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'responses',
+    'TIMEOUT': 3600,
+}
+
+#Conditional GET on profile, user posts and followers (see api.etags), revalidated from the
+#RESPONSE_CACHE tag versions without running queries or serializers
+ETAGS = {
+    'ENABLED': True,
+    'TIMEOUT': 86400,
+}
+
+#Per-process follow-set cache (see api.follow_cache); the version tokens live in the
+#shared CACHE_ALIAS
+FOLLOW_CACHE = {
+    'CACHE_ALIAS': 'shared',
+    'MAX_ENTRIES': 10000,
+}
+
+CHAT = {
+    'FLUSH_INTERVAL': 0.005,
+    'MAX_BATCH': 500,
+    'MAX_PENDING': 5000,
+    'FLUSH_ATTEMPTS': 5,
+    'RETRY_DELAY': 0.1,
+    'KNOWN_USERS': 100000,
+}
+
+PRESENCE = {
+    'CACHE_ALIAS': 'presence',
+    'TIMEOUT': 60,
+    'TYPING_INTERVAL': 2.0,
+    'NOTIFY_PARTNERS': 50,
+}
+
+#Per-request SQL, serializer and group_send timings (see metrics.requests), exposed as a
+#Server-Timing header and per route at /api/metrics/requests/ for admins
+REQUEST_METRICS = {
+    'ENABLED': False,
+    'SERVER_TIMING': True,
+    'SAMPLE_RATE': 0.01,
+    'LOG_FILE': BASE_DIR / 'request_metrics.log',
+}
+
+#Open sockets, frame rates, group_send latency and chat delivery time (see metrics.sockets),
+#in Prometheus text format at /api/metrics/sockets/ for admins or a scraper sending the token
+SOCKET_METRICS = {
+    'SCRAPE_TOKEN': os.environ.get('METRICS_SCRAPE_TOKEN'),
+}
+
+#Chunked media uploads (see api.uploads)
+UPLOADS = {
+    'CHUNK_SIZE': 4 * 1024 * 1024,
+    'MAX_SIZE': 512 * 1024 * 1024,
+    'EXPIRE_AFTER': 86400,
+}
+
 ASGI_APPLICATION = 'core.asgi.application'
 
 WSGI_APPLICATION = 'core.wsgi.application'
@@ -19,11 +19,13 @@ from django.urls import path,include
 from django.conf.urls.static import static
 from django.conf import settings
 from api import urls as api_urls
+from metrics import urls as metrics_urls
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(api_urls)),
+    path('api/metrics/', include(metrics_urls)),
 ]
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,9 @@
+from django.contrib import admin
+from .models import Job
+
+# Register your models here.
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id','name','status','attempts','run_at','created_at')
+    list_filter = ('status','name')
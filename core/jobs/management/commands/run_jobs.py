@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from jobs.worker import Worker
+
+
+class Command(BaseCommand):
+    help = 'Run the background job worker.'
+
+    def add_arguments(self,parser):
+        parser.add_argument('--concurrency',type=int,help='Jobs executed at the same time (default JOBS["CONCURRENCY"]).')
+        parser.add_argument('--executor',choices=['thread','process'],help='Pool used to execute jobs (default JOBS["EXECUTOR"]).')
+        parser.add_argument('--poll-interval',type=float,help='Seconds between queue polls when idle.')
+        parser.add_argument('--once',action='store_true',help='Exit once the queue is empty.')
+
+    def handle(self,*args,**options):
+        worker = Worker(concurrency=options['concurrency'],executor=options['executor'],poll_interval=options['poll_interval'])
+        self.stdout.write(f'Worker started ({worker.executor} pool, concurrency {worker.concurrency})')
+        try:
+            worker.run(once=options['once'])
+        except KeyboardInterrupt:
+            self.stdout.write('Worker stopped')
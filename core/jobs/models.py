@@ -0,0 +1,38 @@
+from django.db import models
+from django.utils import timezone
+
+# Create your models here.
+
+class Job(models.Model):
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (PENDING,'Pending'),
+        (RUNNING,'Running'),
+        (DONE,'Done'),
+        (FAILED,'Failed'),
+    ]
+
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list,blank=True)
+    kwargs = models.JSONField(default=dict,blank=True)
+    status = models.CharField(max_length=10,choices=STATUS_CHOICES,default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True,blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True,blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status','run_at'],name='job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.status})'
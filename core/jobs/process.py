@@ -0,0 +1,13 @@
+# Entry points for the 'process' executor. Spawned children unpickle these by module path
+# before Django is set up, so this module must not import models at load time.
+
+
+def init_process():
+    import django
+    django.setup()
+
+
+
+def run_job(job_id):
+    from .worker import run_job
+    return run_job(job_id)
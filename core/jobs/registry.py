@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Job
+
+
+DEFAULTS = {
+    'ALWAYS_EAGER':False,  # run jobs in-process after commit instead of queueing them
+    'CONCURRENCY':4,
+    'EXECUTOR':'thread',  # or 'process'
+    'POLL_INTERVAL':1.0,
+    'MAX_ATTEMPTS':3,
+    'RETRY_DELAY':10,  # seconds, doubled after every failed attempt
+    'LOCK_TIMEOUT':600,  # running jobs older than this are considered abandoned
+    'KEEP_DONE':86400,  # finished jobs are purged after this many seconds
+    'PERIODIC':{},  # {task name: interval in seconds}, enqueued by the worker's maintenance pass
+}
+
+
+def job_setting(name):
+    return getattr(settings,'JOBS',{}).get(name,DEFAULTS[name])
+
+
+
+registry = {}
+
+
+
+class Task:
+
+    def __init__(self,func,name,max_attempts=None):
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+
+    def __call__(self,*args,**kwargs):
+        return self.func(*args,**kwargs)
+
+    def enqueue(self,*args,run_at=None,**kwargs):
+        # the job row is written in the caller's transaction: it only becomes
+        # visible to workers if the surrounding writes commit
+        if job_setting('ALWAYS_EAGER'):
+            transaction.on_commit(lambda: self.func(*args,**kwargs),robust=True)
+            return None
+        return Job.objects.create(
+            name=self.name,
+            args=list(args),
+            kwargs=kwargs,
+            max_attempts=self.max_attempts or job_setting('MAX_ATTEMPTS'),
+            run_at=run_at or timezone.now()
+        )
+
+
+
+def task(func=None,*,max_attempts=None):
+    # @task or @task(max_attempts=5); the job name is the dotted path of the function
+    def decorator(func):
+        name = f'{func.__module__}.{func.__name__}'
+        registry[name] = Task(func,name,max_attempts)
+        return registry[name]
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+
+def get_task(name):
+    if name not in registry:
+        # importing the module runs its @task decorators
+        import_string(name)
+    return registry[name]
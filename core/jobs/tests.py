@@ -0,0 +1,91 @@
+from django.test import TestCase,override_settings
+from django.utils import timezone
+from datetime import timedelta
+from .models import Job
+from .registry import get_task,task
+from .worker import Worker,claim_jobs,run_job
+
+# Create your tests here.
+
+
+calls = []
+
+
+@task
+def record(value=None,label=None):
+    calls.append((value,label))
+
+
+
+@task(max_attempts=2)
+def explode():
+    raise ValueError('boom')
+
+
+
+
+@override_settings(JOBS={'RETRY_DELAY':10,'LOCK_TIMEOUT':600,'PERIODIC':{'jobs.tests.record':60}})
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        calls.clear()
+
+    def test_registry_and_enqueue(self):
+        self.assertIs(get_task('jobs.tests.record'),record)
+        job = record.enqueue(1,label='one')
+        self.assertEqual((job.name,job.args,job.kwargs,job.max_attempts,job.status),('jobs.tests.record',[1],{'label':'one'},3,Job.PENDING))
+        self.assertEqual(explode.enqueue().max_attempts,2)
+        # calling the task runs it in-process
+        record(2)
+        self.assertEqual(calls,[(2,None)])
+
+    def test_claim_and_run(self):
+        due = record.enqueue(1)
+        record.enqueue(2,run_at=timezone.now() + timedelta(hours=1))
+        self.assertEqual(claim_jobs(10),[due.id])
+        self.assertEqual(claim_jobs(10),[])
+        due.refresh_from_db()
+        self.assertEqual((due.status,due.attempts),(Job.RUNNING,1))
+
+        run_job(due.id)
+        due.refresh_from_db()
+        self.assertEqual(due.status,Job.DONE)
+        self.assertIsNotNone(due.finished_at)
+        self.assertEqual(calls,[(1,None)])
+
+    def test_retry_with_backoff_then_fail(self):
+        job = explode.enqueue()
+        claim_jobs(1)
+        run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status,job.attempts),(Job.PENDING,1))
+        self.assertIn('ValueError: boom',job.last_error)
+        self.assertAlmostEqual((job.run_at - timezone.now()).total_seconds(),10,delta=2)
+
+        Job.objects.filter(id=job.id).update(run_at=timezone.now())
+        claim_jobs(1)
+        run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status,job.attempts),(Job.FAILED,2))
+
+    def test_stale_locks(self):
+        stale = timezone.now() - timedelta(seconds=601)
+        retried = Job.objects.create(name='jobs.tests.record',args=[1],status=Job.RUNNING,attempts=1,max_attempts=3,locked_at=stale)
+        exhausted = Job.objects.create(name='jobs.tests.record',args=[2],status=Job.RUNNING,attempts=3,max_attempts=3,locked_at=stale)
+        running = Job.objects.create(name='jobs.tests.record',args=[3],status=Job.RUNNING,attempts=3,max_attempts=3,locked_at=timezone.now())
+        Worker().maintenance()
+        statuses = dict(Job.objects.filter(id__in=[retried.id,exhausted.id,running.id]).values_list('id','status'))
+        self.assertEqual(statuses,{retried.id:Job.PENDING,exhausted.id:Job.FAILED,running.id:Job.RUNNING})
+
+    def test_periodic_tasks_are_scheduled_once(self):
+        Worker().maintenance()
+        Worker().maintenance()
+        self.assertEqual(Job.objects.filter(name='jobs.tests.record',status=Job.PENDING).count(),1)
+
+    @override_settings(JOBS={'ALWAYS_EAGER':True})
+    def test_always_eager_runs_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertIsNone(record.enqueue(1,label='eager'))
+            self.assertEqual(calls,[])
+        self.assertEqual(calls,[(1,'eager')])
+        self.assertFalse(Job.objects.exists())
@@ -0,0 +1,109 @@
+from concurrent.futures import FIRST_COMPLETED,ProcessPoolExecutor,ThreadPoolExecutor,wait
+from datetime import timedelta
+from django.db import connection,connections,transaction
+from django.db.models import F,Q
+from django.utils import timezone
+from .models import Job
+from .registry import get_task,job_setting
+from . import process
+import multiprocessing
+import logging
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+
+def claim_jobs(limit):
+    now = timezone.now()
+    candidates = Job.objects.filter(status=Job.PENDING,run_at__lte=now).order_by('run_at','id')
+    claim = {'status':Job.RUNNING,'locked_at':now,'attempts':F('attempts') + 1}
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job_ids = list(candidates.select_for_update(skip_locked=True).values_list('id',flat=True)[:limit])
+            Job.objects.filter(id__in=job_ids).update(**claim)
+        return job_ids
+
+    # no SKIP LOCKED (sqlite): a conditional update lets exactly one worker move a job out of PENDING
+    claimed = []
+    for job_id in candidates.values_list('id',flat=True)[:limit]:
+        if Job.objects.filter(id=job_id,status=Job.PENDING).update(**claim):
+            claimed.append(job_id)
+    return claimed
+
+
+
+def run_job(job_id):
+    try:
+        job = Job.objects.get(id=job_id)
+        try:
+            get_task(job.name)(*job.args,**job.kwargs)
+        except Exception:
+            error = traceback.format_exc()
+            if job.attempts < job.max_attempts:
+                delay = job_setting('RETRY_DELAY') * 2 ** (job.attempts - 1)
+                Job.objects.filter(id=job_id).update(status=Job.PENDING,run_at=timezone.now() + timedelta(seconds=delay),last_error=error)
+            else:
+                Job.objects.filter(id=job_id).update(status=Job.FAILED,finished_at=timezone.now(),last_error=error)
+                logger.error('Job %s (%s) failed after %s attempts', job_id, job.name, job.attempts)
+        else:
+            Job.objects.filter(id=job_id).update(status=Job.DONE,finished_at=timezone.now())
+    finally:
+        connections.close_all()
+
+
+
+def schedule_periodic(now):
+    # a periodic task is enqueued again once its previous job is older than the interval
+    for name,interval in job_setting('PERIODIC').items():
+        recent = Job.objects.filter(name=name).filter(
+            Q(status__in=[Job.PENDING,Job.RUNNING]) | Q(created_at__gte=now - timedelta(seconds=interval))
+        )
+        if not recent.exists():
+            get_task(name).enqueue()
+
+
+
+class Worker:
+
+    def __init__(self,concurrency=None,executor=None,poll_interval=None):
+        self.concurrency = concurrency or job_setting('CONCURRENCY')
+        self.executor = executor or job_setting('EXECUTOR')
+        self.poll_interval = poll_interval or job_setting('POLL_INTERVAL')
+        self.last_maintenance = 0
+
+    def make_pool(self):
+        if self.executor == 'process':
+            # spawned children set Django up themselves instead of sharing forked connections
+            return ProcessPoolExecutor(max_workers=self.concurrency,mp_context=multiprocessing.get_context('spawn'),initializer=process.init_process)
+        return ThreadPoolExecutor(max_workers=self.concurrency,thread_name_prefix='jobs')
+
+    def maintenance(self):
+        now = timezone.now()
+        # the attempt of an abandoned job was counted when it was claimed
+        stale = Job.objects.filter(status=Job.RUNNING,locked_at__lt=now - timedelta(seconds=job_setting('LOCK_TIMEOUT')))
+        stale.filter(attempts__gte=F('max_attempts')).update(status=Job.FAILED,finished_at=now,last_error='Lock timed out on the last attempt')
+        stale.filter(attempts__lt=F('max_attempts')).update(status=Job.PENDING)
+        Job.objects.filter(status=Job.DONE,finished_at__lt=now - timedelta(seconds=job_setting('KEEP_DONE'))).delete()
+        schedule_periodic(now)
+        self.last_maintenance = time.monotonic()
+
+    def run(self,once=False):
+        # once=True drains the queue and returns instead of polling forever
+        in_flight = set()
+        with self.make_pool() as pool:
+            while True:
+                if time.monotonic() - self.last_maintenance > 60:
+                    self.maintenance()
+                claimed = claim_jobs(self.concurrency - len(in_flight)) if len(in_flight) < self.concurrency else []
+                job_runner = process.run_job if self.executor == 'process' else run_job
+                for job_id in claimed:
+                    in_flight.add(pool.submit(job_runner,job_id))
+                if once and not in_flight and not claimed:
+                    return
+                if in_flight:
+                    done,in_flight = wait(in_flight,timeout=self.poll_interval,return_when=FIRST_COMPLETED)
+                elif not claimed:
+                    time.sleep(self.poll_interval)
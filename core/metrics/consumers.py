@@ -0,0 +1,24 @@
+from . import sockets
+
+
+class MeteredConsumerMixin:
+    # counts sockets and frames of a websocket consumer in metrics.sockets, by class name
+
+    async def accept(self,*args,**kwargs):
+        await super().accept(*args,**kwargs)
+        sockets.connected(type(self).__name__)
+        self.metered = True
+
+    async def websocket_receive(self,message):
+        sockets.received(type(self).__name__)
+        await super().websocket_receive(message)
+
+    async def send(self,*args,**kwargs):
+        sockets.sent(type(self).__name__)
+        await super().send(*args,**kwargs)
+
+    async def websocket_disconnect(self,message):
+        if getattr(self,'metered',False):
+            self.metered = False
+            sockets.disconnected(type(self).__name__)
+        await super().websocket_disconnect(message)
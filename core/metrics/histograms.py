@@ -0,0 +1,44 @@
+import bisect
+
+# In-process histograms with fixed bucket bounds. Callers hold their own lock; each
+# worker process keeps its own, so a scrape only sees what that process served.
+
+
+# upper bounds in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS = (1,2,5,10,25,50,100,250,500,1000,2500,5000,10000)
+
+
+class Histogram:
+
+    def __init__(self,bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.bounds,value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self,percent):
+        # upper bound of the bucket holding the percentile, None past the last bound
+        if not self.count:
+            return None
+        rank = self.count * percent / 100
+        seen = 0
+        for bound,count in zip(self.bounds + (None,),self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def summary(self):
+        return {
+            'count':self.count,
+            'mean':round(self.sum / self.count,3) if self.count else None,
+            'p50':self.percentile(50),
+            'p95':self.percentile(95),
+            'p99':self.percentile(99),
+            'buckets':dict(zip([str(bound) for bound in self.bounds] + ['+Inf'],self.counts)),
+        }
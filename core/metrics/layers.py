@@ -0,0 +1,17 @@
+from . import sockets
+from .requests import record_group_send
+import time
+
+# channel_layer.group_send with timing; every group_send of the project goes through here.
+
+
+async def timed_group_send(channel_layer,group,message):
+    started = time.perf_counter()
+    failed = True
+    try:
+        await channel_layer.group_send(group,message)
+        failed = False
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        record_group_send(elapsed_ms)
+        sockets.observe_group_send(group,elapsed_ms,failed)
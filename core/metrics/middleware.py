@@ -0,0 +1,50 @@
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from contextlib import ExitStack
+from .requests import QueryTimer,RequestTimings,current,install_serializer_hooks,log_sample,observe,request_metrics_setting,server_timing
+import random
+import time
+
+
+class RequestMetricsMiddleware:
+    # removed from the stack at startup unless REQUEST_METRICS['ENABLED'] is set
+
+    def __init__(self,get_response):
+        if not request_metrics_setting('ENABLED'):
+            raise MiddlewareNotUsed()
+        install_serializer_hooks()
+        self.get_response = get_response
+
+    def __call__(self,request):
+        timings = RequestTimings()
+        token = current.set(timings)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(QueryTimer(timings)))
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+
+        total_ms = timings.elapsed_ms()
+        size = len(response.content) if not response.streaming else None
+        if request_metrics_setting('SERVER_TIMING'):
+            response['Server-Timing'] = server_timing(timings,total_ms,size)
+
+        match = getattr(request,'resolver_match',None)
+        record = {
+            'method':request.method,
+            'route':match.route if match else 'unmatched',
+            'status':response.status_code,
+            'total_ms':round(total_ms,3),
+            'db_ms':round(timings.db_ms,3),
+            'queries':timings.queries,
+            'serializer_ms':round(timings.serializer_ms,3),
+            'group_send_ms':round(timings.group_send_ms,3),
+            'group_sends':timings.group_sends,
+            'bytes':size,
+        }
+        observe(record)
+        if random.random() < request_metrics_setting('SAMPLE_RATE'):
+            log_sample(dict(record,path=request.path,at=time.time()))
+        return response
@@ -0,0 +1,197 @@
+from django.conf import settings
+from rest_framework import serializers
+from contextvars import ContextVar
+from threading import Lock
+from .histograms import Histogram
+import functools
+import json
+import logging
+import time
+
+# Per-request timings collected by metrics.middleware.RequestMetricsMiddleware. The
+# request's RequestTimings lives in a context variable, so the database wrapper,
+# the serializer hooks and timed_group_send add to it without being handed the request.
+
+
+DEFAULTS = {
+    'ENABLED':False,
+    'SERVER_TIMING':True,  # add a Server-Timing header to every response
+    'SAMPLE_RATE':0.01,  # share of requests written to LOG_FILE
+    'LOG_FILE':None,  # JSON lines; sampled records are dropped when unset
+}
+
+
+def request_metrics_setting(name):
+    return getattr(settings,'REQUEST_METRICS',{}).get(name,DEFAULTS[name])
+
+
+
+class RequestTimings:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.serializer_ms = 0.0
+        self.group_sends = 0
+        self.group_send_ms = 0.0
+        self.in_serializer = False
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+
+
+current = ContextVar('request_timings',default=None)
+
+
+class QueryTimer:
+    # connection.execute_wrapper hook
+
+    def __init__(self,timings):
+        self.timings = timings
+
+    def __call__(self,execute,sql,params,many,context):
+        started = time.perf_counter()
+        try:
+            return execute(sql,params,many,context)
+        finally:
+            self.timings.queries += 1
+            self.timings.db_ms += (time.perf_counter() - started) * 1000
+
+
+
+def timed_serializer(func):
+    # only the outermost serializer call of a request is timed, nested ones are part of it
+    @functools.wraps(func)
+    def wrapper(*args,**kwargs):
+        timings = current.get()
+        if timings is None or timings.in_serializer:
+            return func(*args,**kwargs)
+        timings.in_serializer = True
+        started = time.perf_counter()
+        try:
+            return func(*args,**kwargs)
+        finally:
+            timings.serializer_ms += (time.perf_counter() - started) * 1000
+            timings.in_serializer = False
+    wrapper.timed = True
+    return wrapper
+
+
+
+def install_serializer_hooks():
+    # patched once, when the middleware is enabled; rendering and validation are timed
+    for cls in (serializers.Serializer,serializers.ListSerializer):
+        if not getattr(cls.data.fget,'timed',False):
+            cls.data = property(timed_serializer(cls.data.fget))
+    if not getattr(serializers.BaseSerializer.is_valid,'timed',False):
+        serializers.BaseSerializer.is_valid = timed_serializer(serializers.BaseSerializer.is_valid)
+
+
+
+def record_group_send(elapsed_ms):
+    timings = current.get()
+    if timings is not None:
+        timings.group_sends += 1
+        timings.group_send_ms += elapsed_ms
+
+
+
+def server_timing(timings,total_ms,size):
+    parts = [
+        f'db;dur={timings.db_ms:.1f};desc="{timings.queries} queries"',
+        f'serializer;dur={timings.serializer_ms:.1f}',
+        f'group_send;dur={timings.group_send_ms:.1f};desc="{timings.group_sends} sends"',
+        f'total;dur={total_ms:.1f}',
+    ]
+    if size is not None:
+        parts.append(f'size;desc="{size} bytes"')
+    return ', '.join(parts)
+
+
+
+class RouteStats:
+
+    def __init__(self):
+        self.total_ms = Histogram()
+        self.db_ms = Histogram()
+        self.serializer_ms = Histogram()
+        self.statuses = {}
+        self.queries = 0
+        self.max_queries = 0
+        self.bytes = 0
+        self.max_bytes = 0
+
+    def observe(self,record):
+        self.total_ms.observe(record['total_ms'])
+        self.db_ms.observe(record['db_ms'])
+        self.serializer_ms.observe(record['serializer_ms'])
+        status = str(record['status'])
+        self.statuses[status] = self.statuses.get(status,0) + 1
+        self.queries += record['queries']
+        self.max_queries = max(self.max_queries,record['queries'])
+        size = record['bytes'] or 0
+        self.bytes += size
+        self.max_bytes = max(self.max_bytes,size)
+
+    def summary(self):
+        count = self.total_ms.count
+        return {
+            'count':count,
+            'status':self.statuses,
+            'total_ms':self.total_ms.summary(),
+            'db_ms':self.db_ms.summary(),
+            'serializer_ms':self.serializer_ms.summary(),
+            'queries':{'mean':round(self.queries / count,2),'max':self.max_queries},
+            'bytes':{'mean':round(self.bytes / count),'max':self.max_bytes},
+        }
+
+
+
+_routes = {}
+_lock = Lock()
+
+
+def observe(record):
+    key = f"{record['method']} {record['route']}"
+    with _lock:
+        stats = _routes.get(key)
+        if stats is None:
+            stats = _routes[key] = RouteStats()
+        stats.observe(record)
+
+
+
+def route_summary():
+    with _lock:
+        return {key:stats.summary() for key,stats in sorted(_routes.items())}
+
+
+
+def reset():
+    with _lock:
+        _routes.clear()
+
+
+
+sample_logger = logging.getLogger('metrics.requests')
+sample_logger.propagate = False
+_log_file = None
+
+
+def log_sample(record):
+    global _log_file
+    path = request_metrics_setting('LOG_FILE')
+    if not path:
+        return
+    if _log_file != path:
+        for handler in list(sample_logger.handlers):
+            sample_logger.removeHandler(handler)
+            handler.close()
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        sample_logger.addHandler(handler)
+        sample_logger.setLevel(logging.INFO)
+        _log_file = path
+    sample_logger.info(json.dumps(record))
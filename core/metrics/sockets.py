@@ -0,0 +1,137 @@
+from django.conf import settings
+from collections import Counter
+from threading import Lock
+from .histograms import Histogram
+import time
+
+# Counters of the WebSocket tier: sockets per consumer, frames in and out, group_send
+# latency and failures, and the time from a chat message's insert to its delivery to
+# the recipient's socket. Per process, like metrics.requests; every worker is scraped
+# on its own and rates are left to the scraper.
+
+
+DEFAULTS = {
+    'SCRAPE_TOKEN':None,  # bearer token of the scraper; staff users can read the endpoint without it
+}
+
+
+def socket_metrics_setting(name):
+    return getattr(settings,'SOCKET_METRICS',{}).get(name,DEFAULTS[name])
+
+
+
+started_at = time.time()
+_lock = Lock()
+_open = Counter()
+_connects = Counter()
+_disconnects = Counter()
+_received = Counter()
+_sent = Counter()
+_group_sends = Counter()
+_group_send_failures = Counter()
+_group_send_ms = Histogram()
+_delivery_ms = Histogram()
+
+
+def connected(consumer):
+    with _lock:
+        _open[consumer] += 1
+        _connects[consumer] += 1
+
+
+
+def disconnected(consumer):
+    with _lock:
+        _open[consumer] -= 1
+        _disconnects[consumer] += 1
+
+
+
+def received(consumer):
+    with _lock:
+        _received[consumer] += 1
+
+
+
+def sent(consumer):
+    with _lock:
+        _sent[consumer] += 1
+
+
+
+def observe_group_send(group,elapsed_ms,failed=False):
+    # groups are labelled by prefix, one label per user would not scale
+    prefix = group.rstrip('0123456789').rstrip('_')
+    with _lock:
+        _group_sends[prefix] += 1
+        if failed:
+            _group_send_failures[prefix] += 1
+        _group_send_ms.observe(elapsed_ms)
+
+
+
+def observe_delivery(stored_at):
+    # wall clock, the message may have been stored by another process
+    with _lock:
+        _delivery_ms.observe(max(time.time() - stored_at,0) * 1000)
+
+
+
+def reset():
+    global _group_send_ms,_delivery_ms
+    with _lock:
+        for counter in (_open,_connects,_disconnects,_received,_sent,_group_sends,_group_send_failures):
+            counter.clear()
+        _group_send_ms = Histogram()
+        _delivery_ms = Histogram()
+
+
+
+def layer_capacity():
+    config = settings.CHANNEL_LAYERS.get('default',{}).get('CONFIG',{})
+    return config.get('capacity',100)
+
+
+
+def counter_lines(name,help_text,kind,counter,label):
+    lines = [f'# HELP {name} {help_text}',f'# TYPE {name} {kind}']
+    lines += [f'{name}{{{label}="{key}"}} {value}' for key,value in sorted(counter.items())]
+    return lines
+
+
+
+def histogram_lines(name,help_text,histogram):
+    # bucket bounds are milliseconds, exported as seconds
+    lines = [f'# HELP {name} {help_text}',f'# TYPE {name} histogram']
+    cumulative = 0
+    for bound,count in zip(histogram.bounds + (None,),histogram.counts):
+        cumulative += count
+        le = '+Inf' if bound is None else f'{bound / 1000:g}'
+        lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+    lines.append(f'{name}_sum {histogram.sum / 1000:.6f}')
+    lines.append(f'{name}_count {histogram.count}')
+    return lines
+
+
+
+def prometheus_text():
+    # Prometheus text exposition format 0.0.4
+    with _lock:
+        lines = [
+            '# HELP process_start_time_seconds Start time of the process since the epoch.',
+            '# TYPE process_start_time_seconds gauge',
+            f'process_start_time_seconds {started_at:.3f}',
+            '# HELP channels_layer_capacity Messages a channel of the default layer holds before ChannelFull.',
+            '# TYPE channels_layer_capacity gauge',
+            f'channels_layer_capacity {layer_capacity()}',
+        ]
+        lines += counter_lines('websocket_open_connections','Open sockets per consumer.','gauge',_open,'consumer')
+        lines += counter_lines('websocket_connects_total','Accepted sockets per consumer.','counter',_connects,'consumer')
+        lines += counter_lines('websocket_disconnects_total','Closed sockets per consumer.','counter',_disconnects,'consumer')
+        lines += counter_lines('websocket_received_total','Frames received per consumer.','counter',_received,'consumer')
+        lines += counter_lines('websocket_sent_total','Frames sent per consumer.','counter',_sent,'consumer')
+        lines += counter_lines('channels_group_send_total','group_send calls per group prefix.','counter',_group_sends,'group')
+        lines += counter_lines('channels_group_send_failures_total','group_send calls that raised, per group prefix.','counter',_group_send_failures,'group')
+        lines += histogram_lines('channels_group_send_seconds','group_send latency.',_group_send_ms)
+        lines += histogram_lines('chat_delivery_seconds','Time from the insert of a chat message to its send on the recipient socket.',_delivery_ms)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,74 @@
+from django.test import override_settings
+from rest_framework.test import APIClient
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from api.models import CustomUser,Post
+from api.testcases import APITestCase
+from . import requests as request_metrics
+from . import sockets as socket_metrics
+from .layers import timed_group_send
+
+# Create your tests here.
+
+
+
+
+@override_settings(REQUEST_METRICS={'ENABLED':True,'SAMPLE_RATE':0})
+class RequestMetricsTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        request_metrics.reset()
+        self.viewer = self.create_user('viewer')
+        self.admin = self.create_user('admin')
+        CustomUser.objects.filter(id=self.admin.id).update(is_staff=True)
+        self.admin.is_staff = True
+        Post.objects.create(author=self.viewer,content='post',is_public=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+
+    def test_server_timing_and_route_histograms(self):
+        response = self.client.get(f'/api/posts/get/{self.viewer.id}/')
+        timing = response['Server-Timing']
+        self.assertRegex(timing,r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing,r'serializer;dur=[\d.]+')
+        self.assertIn(f'size;desc="{len(response.content)} bytes"',timing)
+
+        self.assertEqual(self.client.get('/api/metrics/requests/').status_code,403)
+        self.client.force_authenticate(user=self.admin)
+        routes = self.client.get('/api/metrics/requests/').data['routes']
+        stats = routes['GET api/posts/get/<int:user_id>/']
+        self.assertEqual(stats['count'],1)
+        self.assertEqual(stats['status'],{'200':1})
+        self.assertGreater(stats['queries']['mean'],0)
+        self.assertGreater(stats['bytes']['max'],0)
+
+
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default':{'BACKEND':'channels.layers.InMemoryChannelLayer','CONFIG':{'capacity':50}}},
+    SOCKET_METRICS={'SCRAPE_TOKEN':'scrape'},
+)
+class SocketMetricsTests(APITestCase):
+
+    def test_scrape_endpoint(self):
+        socket_metrics.reset()
+        async_to_sync(timed_group_send)(get_channel_layer(),'chat_user_5',{'type':'chat_typing','user_id':1})
+
+        client = APIClient()
+        self.assertEqual(client.get('/api/metrics/sockets/').status_code,401)
+        response = client.get('/api/metrics/sockets/',HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code,200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn('channels_layer_capacity 50\n',text)
+        self.assertIn('channels_group_send_total{group="chat_user"} 1\n',text)
+        self.assertIn('channels_group_send_seconds_count 1\n',text)
+
+        admin = self.create_user('admin')
+        admin.is_staff = True
+        client.force_authenticate(user=admin)
+        self.assertEqual(client.get('/api/metrics/sockets/').status_code,200)
+        client.force_authenticate(user=self.create_user('viewer'))
+        self.assertEqual(client.get('/api/metrics/sockets/').status_code,403)
@@ -0,0 +1,9 @@
+from django.urls import path
+from .views import RequestMetricsView,ResponseCacheMetricsView,SocketMetricsView
+
+
+urlpatterns = [
+    path('requests/',RequestMetricsView.as_view()),
+    path('sockets/',SocketMetricsView.as_view()),
+    path('response_cache/',ResponseCacheMetricsView.as_view()),
+]
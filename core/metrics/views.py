@@ -0,0 +1,67 @@
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.permissions import BasePermission,IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from api.response_cache import hit_rates,response_cache_setting
+from . import sockets
+from .requests import request_metrics_setting,route_summary
+
+
+class RequestMetricsView(APIView):
+    # histograms of the requests served by this process since it started
+    permission_classes = [IsAdminUser]
+
+    def get(self,request,*args,**kwargs):
+        return Response({
+            'enabled':request_metrics_setting('ENABLED'),
+            'routes':route_summary(),
+        })
+
+
+
+
+class ResponseCacheMetricsView(APIView):
+    # hits and misses of api.response_cache in this process, per cached route
+    permission_classes = [IsAdminUser]
+
+    def get(self,request,*args,**kwargs):
+        return Response({
+            'enabled':response_cache_setting('ENABLED'),
+            'routes':hit_rates(),
+        })
+
+
+
+
+class ScrapeTokenAuthentication(BaseAuthentication):
+    # `Authorization: Bearer <SOCKET_METRICS['SCRAPE_TOKEN']>`, checked before the JWT
+
+    def authenticate(self,request):
+        token = sockets.socket_metrics_setting('SCRAPE_TOKEN')
+        if token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION',''),f'Bearer {token}'):
+            return (AnonymousUser(),'scraper')
+        return None
+
+    def authenticate_header(self,request):
+        return 'Bearer realm="metrics"'
+
+
+
+class IsScraperOrAdmin(BasePermission):
+
+    def has_permission(self,request,view):
+        return request.auth == 'scraper' or IsAdminUser().has_permission(request,view)
+
+
+
+class SocketMetricsView(APIView):
+    # Prometheus text format, for the WebSocket tier of this process
+    authentication_classes = [ScrapeTokenAuthentication,JWTAuthentication]
+    permission_classes = [IsScraperOrAdmin]
+
+    def get(self,request,*args,**kwargs):
+        return HttpResponse(sockets.prometheus_text(),content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,53 @@
+from django.db.models import F
+from api.counters import count_subquery,recount
+from chat.conversations import reconcile_unread as reconcile_chat_unread
+from jobs.registry import task
+from .models import Notification,UnreadCounter
+
+
+# Incrementally maintained unread counters. Writers bump them next to the rows they
+# insert or mark as read, and reconcile_unread_counters repairs any drift.
+
+
+def _ensure(user_ids,kind,partner=0):
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(user_id=user_id,kind=kind,partner=partner) for user_id in user_ids],
+        ignore_conflicts=True
+    )
+
+
+
+def incr_notifications(user_ids,amount=1):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    _ensure(user_ids,UnreadCounter.NOTIFICATIONS)
+    UnreadCounter.objects.filter(user_id__in=user_ids,kind=UnreadCounter.NOTIFICATIONS,partner=0).update(count=F('count') + amount)
+
+
+
+def reset_notifications(user_id):
+    UnreadCounter.objects.filter(user_id=user_id,kind=UnreadCounter.NOTIFICATIONS,partner=0).update(count=0)
+
+
+
+def notifications_unread_many(user_ids):
+    rows = UnreadCounter.objects.filter(user_id__in=list(user_ids),kind=UnreadCounter.NOTIFICATIONS,partner=0).values_list('user_id','count')
+    return dict(rows)
+
+
+
+def notifications_unread(user_id):
+    return notifications_unread_many([user_id]).get(user_id,0)
+
+
+
+@task
+def reconcile_unread_counters():
+    # users with unread notifications and no counter row get one, recounted below
+    unread = Notification.objects.filter(is_read=False,target_user__isnull=False)
+    _ensure(unread.values_list('target_user_id',flat=True).distinct(),UnreadCounter.NOTIFICATIONS)
+    counters = UnreadCounter.objects.filter(kind=UnreadCounter.NOTIFICATIONS,partner=0)
+    fixed = recount(counters,'count',count_subquery(Notification,'target_user_id',{'is_read':False},outer='user_id'))
+    # chat badges live on the inbox entries
+    return fixed + reconcile_chat_unread()
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from notifications.counters import reconcile_unread_counters
+
+
+class Command(BaseCommand):
+    help = 'Recount unread notifications and chat messages and fix the counters that drifted.'
+
+    def handle(self,*args,**options):
+        fixed = reconcile_unread_counters()
+        self.stdout.write(self.style.SUCCESS(f'Unread counters reconciled, fixed {fixed} rows.'))
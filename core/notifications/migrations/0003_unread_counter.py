@@ -0,0 +1,47 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_unread_counters(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    UnreadCounter = apps.get_model('notifications', 'UnreadCounter')
+    counters = [
+        UnreadCounter(user_id=row['target_user_id'], kind='notifications', partner=0, count=row['total'])
+        for row in Notification.objects.filter(is_read=False, target_user__isnull=False).values('target_user_id').annotate(total=Count('id'))
+    ]
+    counters += [
+        UnreadCounter(user_id=row['receiver_id'], kind='chat', partner=row['sender_id'], count=row['total'])
+        for row in ChatMessage.objects.filter(is_read=False).values('receiver_id', 'sender_id').annotate(total=Count('id'))
+    ]
+    UnreadCounter.objects.bulk_create(counters, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0002_notification_target_user_alter_notification_user'),
+        ('chat', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('notifications', 'Notifications'), ('chat', 'Chat')], max_length=15)),
+                ('partner', models.BigIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'kind', 'partner'), name='unique_unread_counter')],
+            },
+        ),
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+def delete_chat_counters(apps, schema_editor):
+    # chat badges moved to chat.Participant.unread_count
+    UnreadCounter = apps.get_model('notifications', 'UnreadCounter')
+    UnreadCounter.objects.filter(kind='chat').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0004_hot_query_indexes'),
+        ('chat', '0007_backfill_inbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_chat_counters, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='unreadcounter',
+            name='kind',
+            field=models.CharField(choices=[('notifications', 'Notifications')], max_length=15),
+        ),
+    ]
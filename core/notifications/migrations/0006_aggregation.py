@@ -0,0 +1,66 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:39
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+MESSAGE_VERBS = [
+    ('created a new post!', 'post'),
+    ('liked your post', 'post_like'),
+    ('commented on your post', 'comment'),
+    ('liked your comment!', 'comment_like'),
+    ('is following you', 'follow'),
+]
+
+
+def backfill_verbs(apps, schema_editor):
+    # existing rows stay one per actor, they only learn their verb and actor
+    Notification = apps.get_model('notifications', 'Notification')
+    for suffix, verb in MESSAGE_VERBS:
+        Notification.objects.filter(message__endswith=suffix).update(verb=verb)
+    batch = []
+    for notification in Notification.objects.only('id', 'user_id').iterator(chunk_size=2000):
+        notification.recent_actors = [notification.user_id]
+        batch.append(notification)
+        if len(batch) >= 2000:
+            Notification.objects.bulk_update(batch, ['recent_actors'])
+            batch = []
+    Notification.objects.bulk_update(batch, ['recent_actors'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_hot_query_indexes'),
+        ('notifications', '0005_remove_chat_unread_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='actor_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='recent_actors',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='verb',
+            field=models.CharField(blank=True, choices=[('post', 'New post'), ('post_like', 'Post liked'), ('comment', 'New comment'), ('comment_like', 'Comment liked'), ('follow', 'New follower')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['target_user', 'verb', 'post', '-timestamp'], name='notification_group_idx'),
+        ),
+        migrations.RunPython(backfill_verbs, migrations.RunPython.noop),
+    ]
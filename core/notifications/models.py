@@ -1,11 +1,81 @@
 from django.db import models
+from django.utils import timezone
 from api.models import CustomUser,Post
 # Create your models here.
 
 class Notification(models.Model):
+    # one row per (target_user, verb, post) and time window: later actors join the
+    # existing row instead of adding one, see notifications.utils.aggregate
+
+    POST = 'post'
+    POST_LIKE = 'post_like'
+    COMMENT = 'comment'
+    COMMENT_LIKE = 'comment_like'
+    FOLLOW = 'follow'
+
+    VERB_CHOICES = [
+        (POST,'New post'),
+        (POST_LIKE,'Post liked'),
+        (COMMENT,'New comment'),
+        (COMMENT_LIKE,'Comment liked'),
+        (FOLLOW,'New follower'),
+    ]
+
+    # latest actor
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE,related_name='notifications_sent')
     target_user = models.ForeignKey(CustomUser, on_delete=models.CASCADE,related_name="notifications_received",null=True,blank=True)
     post = models.ForeignKey(Post, on_delete=models.CASCADE,null=True,blank=True)
+    # empty for free-form messages, which are never grouped
+    verb = models.CharField(max_length=20,choices=VERB_CHOICES,blank=True)
     message = models.CharField(max_length=255)
+    actor_count = models.PositiveIntegerField(default=1)
+    # ids of the latest actors, newest first
+    recent_actors = models.JSONField(default=list,blank=True)
     is_read = models.BooleanField(default=False)
-    timestamp = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    # time of the latest activity
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['target_user','-timestamp'],name='notification_user_recent_idx'),
+            models.Index(fields=['target_user','is_read','-timestamp'],name='notification_user_unread_idx'),
+            models.Index(fields=['target_user','verb','post','-timestamp'],name='notification_group_idx'),
+        ]
+
+
+
+class NotificationActor(models.Model):
+    # every actor of a grouped notification, recent_actors only keeps the latest ones;
+    # actor_count grows when a row is inserted here, so an actor is counted once per group
+    notification = models.ForeignKey(Notification,on_delete=models.CASCADE,related_name='actor_rows')
+    actor = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['notification','actor'],name='unique_notification_actor'),
+        ]
+
+
+
+class UnreadCounter(models.Model):
+    # materialized unread badges, so page loads read one row instead of counting messages
+
+    NOTIFICATIONS = 'notifications'
+
+    KIND_CHOICES = [
+        (NOTIFICATIONS,'Notifications'),
+    ]
+
+    user = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='unread_counters')
+    kind = models.CharField(max_length=15,choices=KIND_CHOICES)
+    # 0 for notifications, left for counters kept per partner
+    partner = models.BigIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user','kind','partner'],name='unique_unread_counter'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.kind} {self.partner}: {self.count}'
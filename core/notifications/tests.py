@@ -1,3 +1,157 @@
-from django.test import TestCase
+from channels.layers import InMemoryChannelLayer
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from api.models import Follow,Post
+from api.testcases import APITestCase
+from jobs.models import Job
+from jobs.worker import claim_jobs,run_job
+from .counters import notifications_unread,reconcile_unread_counters
+from .models import Notification,UnreadCounter
+from .utils import fan_out
+from datetime import timedelta
 
 # Create your tests here.
+
+
+
+
+class FlakyChannelLayer(InMemoryChannelLayer):
+    # fails the next `failures` group sends, like a Redis outage in the middle of a fan-out
+    failures = 0
+
+    async def group_send(self,group,message):
+        if FlakyChannelLayer.failures:
+            FlakyChannelLayer.failures -= 1
+            raise ConnectionError('channel layer unavailable')
+        await super().group_send(group,message)
+
+
+
+
+@override_settings(CHANNEL_LAYERS={'default':{'BACKEND':'channels.layers.InMemoryChannelLayer'}})
+class NotificationAggregationTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = self.create_user('author')
+        self.post = Post.objects.create(author=self.author,content='post',is_public=True)
+        self.fans = [self.create_user(f'fan{i}') for i in range(4)]
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.author)
+
+    def notifications(self):
+        return self.client.get(f'/api/notifications/get/{self.author.id}/').data
+
+    def test_likes_on_one_post_share_a_notification(self):
+        for fan in self.fans[:3] + self.fans[:1]:
+            fan_out(fan.id,Notification.POST_LIKE,self.author.id,self.post.id)
+        data = self.notifications()
+        self.assertEqual(data['count'],1)
+        self.assertEqual(data['notifications_count'],1)
+        notification = data['results'][0]
+        self.assertEqual(notification['actor_count'],3)
+        self.assertEqual(notification['message'],'fan0 and 2 others liked your post')
+        self.assertEqual([actor['username'] for actor in notification['actors']],['fan0','fan2','fan1'])
+
+        self.client.get('/api/notifications/seen/')
+        self.assertEqual(self.notifications()['notifications_count'],0)
+        fan_out(self.fans[3].id,Notification.POST_LIKE,self.author.id,self.post.id)
+        data = self.notifications()
+        self.assertEqual((data['count'],data['notifications_count']),(1,1))
+        self.assertEqual(data['results'][0]['actor_count'],4)
+        self.assertEqual(len(data['results'][0]['actors']),3)
+
+    def test_repeat_actor_outside_the_recent_list_is_counted_once(self):
+        for fan in self.fans + self.fans[:1]:
+            fan_out(fan.id,Notification.POST_LIKE,self.author.id,self.post.id)
+        notification = self.notifications()['results'][0]
+        # fan0 had dropped out of the three recent actors before liking again
+        self.assertEqual(notification['actor_count'],4)
+        self.assertEqual(notification['message'],'fan0 and 3 others liked your post')
+        self.assertEqual([actor['username'] for actor in notification['actors']],['fan0','fan3','fan2'])
+
+    def test_groups_are_per_verb_post_and_window(self):
+        fan_out(self.fans[0].id,Notification.FOLLOW,self.author.id)
+        fan_out(self.fans[1].id,Notification.FOLLOW,self.author.id)
+        fan_out(self.fans[0].id,Notification.COMMENT,self.author.id,self.post.id)
+        Notification.objects.filter(verb=Notification.COMMENT).update(timestamp=timezone.now() - timedelta(days=2))
+        fan_out(self.fans[1].id,Notification.COMMENT,self.author.id,self.post.id)
+        messages = [notification['message'] for notification in self.notifications()['results']]
+        self.assertEqual(messages,['fan1 commented on your post','fan1 and 1 other are following you','fan0 commented on your post'])
+
+
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default':{'BACKEND':'notifications.tests.FlakyChannelLayer'}},
+    NOTIFICATIONS={'CHUNK_SIZE':2},
+    JOBS={'RETRY_DELAY':10},
+)
+class FanOutTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = self.create_user('author')
+        self.post = Post.objects.create(author=self.author,content='post',is_public=True)
+        self.fans = [self.create_user(f'fan{i}') for i in range(5)]
+        for fan in self.fans:
+            Follow.objects.create(follower=fan,following=self.author)
+        FlakyChannelLayer.failures = 0
+
+    def run_jobs(self):
+        for job_id in claim_jobs(10):
+            run_job(job_id)
+
+    def assertNotifiedOnce(self):
+        for fan in self.fans:
+            self.assertEqual(Notification.objects.filter(target_user=fan,verb=Notification.POST,post=self.post).count(),1)
+            self.assertEqual(notifications_unread(fan.id),1)
+
+    def test_failed_chunk_is_retried_without_duplicates(self):
+        fan_out(self.author.id,Notification.POST,None,self.post.id)
+        jobs = list(Job.objects.filter(name='notifications.utils.notify_recipients').order_by('id'))
+        self.assertEqual([len(job.args[3]) for job in jobs],[2,2,1])
+
+        # the first chunk is stored, then fails to push: the other chunks still go out
+        FlakyChannelLayer.failures = 1
+        self.run_jobs()
+        statuses = dict(Job.objects.filter(id__in=[job.id for job in jobs]).values_list('id','status'))
+        self.assertEqual(statuses,{jobs[0].id:Job.PENDING,jobs[1].id:Job.DONE,jobs[2].id:Job.DONE})
+        self.assertNotifiedOnce()
+
+        Job.objects.filter(id=jobs[0].id).update(run_at=timezone.now())
+        self.run_jobs()
+        self.assertEqual(Job.objects.get(id=jobs[0].id).status,Job.DONE)
+        self.assertNotifiedOnce()
+
+    def test_rows_of_an_earlier_fan_out_are_not_skipped(self):
+        for i in range(2):
+            fan_out(self.author.id,'announcement')
+            self.run_jobs()
+        for fan in self.fans:
+            self.assertEqual(Notification.objects.filter(target_user=fan,message='announcement').count(),2)
+
+
+
+
+class UnreadCounterTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.actor = self.create_user('actor')
+        self.users = [self.create_user(f'user{i}') for i in range(3)]
+        for user,unread in zip(self.users,(2,1,0)):
+            for i in range(unread):
+                Notification.objects.create(user=self.actor,target_user=user,message=f'message {i}')
+            Notification.objects.create(user=self.actor,target_user=user,message='read',is_read=True)
+
+    def test_reconcile_fixes_drifted_and_missing_counters(self):
+        UnreadCounter.objects.all().delete()
+        UnreadCounter.objects.create(user=self.users[0],kind=UnreadCounter.NOTIFICATIONS,count=5)
+        UnreadCounter.objects.create(user=self.users[2],kind=UnreadCounter.NOTIFICATIONS,count=3)
+        # users[1] has no counter row at all
+        self.assertEqual(reconcile_unread_counters(),3)
+        self.assertEqual([notifications_unread(user.id) for user in self.users],[2,1,0])
+        self.assertEqual(reconcile_unread_counters(),0)
+
@@ -1,67 +1,210 @@
-
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from .models import Notification
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from datetime import datetime,timedelta
+from .models import Notification,NotificationActor
+from .counters import incr_notifications,notifications_unread_many
+from api.loaders import load_actor_cards
+from api.models import CustomUser,Follow,Post
 from api.serializers import UserSerializer,PostSerializer
+from jobs.registry import task
+from metrics.layers import timed_group_send
+
+
+DEFAULTS = {
+    'CHUNK_SIZE':500,
+    'GROUP_WINDOW':86400,  # seconds since the latest activity during which new actors join a notification
+    'RECENT_ACTORS':3,  # actors kept on a grouped notification
+}
+
+
+def notification_setting(name):
+    return getattr(settings,'NOTIFICATIONS',{}).get(name,DEFAULTS[name])
+
+
+
+# singular and plural form of every verb
+PHRASES = {
+    Notification.POST:('created a new post!','created a new post!'),
+    Notification.POST_LIKE:('liked your post','liked your post'),
+    Notification.COMMENT:('commented on your post','commented on your post'),
+    Notification.COMMENT_LIKE:('liked your comment!','liked your comment!'),
+    Notification.FOLLOW:('is following you','are following you'),
+}
+
+
+def notification_message(verb,username,actor_count=1):
+    singular,plural = PHRASES[verb]
+    if actor_count == 1:
+        return f'{username} {singular}'
+    others = actor_count - 1
+    return f"{username} and {others} {'other' if others == 1 else 'others'} {plural}"
 
-channel_layer = get_channel_layer()
 
 
+async def group_send_many(channel_layer,messages):
+    for group,message in messages:
+        await timed_group_send(channel_layer,group,message)
 
-def send_notification(action_user,message,request,target_user=None,post=None):
-    if target_user:
-        notification = Notification.objects.create(user=action_user,post=post,target_user=target_user,message=message)
-        notifications_count = Notification.objects.filter(target_user=target_user,is_read=False).count()
-        user = UserSerializer(action_user)
-        post = PostSerializer(post,context={'user':request.user}) if post else None
-        avatar = action_user.userprofile.avatar
+
+
+def deliver(notifications,results,actors,updated=False):
+    # one counter read and one event-loop hop for the whole chunk; an updated
+    # notification keeps its id, clients replace the entry they already show
+    counts = notifications_unread_many([notification.target_user_id for notification in notifications])
+    messages = []
+    for notification in notifications:
         payload = {
-            'notifications_count':notifications_count,
-            'results':{
-                'id':notification.id,
-                'user':user.data,
-                'post':post.data,
-                'avatar':str(avatar),
-                'message':message,
-                'is_read':notification.is_read,
-            }
+            'notifications_count':counts.get(notification.target_user_id,0),
+            'updated':updated,
+            'results':dict(
+                results,
+                id=notification.id,
+                verb=notification.verb,
+                message=notification.message,
+                actor_count=notification.actor_count,
+                actors=actors,
+                is_read=notification.is_read,
+                timestamp=notification.timestamp.isoformat(),
+            ),
         }
-
-        async_to_sync(channel_layer.group_send)(
-        f"notifications_user_{target_user.id}",
-        {
+        messages.append((f"notifications_user_{notification.target_user_id}",{
             "type":"send_notification",
             "payload":payload,
-            }
-        )
-
-
-
-
-    else:
-        followers = action_user.followers.all()
-        for follower in followers:
-            notification = Notification.objects.create(user=action_user,post=post,target_user=follower.follower,message=message)
-            notifications_count = Notification.objects.filter(target_user=follower,is_read=False).count()
-            user = UserSerializer(follower)
-            post = PostSerializer(post,context={'user':request.user}) if post else None
-            avatar = follower.userprofile.avatar
-            payload = {
-            'notifications_count':notifications_count,
-            'results':{
-                'id':notification.id,
-                'user':user.data,
-                'post':post.data,
-                'avatar':str(avatar),
-                'message':message,
-                'is_read':notification.is_read,
-                }
-            }
-            async_to_sync(channel_layer.group_send)(
-            f"notifications_user_{follower.id}",
-            {
-                "type":"send_notification",
-                "payload":payload,
-            }
+        }))
+    async_to_sync(group_send_many)(get_channel_layer(),messages)
+
+
+
+def aggregate(action_user,verb,target_user_id,post_id):
+    # joins the latest notification of the same (target_user, verb, post) within
+    # GROUP_WINDOW, or starts a new one; returns (notification, updated)
+    now = timezone.now()
+    with transaction.atomic():
+        notification = Notification.objects.select_for_update().filter(
+            target_user_id=target_user_id,verb=verb,post_id=post_id,
+            timestamp__gte=now - timedelta(seconds=notification_setting('GROUP_WINDOW'))
+        ).order_by('-timestamp').first()
+        if notification is None:
+            notification = Notification.objects.create(
+                user=action_user,target_user_id=target_user_id,post_id=post_id,verb=verb,
+                message=notification_message(verb,action_user.username),recent_actors=[action_user.id],timestamp=now
             )
+            NotificationActor.objects.create(notification=notification,actor=action_user)
+            incr_notifications([target_user_id])
+            return notification,False
+
+        was_read = notification.is_read
+        # recent_actors is cut to a few ids, the actor rows hold all of them
+        _,new_actor = NotificationActor.objects.get_or_create(notification=notification,actor=action_user)
+        if new_actor:
+            notification.actor_count += 1
+        notification.recent_actors = ([action_user.id] + [actor for actor in notification.recent_actors if actor != action_user.id])[:notification_setting('RECENT_ACTORS')]
+        notification.user = action_user
+        notification.message = notification_message(verb,action_user.username,notification.actor_count)
+        notification.is_read = False
+        notification.timestamp = now
+        notification.save(update_fields=['user','message','actor_count','recent_actors','is_read','timestamp'])
+        if was_read:
+            incr_notifications([target_user_id])
+        return notification,True
+
+
+
+def follower_id_chunks(user_id,chunk_size):
+    last_id = 0
+    while True:
+        chunk = list(Follow.objects.filter(following_id=user_id,id__gt=last_id).order_by('id').values_list('id','follower_id')[:chunk_size])
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        yield [follower_id for follow_id,follower_id in chunk]
+
+
+
+def render_results(action_user,post):
+    # the shared part of the payload, rendered once per job for every recipient
+    return {
+        'user':UserSerializer(action_user).data,
+        'post':PostSerializer([post],many=True,context={'user':action_user}).data[0] if post else None,
+        'avatar':str(action_user.userprofile.avatar),
+    }
+
+
+
+def split_verb(verb,username):
+    if verb not in PHRASES:
+        # a free-form message, or a job queued before verbs existed: never grouped
+        return '',verb
+    return verb,notification_message(verb,username)
+
+
+
+@task
+def fan_out(action_user_id,verb,target_user_id=None,post_id=None):
+    action_user = CustomUser.objects.select_related('userprofile').get(id=action_user_id)
+    post = Post.objects.filter(id=post_id).first() if post_id else None
+    if post_id and post is None:
+        return
+
+    if target_user_id and verb in PHRASES:
+        # joining a group is idempotent per actor, a retry only refreshes it
+        notification,updated = aggregate(action_user,verb,target_user_id,post_id)
+        actor_cards = load_actor_cards(notification.recent_actors)
+        actors = [actor_cards[actor] for actor in notification.recent_actors if actor in actor_cards]
+        deliver([notification],render_results(action_user,post),actors,updated)
+        return
+
+    # rows inserted from here on belong to this fan-out, see notify_recipients
+    since = timezone.now().isoformat()
+    if target_user_id:
+        notify_recipients(action_user_id,verb,post_id,[target_user_id],since)
+        return
+
+    # one job per chunk, enqueued all together: a failure here leaves none behind and the
+    # retry starts over, a failed chunk is retried on its own
+    with transaction.atomic():
+        for recipient_ids in follower_id_chunks(action_user_id,notification_setting('CHUNK_SIZE')):
+            notify_recipients.enqueue(action_user_id,verb,post_id,recipient_ids,since)
+
+
+
+@task
+def notify_recipients(action_user_id,verb,post_id,recipient_ids,since):
+    """
+    One chunk of a fan-out. A recipient that already has the (actor, post, verb) row
+    inserted since the fan-out started is skipped, so a retried chunk inserts and counts
+    every notification once; those rows are pushed again as updates.
+    """
+    action_user = CustomUser.objects.select_related('userprofile').get(id=action_user_id)
+    post = Post.objects.filter(id=post_id).first() if post_id else None
+    if post_id and post is None:
+        return
+    verb,message = split_verb(verb,action_user.username)
+
+    with transaction.atomic():
+        delivered = list(Notification.objects.filter(
+            user_id=action_user_id,post_id=post_id,verb=verb,message=message,
+            target_user_id__in=recipient_ids,timestamp__gte=datetime.fromisoformat(since)
+        ))
+        done = {notification.target_user_id for notification in delivered}
+        notifications = Notification.objects.bulk_create([
+            Notification(user_id=action_user_id,post_id=post_id,target_user_id=recipient_id,verb=verb,message=message,recent_actors=[action_user_id])
+            for recipient_id in recipient_ids if recipient_id not in done
+        ])
+        incr_notifications([notification.target_user_id for notification in notifications])
+
+    results = render_results(action_user,post)
+    actors = [{'id':action_user.id,'username':action_user.username,'avatar':results['avatar']}]
+    if notifications:
+        deliver(notifications,results,actors)
+    if delivered:
+        deliver(delivered,results,actors,updated=True)
+
+
 
+def send_notification(action_user,verb,request,target_user=None,post=None):
+    # delivery runs on the job worker, the request only records the job
+    fan_out.enqueue(action_user.id,verb,target_user.id if target_user else None,post.id if post else None)
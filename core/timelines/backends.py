@@ -0,0 +1,300 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Count,F,Q,Window
+from django.db.models.functions import RowNumber
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from datetime import datetime,timezone
+from bisect import insort
+from threading import Lock
+
+# A timeline entry is a (created_at, post_id, author_id) tuple. Backends keep at most
+# MAX_LENGTH entries per user, newest first, and page through them with the same
+# (created_at, id) positions used by api.paginations.KeysetCursorPagination.
+
+
+DEFAULTS = {
+    'BACKEND':'timelines.backends.DatabaseTimelineBackend',
+    'OPTIONS':{},
+    'MAX_LENGTH':500,
+    'FANOUT_FOLLOWER_THRESHOLD':5000,
+    'FANOUT_CHUNK_SIZE':1000,
+}
+
+
+def timeline_setting(name):
+    return getattr(settings,'TIMELINES',{}).get(name,DEFAULTS[name])
+
+
+def is_before(entry,position):
+    # True when entry comes strictly after `position` in (-created_at,-id) order
+    if position is None:
+        return True
+    created_at,pk = position
+    return entry[0] < created_at or (entry[0] == created_at and entry[1] < pk)
+
+
+
+
+class BaseTimelineBackend:
+    cascades_post_delete = False
+
+    def __init__(self,max_length,**options):
+        self.max_length = max_length
+
+    def push(self,user_ids,entry):
+        # add one entry to many timelines (fan-out on write)
+        raise NotImplementedError
+
+    def add(self,user_id,entries):
+        # add many entries to one timeline (backfill after a follow)
+        raise NotImplementedError
+
+    def replace(self,user_id,entries):
+        raise NotImplementedError
+
+    def read(self,user_id,position,limit):
+        # returns up to `limit` (created_at, post_id) pairs strictly after `position`
+        raise NotImplementedError
+
+    def remove_post(self,post_id,author_id,user_ids):
+        raise NotImplementedError
+
+    def remove_author(self,user_id,author_id):
+        raise NotImplementedError
+
+    def compact(self):
+        # drop entries beyond max_length, for backends that do not cap on write
+        pass
+
+
+
+
+class DatabaseTimelineBackend(BaseTimelineBackend):
+    # rows of a deleted post go away with the ON DELETE CASCADE of TimelineEntry.post
+    cascades_post_delete = True
+
+    def __init__(self,max_length,chunk_size=1000,**options):
+        super().__init__(max_length,**options)
+        self.chunk_size = chunk_size
+
+    @property
+    def model(self):
+        from .models import TimelineEntry
+        return TimelineEntry
+
+    def push(self,user_ids,entry):
+        created_at,post_id,author_id = entry
+        user_ids = list(user_ids)
+        for start in range(0,len(user_ids),self.chunk_size):
+            chunk = user_ids[start:start + self.chunk_size]
+            self.model.objects.bulk_create(
+                [self.model(user_id=user_id,post_id=post_id,author_id=author_id,created_at=created_at) for user_id in chunk],
+                ignore_conflicts=True
+            )
+        # timelines may run over max_length until the next compact(); reads are limited anyway
+
+    def add(self,user_id,entries):
+        self.model.objects.bulk_create(
+            [self.model(user_id=user_id,post_id=post_id,author_id=author_id,created_at=created_at) for created_at,post_id,author_id in entries],
+            batch_size=self.chunk_size,
+            ignore_conflicts=True
+        )
+        self.trim([user_id])
+
+    def replace(self,user_id,entries):
+        self.model.objects.filter(user_id=user_id).delete()
+        self.add(user_id,entries[:self.max_length])
+
+    def trim(self,user_ids):
+        overflow = self.model.objects.filter(user_id__in=user_ids).annotate(
+            rank=Window(RowNumber(),partition_by=F('user_id'),order_by=(F('created_at').desc(),F('post_id').desc()))
+        ).filter(rank__gt=self.max_length).values_list('pk',flat=True)
+        overflow = list(overflow)
+        if overflow:
+            self.model.objects.filter(pk__in=overflow).delete()
+
+    def compact(self):
+        overflowing = list(
+            self.model.objects.values('user_id').annotate(total=Count('pk'))
+            .filter(total__gt=self.max_length).values_list('user_id',flat=True)
+        )
+        for start in range(0,len(overflowing),self.chunk_size):
+            self.trim(overflowing[start:start + self.chunk_size])
+
+    def read(self,user_id,position,limit):
+        entries = self.model.objects.filter(user_id=user_id)
+        if position is not None:
+            created_at,pk = position
+            entries = entries.filter(Q(created_at__lt=created_at) | Q(created_at=created_at,post_id__lt=pk))
+        return list(entries.order_by('-created_at','-post_id').values_list('created_at','post_id')[:limit])
+
+    def remove_post(self,post_id,author_id,user_ids):
+        self.model.objects.filter(post_id=post_id).delete()
+
+    def remove_author(self,user_id,author_id):
+        self.model.objects.filter(user_id=user_id,author_id=author_id).delete()
+
+
+
+
+class MemoryTimelineBackend(BaseTimelineBackend):
+    # per-process store, meant for development and tests
+
+    def __init__(self,max_length,**options):
+        super().__init__(max_length,**options)
+        self.timelines = {}
+        self.lock = Lock()
+
+    def _insert(self,user_id,entry):
+        # timelines are kept in ascending order, the newest entry is last
+        timeline = self.timelines.setdefault(user_id,[])
+        if entry not in timeline:
+            insort(timeline,entry,key=lambda e:(e[0],e[1]))
+        if len(timeline) > self.max_length:
+            del timeline[:len(timeline) - self.max_length]
+
+    def push(self,user_ids,entry):
+        with self.lock:
+            for user_id in user_ids:
+                self._insert(user_id,tuple(entry))
+
+    def add(self,user_id,entries):
+        with self.lock:
+            for entry in entries:
+                self._insert(user_id,tuple(entry))
+
+    def replace(self,user_id,entries):
+        with self.lock:
+            self.timelines.pop(user_id,None)
+            for entry in entries[:self.max_length]:
+                self._insert(user_id,tuple(entry))
+
+    def read(self,user_id,position,limit):
+        with self.lock:
+            timeline = list(self.timelines.get(user_id,()))
+        page = []
+        for entry in reversed(timeline):
+            if len(page) == limit:
+                break
+            if is_before(entry,position):
+                page.append((entry[0],entry[1]))
+        return page
+
+    def remove_post(self,post_id,author_id,user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                timeline = self.timelines.get(user_id)
+                if timeline:
+                    timeline[:] = [e for e in timeline if e[1] != post_id]
+
+    def remove_author(self,user_id,author_id):
+        with self.lock:
+            timeline = self.timelines.get(user_id)
+            if timeline:
+                timeline[:] = [e for e in timeline if e[2] != author_id]
+
+
+
+
+class RedisTimelineBackend(BaseTimelineBackend):
+    # one sorted set per user; the score is created_at in integer microseconds (exact in a
+    # double up to year 2255) and the member is "post_id:author_id"
+
+    def __init__(self,max_length,url='redis://127.0.0.1:6379/0',prefix='timeline',**options):
+        super().__init__(max_length,**options)
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def key(self,user_id):
+        return f'{self.prefix}:{user_id}'
+
+    @staticmethod
+    def score(created_at):
+        return int(created_at.timestamp()) * 1000000 + created_at.microsecond
+
+    @staticmethod
+    def to_datetime(score):
+        seconds,micros = divmod(int(score),1000000)
+        return datetime.fromtimestamp(seconds,tz=timezone.utc).replace(microsecond=micros)
+
+    def _zadd(self,pipe,user_id,entries):
+        key = self.key(user_id)
+        pipe.zadd(key,{f'{post_id}:{author_id}':self.score(created_at) for created_at,post_id,author_id in entries})
+        pipe.zremrangebyrank(key,0,-self.max_length - 1)
+
+    def push(self,user_ids,entry):
+        with self.client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                self._zadd(pipe,user_id,[entry])
+            pipe.execute()
+
+    def add(self,user_id,entries):
+        if not entries:
+            return
+        with self.client.pipeline(transaction=False) as pipe:
+            self._zadd(pipe,user_id,entries)
+            pipe.execute()
+
+    def replace(self,user_id,entries):
+        with self.client.pipeline() as pipe:
+            pipe.delete(self.key(user_id))
+            if entries:
+                self._zadd(pipe,user_id,entries[:self.max_length])
+            pipe.execute()
+
+    def read(self,user_id,position,limit):
+        key = self.key(user_id)
+        if position is None:
+            members = self.client.zrevrange(key,0,limit - 1,withscores=True)
+        else:
+            # members sharing the boundary score may sit on either side of the cursor
+            max_score = self.score(position[0])
+            ties = self.client.zcount(key,max_score,max_score)
+            members = self.client.zrevrangebyscore(key,max_score,'-inf',start=0,num=limit + ties,withscores=True)
+        page = []
+        for member,score in members:
+            post_id = int(member.split(b':')[0])
+            entry = (self.to_datetime(score),post_id)
+            if is_before(entry,position):
+                page.append(entry)
+        page.sort(reverse=True)
+        return page[:limit]
+
+    def remove_post(self,post_id,author_id,user_ids):
+        member = f'{post_id}:{author_id}'
+        with self.client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zrem(self.key(user_id),member)
+            pipe.execute()
+
+    def remove_author(self,user_id,author_id):
+        key = self.key(user_id)
+        suffix = f':{author_id}'.encode()
+        members = [m for m in self.client.zrange(key,0,-1) if m.endswith(suffix)]
+        if members:
+            self.client.zrem(key,*members)
+
+
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        backend_class = import_string(timeline_setting('BACKEND'))
+        options = dict(timeline_setting('OPTIONS'))
+        if issubclass(backend_class,DatabaseTimelineBackend):
+            options.setdefault('chunk_size',timeline_setting('FANOUT_CHUNK_SIZE'))
+        _backend = backend_class(max_length=timeline_setting('MAX_LENGTH'),**options)
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting,**kwargs):
+    global _backend
+    if setting == 'TIMELINES':
+        _backend = None
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from api.models import CustomUser
+from timelines.utils import rebuild_timeline
+
+
+class Command(BaseCommand):
+    help = 'Rebuild materialized home timelines from posts and follows (backfill or repair).'
+
+    def add_arguments(self,parser):
+        parser.add_argument('--user',type=int,action='append',dest='user_ids',help='Only rebuild these user ids (repeatable).')
+        parser.add_argument('--chunk-size',type=int,default=500,help='Users loaded per batch.')
+
+    def handle(self,*args,**options):
+        users = CustomUser.objects.filter(is_active=True).order_by('id')
+        if options['user_ids']:
+            users = users.filter(id__in=options['user_ids'])
+
+        rebuilt = 0
+        last_id = 0
+        while True:
+            chunk = list(users.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+            for user in chunk:
+                rebuild_timeline(user)
+            rebuilt += len(chunk)
+            last_id = chunk[-1].id
+            self.stdout.write(f'rebuilt {rebuilt} timelines')
+
+        self.stdout.write(self.style.SUCCESS(f'Done, {rebuilt} timelines rebuilt.'))
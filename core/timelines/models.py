@@ -0,0 +1,22 @@
+from django.db import models
+from api.models import CustomUser,Post
+
+# Create your models here.
+
+class TimelineEntry(models.Model):
+    # one row per (reader, post): the materialized home timeline of `user`
+    user = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='timeline_entries')
+    post = models.ForeignKey(Post,on_delete=models.CASCADE,related_name='timeline_entries')
+    author = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name='+')
+    # copy of post.created_at so a timeline page never has to join posts to be ordered
+    created_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user','post')
+        indexes = [
+            models.Index(fields=['user','-created_at','-post'],name='timeline_user_recent_idx'),
+            models.Index(fields=['user','author'],name='timeline_user_author_idx'),
+        ]
+
+    def __str__(self):
+        return f'post {self.post_id} in {self.user_id} timeline'
@@ -0,0 +1,22 @@
+from api.models import Follow,Post
+from django.db.models.signals import post_delete,post_save
+from django.dispatch import receiver
+from .utils import backfill_follow,remove_follow,remove_post
+
+
+@receiver(post_delete,sender=Post)
+def remove_deleted_post(sender,instance,**kwargs):
+    remove_post(instance)
+
+
+
+@receiver(post_save,sender=Follow)
+def add_followed_posts(sender,instance,created,**kwargs):
+    if created:
+        backfill_follow(instance.follower_id,instance.following_id)
+
+
+
+@receiver(post_delete,sender=Follow)
+def remove_unfollowed_posts(sender,instance,**kwargs):
+    remove_follow(instance.follower_id,instance.following_id)
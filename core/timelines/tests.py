@@ -0,0 +1,158 @@
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from api.models import CustomUser,Follow,Post
+from api.testcases import APITestCase
+from jobs.models import Job
+from .models import TimelineEntry
+from .utils import trim_timelines
+from datetime import timedelta
+from io import StringIO
+
+# Create your tests here.
+
+
+
+
+@override_settings(
+    TIMELINES={'BACKEND':'timelines.backends.DatabaseTimelineBackend','MAX_LENGTH':3,'FANOUT_FOLLOWER_THRESHOLD':3},
+    JOBS={'ALWAYS_EAGER':True},
+    CHANNEL_LAYERS={'default':{'BACKEND':'channels.layers.InMemoryChannelLayer'}},
+)
+class TimelineTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = self.create_user('author')
+        self.fans = [self.create_user(f'fan{i}') for i in range(2)]
+        for fan in self.fans:
+            Follow.objects.create(follower=fan,following=self.author)
+        CustomUser.objects.filter(id=self.author.id).update(followers_count=len(self.fans))
+        CustomUser.objects.filter(id__in=[fan.id for fan in self.fans]).update(following_count=1)
+        self.client = APIClient()
+
+    def publish(self,user,content):
+        self.client.force_authenticate(user=user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/posts/create/',{'content':content,'is_public':False})
+        self.assertEqual(response.status_code,201)
+        return Post.objects.get(id=response.data['id'])
+
+    def timeline(self,user):
+        return list(TimelineEntry.objects.filter(user=user).order_by('-created_at','-post').values_list('post_id',flat=True))
+
+    def feed(self,user):
+        self.client.force_authenticate(user=user)
+        return [post['id'] for post in self.client.get('/api/feed/').data['results']]
+
+    def walk_feed(self,user,page_size):
+        self.client.force_authenticate(user=user)
+        ids,url = [],f'/api/feed/?page_size={page_size}'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code,200)
+            ids += [post['id'] for post in response.data['results']]
+            url = response.data['next']
+            self.assertLess(len(ids),50)
+        return ids
+
+    def test_push_to_followers_after_commit(self):
+        self.client.force_authenticate(user=self.author)
+        with self.captureOnCommitCallbacks() as callbacks:
+            post = Post.objects.get(id=self.client.post('/api/posts/create/',{'content':'post','is_public':False}).data['id'])
+        # only the author's own timeline is written inside the request
+        self.assertEqual(self.timeline(self.author),[post.id])
+        self.assertEqual(self.timeline(self.fans[0]),[])
+        for callback in callbacks:
+            callback()
+        for fan in self.fans:
+            self.assertEqual(self.timeline(fan),[post.id])
+            self.assertEqual(self.feed(fan),[post.id])
+
+    def test_queued_when_not_eager(self):
+        with self.settings(JOBS={'ALWAYS_EAGER':False}):
+            post = self.publish(self.author,'post')
+        job = Job.objects.get(name='timelines.utils.push_to_followers')
+        self.assertEqual(job.args,[post.id])
+        self.assertEqual(self.timeline(self.fans[0]),[])
+
+    def test_popular_authors_are_pulled_at_read_time(self):
+        fan = self.create_user('fan2')
+        Follow.objects.create(follower=fan,following=self.author)
+        CustomUser.objects.filter(id=self.author.id).update(followers_count=3)
+        post = self.publish(self.author,'post')
+        self.assertEqual(self.timeline(fan),[])
+        self.assertEqual(self.feed(fan),[post.id])
+        self.assertEqual(self.feed(self.create_user('stranger')),[])
+
+    def test_unfollow_and_delete_remove_entries(self):
+        first = self.publish(self.author,'first')
+        second = self.publish(self.author,'second')
+        self.assertEqual(self.timeline(self.fans[0]),[second.id,first.id])
+
+        self.client.force_authenticate(user=self.fans[0])
+        self.assertEqual(self.client.delete('/api/unfollow/',{'user_id':self.author.id},format='json').status_code,200)
+        self.assertEqual(self.timeline(self.fans[0]),[])
+        self.assertEqual(self.feed(self.fans[0]),[])
+
+        self.client.force_authenticate(user=self.author)
+        self.assertEqual(self.client.delete('/api/posts/delete/',{'post_id':first.id},format='json').status_code,200)
+        self.assertEqual(self.timeline(self.fans[1]),[second.id])
+        self.assertEqual(self.timeline(self.author),[second.id])
+
+    def test_follow_backfills_recent_posts(self):
+        post = self.publish(self.author,'post')
+        late = self.create_user('late')
+        Follow.objects.create(follower=late,following=self.author)
+        self.assertEqual(self.timeline(late),[post.id])
+
+    def test_rebuild_timelines(self):
+        posts = [self.publish(self.author,f'post {i}') for i in range(2)]
+        TimelineEntry.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_timelines','--user',str(self.fans[0].id),stdout=out)
+        self.assertIn('Done, 1 timelines rebuilt.',out.getvalue())
+        self.assertEqual(self.timeline(self.fans[0]),[posts[1].id,posts[0].id])
+        self.assertEqual(self.timeline(self.fans[1]),[])
+
+        call_command('rebuild_timelines',stdout=out)
+        self.assertEqual(self.timeline(self.author),[posts[1].id,posts[0].id])
+
+    def test_trim_keeps_the_newest_entries(self):
+        posts = [self.publish(self.author,f'post {i}') for i in range(5)]
+        # pushes do not trim, the periodic task does
+        self.assertEqual(len(self.timeline(self.fans[0])),5)
+        self.assertEqual(self.feed(self.fans[0])[:3],[post.id for post in posts[:1:-1]])
+        trim_timelines()
+        for user in self.fans + [self.author]:
+            self.assertEqual(self.timeline(user),[post.id for post in posts[:1:-1]])
+
+    def test_walk_merges_timeline_public_and_pulled_posts(self):
+        popular = self.create_user('popular')
+        stranger = self.create_user('stranger')
+        Follow.objects.create(follower=self.fans[0],following=popular)
+        CustomUser.objects.filter(id=popular.id).update(followers_count=3)
+        CustomUser.objects.filter(id=self.fans[0].id).update(following_count=2)
+
+        fanned = [self.publish(self.author,f'fanned {i}') for i in range(3)]
+        self.client.force_authenticate(user=self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            # in the timeline and public at once, listed a single time
+            both = Post.objects.get(id=self.client.post('/api/posts/create/',{'content':'both','is_public':True}).data['id'])
+        pulled = [self.publish(popular,f'pulled {i}') for i in range(2)]
+        public = [Post.objects.create(author=stranger,content=f'public {i}',is_public=True) for i in range(2)]
+        hidden = Post.objects.create(author=stranger,content='hidden',is_public=False)
+        self.assertEqual(set(self.timeline(self.fans[0])),{post.id for post in fanned + [both]})
+
+        # ties on created_at across the three sources, broken by id
+        now = timezone.now()
+        posts = fanned + [both] + pulled + public + [hidden]
+        for i,post in enumerate(posts):
+            created_at = now - timedelta(minutes=i // 3)
+            Post.objects.filter(id=post.id).update(created_at=created_at)
+            TimelineEntry.objects.filter(post=post).update(created_at=created_at)
+
+        expected = list(Post.objects.filter(id__in=[post.id for post in posts if post != hidden]).order_by('-created_at','-id').values_list('id',flat=True))
+        for page_size in (1,2,3,4,20):
+            self.assertEqual(self.walk_feed(self.fans[0],page_size),expected)
@@ -0,0 +1,106 @@
+from django.db.models import Q
+from api.models import CustomUser,Follow,Post
+from api.paginations import keyset_queryset
+from jobs.registry import task
+from .backends import get_backend,timeline_setting
+
+
+def post_entry(post):
+    return (post.created_at,post.id,post.author_id)
+
+
+
+def pulled_author_ids(user):
+    # followed accounts above the fan-out threshold: their posts are merged in at read time
+    threshold = timeline_setting('FANOUT_FOLLOWER_THRESHOLD')
+    followed = Follow.objects.filter(follower=user).values('following')
+    return list(CustomUser.objects.filter(id__in=followed,followers_count__gte=threshold).values_list('id',flat=True))
+
+
+
+def is_pushed_author(followers_count):
+    return followers_count < timeline_setting('FANOUT_FOLLOWER_THRESHOLD')
+
+
+
+def fanout_post(post):
+    recipients = [post.author_id]
+    if is_pushed_author(post.author.followers_count):
+        recipients += list(Follow.objects.filter(following_id=post.author_id).values_list('follower_id',flat=True))
+    get_backend().push(recipients,post_entry(post))
+
+
+
+@task
+def push_to_followers(post_id):
+    # pushes are idempotent, a retried job only rewrites the same entries
+    post = Post.objects.select_related('author').filter(id=post_id).first()
+    if post is not None:
+        fanout_post(post)
+
+
+
+def publish_post(post):
+    # the author's own timeline is written in the request, the followers' by the job
+    # worker once the post has committed
+    get_backend().push([post.author_id],post_entry(post))
+    if is_pushed_author(post.author.followers_count):
+        push_to_followers.enqueue(post.id)
+
+
+
+@task
+def trim_timelines():
+    get_backend().compact()
+
+
+
+def remove_post(post):
+    backend = get_backend()
+    if backend.cascades_post_delete:
+        return
+    followers = list(Follow.objects.filter(following_id=post.author_id).values_list('follower_id',flat=True))
+    backend.remove_post(post.id,post.author_id,followers + [post.author_id])
+
+
+
+def backfill_follow(follower_id,author_id):
+    followers_count = CustomUser.objects.filter(id=author_id).values_list('followers_count',flat=True).first()
+    if followers_count is None or not is_pushed_author(followers_count):
+        return
+    entries = Post.objects.filter(author_id=author_id).order_by('-created_at','-id').values_list('created_at','id','author_id')
+    get_backend().add(follower_id,list(entries[:timeline_setting('MAX_LENGTH')]))
+
+
+
+def remove_follow(follower_id,author_id):
+    get_backend().remove_author(follower_id,author_id)
+
+
+
+def rebuild_timeline(user):
+    pulled = pulled_author_ids(user)
+    followed = Follow.objects.filter(follower=user).exclude(following__in=pulled).values('following')
+    entries = Post.objects.filter(Q(author__in=followed) | Q(author=user)).order_by('-created_at','-id').values_list('created_at','id','author_id')
+    get_backend().replace(user.id,list(entries[:timeline_setting('MAX_LENGTH')]))
+
+
+
+def read_home_timeline(user,position,limit):
+    # merge the materialized timeline with the posts that are never fanned out:
+    # public posts from anyone and posts from followed high-follower accounts.
+    # Each source is read as its own keyset page, so the merged page is exact.
+    entries = get_backend().read(user.id,position,limit)
+
+    pulled = Q(is_public=True)
+    pulled_ids = pulled_author_ids(user)
+    if pulled_ids:
+        pulled |= Q(author__in=pulled_ids)
+    posts = {post.id:post for post in keyset_queryset(Post.objects.filter(pulled),position)[:limit]}
+
+    missing = [post_id for created_at,post_id in entries if post_id not in posts]
+    if missing:
+        posts.update(Post.objects.in_bulk(missing))
+
+    merged = sorted(posts.values(),key=lambda post:(post.created_at,post.id),reverse=True)
+    return merged[:limit]